@@ -0,0 +1 @@
+"""HTTP API чата для клиентов без интерфейса Streamlit (см. api/app.py)."""
@@ -0,0 +1,257 @@
+"""HTTP API чата.
+
+Те же операции, что и на страницах, но без Streamlit: отправка вопроса в
+сессию помощника (ответ целиком или потоком SSE), список помощников и
+сессий, страница истории и остаток генераций, а также скачивание экспорта
+истории по одноразовой ссылке со страниц (GET /v1/exports/<код>). Данные
+читаются через DatabaseManager, ответы запрашиваются через
+utils.flowise_client.
+
+Авторизация — активный ключ доступа пользователя:
+    Authorization: Bearer <active_token>
+
+Запуск в нескольких процессах (каждый со своим пулом соединений):
+    python -m api --workers 4
+    gunicorn api.app:app -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:8000
+
+Настройки в secrets.toml:
+    [api]
+    host = "0.0.0.0"
+    port = 8000
+    workers = 4
+    public_url = "https://chat.example.com/api"   # адрес API для ссылок со страниц
+
+Потоковый ответ (POST .../messages с "stream": true) — события SSE:
+    event: token   data: {"data": "<часть ответа>"}
+    event: end     data: {"message_id": "...", "remaining_generations": 41}
+    event: error   data: {"detail": "..."}
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import quote
+
+from fastapi import Depends, FastAPI, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from utils import chat_service, flowise_client, metrics
+from utils.chat_service import ChatError
+from utils.database import transfer
+from utils.database.database_manager import get_database
+from utils.log import get_logger
+
+log = get_logger("api")
+
+API_DEFAULTS = {
+    "host": "0.0.0.0",
+    "port": 8000,
+    "workers": 4
+}
+
+MAX_MESSAGE_LENGTH = 20000
+
+
+def _api_setting(key: str):
+    import streamlit as st
+    try:
+        return st.secrets["api"].get(key, API_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return API_DEFAULTS[key]
+
+
+class MessageRequest(BaseModel):
+    message: str = Field(..., min_length=1, max_length=MAX_MESSAGE_LENGTH)
+    stream: bool = False
+
+
+bearer = HTTPBearer(auto_error=False)
+
+
+async def database():
+    # Первое обращение создает подключения, поэтому не в цикле событий
+    return await run_in_threadpool(get_database)
+
+
+async def current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer), db=Depends(database)):
+    if credentials is None:
+        raise ChatError("Требуется ключ доступа", status=401)
+    return await run_in_threadpool(chat_service.authenticate, db, credentials.credentials)
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+async def _stream_reply(db, username: str, flow_id: str, session_id: str, prompt: str):
+    """События SSE с частями ответа.
+
+    Генерация резервируется в начале потока, по базе, а не по
+    кэшированному пользователю: одновременные потоки не получат ответов
+    сверх остатка. Вопрос и ответ сохраняются после последней части; при
+    ошибке, пустом ответе или отключении клиента ничего не сохраняется и
+    генерация возвращается.
+    """
+    started = time.perf_counter()
+    parts = []
+    cancel = threading.Event()
+    # Резерв внутри генератора: если клиент отключится до начала потока,
+    # генератор не запустится и списывать будет нечего
+    charge = chat_service.is_charged(flow_id)
+    if charge and not await run_in_threadpool(chat_service.charge_generation, db, username):
+        yield _sse("error", {"detail": "Закончились генерации"})
+        return
+    settled = not charge
+    try:
+        tokens = flowise_client.stream_tokens(
+            chat_service.get_chatflow_id(flow_id), prompt, session_id=session_id, cancel=cancel
+        )
+        async for text in iterate_in_threadpool(tokens):
+            parts.append(text)
+            yield _sse("token", {"data": text})
+
+        if not parts:
+            yield _sse("error", {"detail": "Пустой ответ помощника"})
+            return
+        message = await run_in_threadpool(
+            chat_service.save_exchange, db, username, flow_id, session_id, prompt, "".join(parts)
+        )
+        settled = True
+    except (asyncio.CancelledError, GeneratorExit):
+        # Клиент отключился: поток Flowise закрывается на следующей части
+        cancel.set()
+        metrics.inc("chat_generations_cancelled_total")
+        raise
+    except Exception as e:
+        log.error(f"Ошибка при получении ответа: {str(e)}",
+                  extra={"user": username, "flow": flow_id, "session": session_id})
+        yield _sse("error", {"detail": flowise_client.describe_error(e)})
+        return
+    finally:
+        if not settled:
+            # Ждать в отменяемой задаче нельзя, возврат выполняется в пуле потоков
+            asyncio.get_running_loop().run_in_executor(None, chat_service.refund_generation, db, username)
+
+    remaining = await run_in_threadpool(chat_service.get_remaining_generations, db, username)
+    log.info("Ответ отправлен потоком", extra={
+        "user": username, "flow": flow_id, "session": session_id,
+        "duration_ms": round((time.perf_counter() - started) * 1000)
+    })
+    yield _sse("end", {"message_id": message["message_id"], "remaining_generations": remaining})
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="Chat API", version="1")
+
+    @app.exception_handler(ChatError)
+    async def chat_error_handler(request, exc: ChatError):
+        headers = None
+        if exc.status == 401:
+            headers = {"WWW-Authenticate": "Bearer"}
+        elif exc.status == 503:
+            headers = {"Retry-After": str(max(1, round(flowise_client.get_breaker().retry_after())))}
+        return JSONResponse({"detail": str(exc)}, status_code=exc.status, headers=headers)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/v1/exports/{code}")
+    async def download_export(code: str, db=Depends(database)):
+        # Ключ доступа не нужен: ссылку выдает страница вошедшему пользователю,
+        # она одноразовая и действует EXPORT_LINK_TTL секунд
+        scope = await run_in_threadpool(transfer.take_export_link, db, code)
+        if scope is None:
+            raise ChatError("Ссылка недействительна или устарела", status=404)
+        records = transfer.iter_records(db, scope["username"], scope["flow_id"], scope["session_id"],
+                                        include_account=scope["include_account"])
+        name = f"chat_{scope['session_id'][:8]}" if scope["session_id"] else scope["username"]
+        return StreamingResponse(
+            iterate_in_threadpool(transfer.iter_gzip_chunks(records)),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}.ndjson.gz"}
+        )
+
+    @app.get("/v1/quota")
+    async def quota(user=Depends(current_user)):
+        return chat_service.get_quota(user)
+
+    @app.get("/v1/flows")
+    async def flows(user=Depends(current_user)):
+        return chat_service.list_flows(user)
+
+    @app.get("/v1/flows/{flow_id}/sessions")
+    async def sessions(flow_id: str, user=Depends(current_user), db=Depends(database)):
+        return await run_in_threadpool(chat_service.list_sessions, db, user, flow_id)
+
+    @app.get("/v1/flows/{flow_id}/sessions/{session_id}/messages")
+    async def history(flow_id: str, session_id: str,
+                      offset: int = Query(0, ge=0),
+                      limit: int = Query(chat_service.HISTORY_PAGE_SIZE, ge=1, le=chat_service.MAX_HISTORY_PAGE_SIZE),
+                      user=Depends(current_user), db=Depends(database)):
+        return await run_in_threadpool(chat_service.get_history_page, db, user, flow_id, session_id, offset, limit)
+
+    @app.post("/v1/flows/{flow_id}/sessions/{session_id}/messages")
+    async def send_message(flow_id: str, session_id: str, request: MessageRequest,
+                           user=Depends(current_user), db=Depends(database)):
+        username = user["username"]
+        await run_in_threadpool(chat_service.check_send, db, user, flow_id, session_id)
+
+        if request.stream:
+            return StreamingResponse(
+                _stream_reply(db, username, flow_id, session_id, request.message),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        def generate(cancel):
+            response = flowise_client.predict(chat_service.get_chatflow_id(flow_id), request.message, session_id,
+                                              cancel=cancel)
+            if not response:
+                raise ChatError("Пустой ответ помощника", status=502)
+            return response
+
+        # Повтор того же запроса (например, после обрыва соединения клиента)
+        # присоединяется к выполняющемуся обмену
+        future, _ = chat_service.submit_exchange(db, username, flow_id, session_id, request.message, generate)
+        try:
+            # shield: отключение клиента не отменяет обмен, к которому могли присоединиться другие
+            message = await asyncio.shield(asyncio.wrap_future(future))
+        except ChatError:
+            raise
+        except flowise_client.FlowiseUnavailable as e:
+            raise ChatError(str(e), status=503)
+        except flowise_client.FlowiseTimeout as e:
+            raise ChatError(flowise_client.describe_error(e), status=504)
+        except Exception as e:
+            log.error(f"Ошибка при получении ответа: {str(e)}",
+                      extra={"user": username, "flow": flow_id, "session": session_id})
+            raise ChatError("Ошибка при получении ответа", status=502)
+
+        remaining = await run_in_threadpool(chat_service.get_remaining_generations, db, username)
+        return {"message": message, "remaining_generations": remaining}
+
+    return app
+
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API чата")
+    parser.add_argument("--host", default=_api_setting("host"))
+    parser.add_argument("--port", type=int, default=int(_api_setting("port")))
+    parser.add_argument("--workers", type=int, default=int(_api_setting("workers")),
+                        help="процессов uvicorn (у каждого свои пулы MongoDB и Redis)")
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run("api.app:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Проверка отмены запроса к Flowise.
+
+Запрос к тестовому серверу (benchmarks/loadtest/fake_flowise.py)
+отменяется через CANCEL_AFTER секунд после начала; вызов должен завершиться
+FlowiseCancelled не позднее чем через MAX_DELAY секунд после отмены, а не
+по готовности ответа. Проверяются чат-поток без потоковой передачи (сервер
+молчит до конца генерации и отвечает одним JSON) и поток SSE с долгими
+паузами между частями.
+
+Запуск из корня репозитория:
+    python benchmarks/cancel_check.py
+
+Скрипт завершается с кодом 1, если хотя бы один вызов не вернулся вовремя.
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlit.runtime.secrets import Secrets
+import streamlit as st
+
+from loadtest.fake_flowise import FakeFlowiseConfig, start_server
+from utils import flowise_client
+
+CANCEL_AFTER = 0.5  # секунд
+MAX_DELAY = 1.0  # секунд
+
+# (название, настройки тестового сервера)
+CASES = [
+    ("ответ одним JSON", dict(latency_ms=10000, jitter_ms=0, streaming=False)),
+    ("поток SSE", dict(latency_ms=0, jitter_ms=0, token_delay_ms=10000, streaming=True)),
+]
+
+
+def check(name, config):
+    server, base_url = start_server(FakeFlowiseConfig(**config))
+    secrets = Secrets()
+    secrets._secrets = {"flowise": {"base_url": base_url, "retries": 0}}
+    st.secrets = secrets
+    flowise_client._session = None
+    flowise_client._breakers.clear()
+
+    cancel = threading.Event()
+    threading.Timer(CANCEL_AFTER, cancel.set).start()
+    started = time.monotonic()
+    try:
+        flowise_client.predict("flow", "Вопрос", session_id="session", timeout=30, cancel=cancel)
+        outcome = "ответ получен"
+    except flowise_client.FlowiseCancelled:
+        outcome = "отменен"
+    except Exception as e:
+        outcome = f"ошибка {type(e).__name__}: {e}"
+    delay = time.monotonic() - started - CANCEL_AFTER
+    server.shutdown()
+    ok = outcome == "отменен" and delay <= MAX_DELAY
+    print(f"{'ok  ' if ok else 'FAIL'} {name}: {outcome}, через {delay:.2f} с после отмены")
+    return ok
+
+
+def main():
+    failures = sum(not check(name, config) for name, config in CASES)
+    print(f"Неверных результатов: {failures} из {len(CASES)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Сравнение кодеков значений кэша Redis.
+
+Сравнивает текущий формат (json.dumps(..., default=str)) с BSON и
+msgpack, со сжатием и без, на документе пользователя и историях чата
+разного размера. Для каждого варианта печатается время кодирования и
+декодирования (медиана), размер значения и сохраняются ли типы.
+
+Запуск из корня репозитория:
+    python benchmarks/codec_bench.py
+    python benchmarks/codec_bench.py --sizes 10 1000 10000 --json codec.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+
+from utils.database.codec import ValueCodec, msgpack
+
+REPEAT = 7
+
+
+def make_user():
+    now = datetime.now().replace(microsecond=0)
+    return {
+        "_id": ObjectId(),
+        "username": "benchmark_user",
+        "email": "benchmark@example.com",
+        "password": "$pbkdf2-sha256$29000$" + "x" * 64,
+        "profile_image": "profile_images/benchmark_user.png",
+        "remaining_generations": 420,
+        "active_token": "b99176c5-8bca-4be9-b066-894e4103f32c",
+        "is_admin": False,
+        "created_at": now,
+        "updated_at": now,
+        "chat_flows": [
+            {"id": f"flow-{i}", "name": f"Помощник {i}", "created_at": now, "current_session": f"session-{i}"}
+            for i in range(5)
+        ],
+    }
+
+
+def make_history(size):
+    start = datetime.now().replace(microsecond=0) - timedelta(days=30)
+    messages = []
+    for i in range(size):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = (
+            f"Вопрос номер {i}: как настроить поиск по документам?"
+            if role == "user"
+            else f"Ответ {i}. " + "Подробное объяснение с примерами и списком шагов. " * 12
+        )
+        messages.append({
+            "role": role,
+            "content": content,
+            "timestamp": (start + timedelta(seconds=i * 30)).isoformat(),
+        })
+    return messages
+
+
+def variants():
+    yield "json (текущий)", ValueCodec("json", compress_threshold=None)
+    yield "bson", ValueCodec("bson", compress_threshold=None)
+    yield "bson+zlib", ValueCodec("bson", compress_threshold=0)
+    if msgpack is not None:
+        yield "msgpack", ValueCodec("msgpack", compress_threshold=None)
+        yield "msgpack+zlib", ValueCodec("msgpack", compress_threshold=0)
+
+
+def timed(fn, arg, loops):
+    samples = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn(arg)
+        samples.append((time.perf_counter() - started) / loops)
+    return statistics.median(samples)
+
+
+def bench_value(label, value):
+    loops = max(1, 2000 // max(1, len(value) if isinstance(value, list) else 1))
+    results = []
+    for name, codec in variants():
+        encoded = codec.encode(value)
+        decoded = codec.decode(encoded)
+        results.append({
+            "value": label,
+            "codec": name,
+            "bytes": len(encoded),
+            "encode_us": timed(codec.encode, value, loops) * 1e6,
+            "decode_us": timed(codec.decode, encoded, loops) * 1e6,
+            "types_preserved": decoded == value,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение кодеков кэша")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10, 1000, 10000],
+                        help="размеры историй чата")
+    parser.add_argument("--json", dest="json_path", default=None,
+                        help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    results = bench_value("user", make_user())
+    for size in args.sizes:
+        results.extend(bench_value(f"history[{size}]", make_history(size)))
+
+    print(f"{'значение':<16} {'кодек':<16} {'байт':>10} {'encode, мкс':>12} {'decode, мкс':>12}  типы")
+    for row in results:
+        print(
+            f"{row['value']:<16} {row['codec']:<16} {row['bytes']:>10} "
+            f"{row['encode_us']:>12.1f} {row['decode_us']:>12.1f}  "
+            f"{'да' if row['types_preserved'] else 'нет'}"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Микробенчмарки горячих путей данных и текста.
+
+Работает без MongoDB и Redis: DatabaseManager создается с хранилищем
+"local" (mongomock и fakeredis из requirements-dev.txt). Абсолютные
+значения для операций с базой отличаются от рабочего сервера, поэтому
+результаты предназначены для сравнения версий кода между собой.
+
+Замеры:
+    history.save / history.get_cold / history.get_cached  — 10, 1000, 10000 сообщений
+    sessions.available                                     — 1000 сессий
+    translation.split_into_chunks                          — длинный markdown
+    tokens.is_token_deactivated                            — 100 000 отозванных ключей
+    messages.hash                                          — хэши длинной истории
+    security.verify_password                               — проверка PBKDF2
+
+Запуск из корня репозитория:
+    python benchmarks/hot_paths.py
+    python benchmarks/hot_paths.py --json results.json
+    python benchmarks/hot_paths.py --compare baseline.json --threshold 0.2
+    python benchmarks/hot_paths.py --filter history --repeat 10
+
+С --compare скрипт завершается с кодом 1, если медиана какого-либо
+замера выросла больше чем на --threshold (доля) относительно файла.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database.database_manager import DatabaseManager
+
+HISTORY_SIZES = [10, 1000, 10000]
+SESSION_COUNT = 1000
+REVOKED_TOKENS = 100_000
+HASHED_MESSAGES = 10000
+
+USERNAME = "bench_user"
+FLOW_ID = "bench_flow"
+
+
+def make_messages(count):
+    start = datetime.now() - timedelta(days=30)
+    messages = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = (
+            f"Вопрос номер {i}: как настроить поиск по документам?"
+            if role == "user"
+            else f"Ответ {i}. " + "Подробное объяснение с примерами и списком шагов. " * 12
+        )
+        messages.append({
+            "role": role,
+            "content": content,
+            "timestamp": (start + timedelta(seconds=i * 30)).isoformat()
+        })
+    return messages
+
+
+def make_markdown(paragraphs=400):
+    blocks = []
+    for i in range(paragraphs):
+        blocks.append(f"## Раздел {i}\n")
+        blocks.append("Текст раздела с пояснениями. Второе предложение раздела. " * 5)
+        blocks.append("- пункт списка\n- еще один пункт\n")
+        blocks.append("```python\nprint('пример кода')\n```\n")
+    return "\n".join(blocks)
+
+
+def measure(fn, repeat, setup=None):
+    """Время одного вызова fn в миллисекундах для каждого повтора"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def bench_history(db, repeat):
+    for size in HISTORY_SIZES:
+        session_id = f"history-{size}"
+        messages = make_messages(size)
+        cache_key = f"chat_history:{USERNAME}:{FLOW_ID}:{session_id}"
+
+        yield "history.save", {"messages": size}, measure(
+            lambda: db.save_chat_history(USERNAME, FLOW_ID, session_id, messages), repeat
+        )
+        yield "history.get_cold", {"messages": size}, measure(
+            lambda: db.get_chat_history(USERNAME, FLOW_ID, session_id), repeat,
+            setup=lambda: db.redis_client.delete(cache_key)
+        )
+        db.get_chat_history(USERNAME, FLOW_ID, session_id)
+        yield "history.get_cached", {"messages": size}, measure(
+            lambda: db.get_chat_history(USERNAME, FLOW_ID, session_id), repeat
+        )
+
+
+def bench_sessions(db, repeat):
+    now = datetime.now()
+    db.chat_sessions.delete_many({"username": USERNAME, "flow_id": FLOW_ID})
+    db.chat_sessions.insert_many([
+        {
+            "username": USERNAME,
+            "flow_id": FLOW_ID,
+            "session_id": f"session-{i}",
+            "name": f"Сессия {i}",
+            "is_primary": i == 0,
+            "created_at": now + timedelta(seconds=i)
+        }
+        for i in range(SESSION_COUNT)
+    ])
+    yield "sessions.available", {"sessions": SESSION_COUNT}, measure(
+        lambda: db.get_available_sessions(USERNAME, FLOW_ID), repeat
+    )
+
+
+def bench_translation(repeat):
+    from utils.translation import split_into_chunks
+    text = make_markdown()
+    yield "translation.split_into_chunks", {"chars": len(text)}, measure(
+        lambda: split_into_chunks(text), repeat
+    )
+
+
+def bench_tokens(repeat):
+    from utils.utils import is_token_deactivated
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "deactivated_keys.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"deactivated_keys": [
+                {"token": f"token-{i:08d}", "deactivated_at": "2024-01-01T00:00:00", "reason": "generations_depleted"}
+                for i in range(REVOKED_TOKENS)
+            ]}, f)
+        # Худший случай: ключа нет в списке
+        yield "tokens.is_token_deactivated", {"revoked": REVOKED_TOKENS}, measure(
+            lambda: is_token_deactivated("active-token", path), repeat
+        )
+
+
+def bench_hash(repeat):
+    from utils.chat_database import get_message_hash
+    messages = make_messages(HASHED_MESSAGES)
+    yield "messages.hash", {"messages": HASHED_MESSAGES}, measure(
+        lambda: [get_message_hash(m["role"], m["content"]) for m in messages], repeat
+    )
+
+
+def bench_password(repeat):
+    from utils.security import hash_password, verify_password
+    hashed = hash_password("correct horse battery staple")
+    yield "security.verify_password", {}, measure(
+        lambda: verify_password("correct horse battery staple", hashed), repeat
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def result_key(result):
+    return result["name"] + "".join(f" {k}={v}" for k, v in sorted(result["params"].items()))
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    print(f"\nСравнение с {baseline_path}:")
+    for result in results:
+        key = result_key(result)
+        previous = baseline.get(key)
+        if not previous:
+            print(f"  {key:<50} нет в базовом файле")
+            continue
+        change = result["median_ms"] / previous["median_ms"] - 1 if previous["median_ms"] else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "  РЕГРЕССИЯ"
+            regressions.append(key)
+        print(f"  {key:<50} {previous['median_ms']:>10.3f} -> {result['median_ms']:>10.3f} мс ({change:+.1%}){mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default=None, help="только замеры, имя которых содержит строку")
+    parser.add_argument("--json", dest="json_path", default=None)
+    parser.add_argument("--compare", default=None, help="файл результатов предыдущей версии")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    db = DatabaseManager(config={"database": {"backend": "local"}})
+    suites = [
+        ("history", lambda: bench_history(db, args.repeat)),
+        ("sessions", lambda: bench_sessions(db, args.repeat)),
+        ("translation", lambda: bench_translation(args.repeat)),
+        ("tokens", lambda: bench_tokens(args.repeat)),
+        ("messages", lambda: bench_hash(args.repeat)),
+        ("security", lambda: bench_password(args.repeat)),
+    ]
+
+    results = []
+    for prefix, suite in suites:
+        # Набор целиком пропускается, если фильтр к нему не относится
+        if args.filter and args.filter not in prefix and not args.filter.startswith(prefix + "."):
+            continue
+        for name, params, timings in suite():
+            if args.filter and args.filter not in name:
+                continue
+            result = {
+                "name": name,
+                "params": params,
+                "repeat": len(timings),
+                "median_ms": round(statistics.median(timings), 3),
+                "min_ms": round(min(timings), 3),
+                "max_ms": round(max(timings), 3),
+            }
+            results.append(result)
+            print(f"{result_key(result):<50} медиана {result['median_ms']:>10.3f} мс, мин {result['min_ms']:>10.3f} мс")
+
+    report = {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": db.backend,
+        "results": results,
+    }
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
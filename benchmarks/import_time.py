@@ -0,0 +1,141 @@
+"""Профилирование времени импорта страниц приложения.
+
+Для каждой страницы берутся ее импорты верхнего уровня и выполняются
+в отдельном процессе под `python -X importtime`, так что замер
+соответствует холодному старту скрипта. Модули, загружаемые самим
+интерпретатором при запуске, из отчета исключаются.
+
+Запуск из корня репозитория:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py pages/app.py --top 20
+    python benchmarks/import_time.py --budget-ms 1500 --json import_time.json
+
+С параметром --budget-ms скрипт завершается с кодом 1, если хотя бы
+одна страница превышает бюджет.
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_TARGETS = [
+    "main.py",
+    "pages/registr.py",
+    "pages/key_input.py",
+    "pages/simple_chat.py",
+    "pages/app.py",
+    "pages/new_chat.py",
+    "pages/profile.py",
+    "pages/admin/generate_tokens.py",
+]
+
+
+def collect_imports(path):
+    """Импорты верхнего уровня файла в виде исходного кода"""
+    with open(os.path.join(ROOT, path), encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    return [
+        ast.unparse(node)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+
+
+def run_importtime(code):
+    """Выполняет код под -X importtime и разбирает отчет интерпретатора"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us = int(parts[0])
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # строка заголовка
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append({
+            "module": name.strip(),
+            "self_ms": self_us / 1000,
+            "cumulative_ms": cumulative_us / 1000,
+            "depth": depth,
+        })
+    return rows, result.returncode, "\n".join(errors)
+
+
+def profile_target(path, startup_modules):
+    """Замер импорта одной страницы"""
+    rows, returncode, errors = run_importtime("\n".join(collect_imports(path)))
+    rows = [row for row in rows if row["module"] not in startup_modules]
+    top_level = [row for row in rows if row["depth"] == 0]
+    return {
+        "target": path,
+        "ok": returncode == 0,
+        "error": errors.strip() if returncode != 0 else "",
+        "total_ms": round(sum(row["cumulative_ms"] for row in top_level), 1),
+        "modules": len(rows),
+        "top_level": sorted(top_level, key=lambda row: row["cumulative_ms"], reverse=True),
+        "heaviest_self": sorted(rows, key=lambda row: row["self_ms"], reverse=True),
+    }
+
+
+def print_report(report, top):
+    status = "ok" if report["ok"] else "ОШИБКА"
+    print(f"\n{report['target']}: {report['total_ms']:.1f} ms, модулей: {report['modules']} [{status}]")
+    if not report["ok"]:
+        print(f"  {report['error'].splitlines()[-1] if report['error'] else 'импорт завершился с ошибкой'}")
+    print("  Импорты верхнего уровня (cumulative):")
+    for row in report["top_level"][:top]:
+        print(f"    {row['cumulative_ms']:9.1f} ms  {row['module']}")
+    print("  Самые тяжелые модули (self):")
+    for row in report["heaviest_self"][:top]:
+        print(f"    {row['self_ms']:9.1f} ms  {row['module']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта страниц приложения")
+    parser.add_argument("targets", nargs="*", default=DEFAULT_TARGETS,
+                        help="файлы страниц относительно корня репозитория")
+    parser.add_argument("--top", type=int, default=10, help="сколько модулей показывать")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="бюджет времени импорта на страницу")
+    parser.add_argument("--json", dest="json_path", default=None,
+                        help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    startup_rows, _, _ = run_importtime("pass")
+    startup_modules = {row["module"] for row in startup_rows}
+
+    reports = [profile_target(target, startup_modules) for target in args.targets]
+    for report in reports:
+        print_report(report, args.top)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+    over_budget = [
+        report for report in reports
+        if not report["ok"] or (args.budget_ms is not None and report["total_ms"] > args.budget_ms)
+    ]
+    if over_budget:
+        print("\nПревышен бюджет или ошибка импорта: " + ", ".join(r["target"] for r in over_budget))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Синтетические пользователи, помощники, сессии и сообщения.
+
+Данные записываются через DatabaseManager так же, как их создают страницы
+(registr, key_input, new_chat), поэтому нагрузочный тест видит обычные
+документы: активный токен, запас генераций, список chat_flows с
+current_session и историю в chat_history.
+
+Запуск отдельно (в базу из secrets.toml или в локальное хранилище):
+    python benchmarks/loadtest/dataset.py --users 50 --flows 2 --sessions 3 --messages 40
+"""
+import argparse
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+USER_PREFIX = "load_user"
+SEARCH_FLOW = "search"
+
+QUESTIONS = [
+    "Как настроить поиск по документам?",
+    "Составь план статьи о продуктах компании",
+    "Чем отличается тариф Бизнес от тарифа Старт?",
+    "Переведи на русский краткое описание API",
+    "Какие документы нужны для подключения?",
+    "Сравни два варианта интеграции и дай рекомендацию",
+]
+
+
+def username_for(index: int) -> str:
+    return f"{USER_PREFIX}_{index:05d}"
+
+
+def make_history(count: int, rng: random.Random, start: datetime):
+    messages = []
+    for i in range(count):
+        if i % 2 == 0:
+            content = rng.choice(QUESTIONS) + f" (вопрос {i // 2 + 1})"
+            role = "user"
+        else:
+            content = "Ответ помощника. " + "Пояснение с примерами и списком шагов. " * rng.randint(3, 15)
+            role = "assistant"
+        messages.append({
+            "role": role,
+            "content": content,
+            "timestamp": (start + timedelta(seconds=i * 45)).isoformat()
+        })
+    return messages
+
+
+def seed_sessions(db, username: str, flow_id: str, sessions: int, messages: int,
+                  rng: random.Random, now: datetime):
+    """Сессии помощника с историей; первая сессия — основная"""
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+    for session_index, session_id in enumerate(session_ids):
+        created_at = now - timedelta(days=sessions - session_index)
+        db.chat_sessions.insert_one({
+            "username": username,
+            "flow_id": flow_id,
+            "session_id": session_id,
+            "name": "Основная сессия" if session_index == 0 else f"Сессия {session_index + 1}",
+            "is_primary": session_index == 0,
+            "created_at": created_at,
+            "updated_at": created_at
+        })
+        if messages:
+            db.save_chat_history(username, flow_id, session_id, make_history(messages, rng, created_at))
+    return session_ids
+
+
+def generate(db, users: int = 10, flows: int = 1, sessions: int = 2, messages: int = 20,
+             generations: int = 100000, seed: int = 0):
+    """Создает набор данных и возвращает описание пользователей.
+
+    Каждый элемент результата: {"username", "email", "flows": {flow_id: [session_id, ...]}}.
+    Кроме помощников из chat_flows (страница new_chat) создаются сессии
+    потока "search" (страница app). Пользователи с теми же именами
+    перезаписываются.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    created = []
+
+    for index in range(users):
+        username = username_for(index)
+        for flow in (db.users.find_one({"username": username}) or {}).get("chat_flows", []):
+            db.forget_history(username, flow["id"])
+        db.forget_history(username, SEARCH_FLOW)
+        db.chat_sessions.delete_many({"username": username})
+        db.chat_history.delete_many({"username": username})
+
+        user_flows = {SEARCH_FLOW: seed_sessions(db, username, SEARCH_FLOW, sessions, messages, rng, now)}
+        chat_flows = []
+        for flow_index in range(flows):
+            flow_id = f"flow-{index:05d}-{flow_index}"
+            user_flows[flow_id] = seed_sessions(db, username, flow_id, sessions, messages, rng, now)
+            chat_flows.append({
+                "id": flow_id,
+                "name": f"Помощник {flow_index + 1}",
+                "created_at": now - timedelta(minutes=flow_index),
+                "current_session": user_flows[flow_id][0] if sessions else str(uuid.uuid4())
+            })
+
+        email = f"{username}@loadtest.local"
+        db.users.replace_one(
+            {"username": username},
+            {
+                "username": username,
+                "email": email,
+                "password": "",
+                "remaining_generations": generations,
+                "active_token": f"load-token-{index:05d}",
+                "token_activated_at": now,
+                "is_admin": False,
+                "chat_flows": chat_flows,
+                "created_at": now,
+                "updated_at": now
+            },
+            upsert=True
+        )
+        db.invalidate_user(username)
+        created.append({"username": username, "email": email, "flows": user_flows})
+
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические данные для нагрузочного теста")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--flows", type=int, default=1, help="помощников на пользователя")
+    parser.add_argument("--sessions", type=int, default=2, help="сессий на помощника")
+    parser.add_argument("--messages", type=int, default=20, help="сообщений в сессии")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--local", action="store_true", help="локальное хранилище вместо secrets.toml")
+    args = parser.parse_args()
+
+    from utils.database.database_manager import DatabaseManager
+    db = DatabaseManager(config={"database": {"backend": "local"}}) if args.local else DatabaseManager()
+    users = generate(db, args.users, args.flows, args.sessions, args.messages, seed=args.seed)
+    sessions = args.users * (args.flows + 1) * args.sessions
+    print(f"Создано пользователей: {len(users)}, сессий: {sessions}, сообщений: {sessions * args.messages}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Локальный сервер, отвечающий как Flowise API.
+
+Поддерживает запросы, которые делает пакет flowise:
+    GET  /api/v1/chatflows-streaming/<id>  -> {"isStreaming": ...}
+    POST /api/v1/prediction/<id>           -> JSON {"text": ...} или поток SSE
+
+Тело POST — JSON или multipart/form-data с файлами (поле files); имена и
+размеры полученных файлов сохраняются в FakeFlowiseConfig.uploads.
+
+Задержка ответа, разброс, скорость выдачи токенов и доля ошибок
+настраиваются, чтобы нагрузочный тест не зависел от настоящей модели.
+
+Запуск отдельно:
+    python benchmarks/loadtest/fake_flowise.py --port 3999 --latency-ms 800 --streaming
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_WORDS = (
+    "Ответ сформирован тестовым сервером и содержит несколько предложений, "
+    "похожих на ответ модели, со списками и пояснениями к каждому шагу."
+).split()
+
+
+class FakeFlowiseConfig:
+    def __init__(self, latency_ms=500.0, jitter_ms=100.0, token_delay_ms=20.0, tokens=80,
+                 streaming=False, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_delay_ms = token_delay_ms
+        self.tokens = tokens
+        self.streaming = streaming
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.uploads = []  # (имя, тип, размер) файлов из запросов multipart
+
+    def delay(self):
+        with self.lock:
+            self.requests += 1
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+            failed = self.random.random() < self.error_rate
+        return max(0.0, self.latency_ms + jitter) / 1000, failed
+
+    def answer_tokens(self, question):
+        words = [f"«{question[:40]}»:"]
+        while len(words) < self.tokens:
+            words.append(ANSWER_WORDS[len(words) % len(ANSWER_WORDS)])
+        return [word + " " for word in words]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: FakeFlowiseConfig = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/api/v1/chatflows-streaming/"):
+            self._send_json(200, {"isStreaming": self.config.streaming})
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        if not self.path.startswith("/api/v1/prediction/"):
+            self._send_json(404, {"message": "Not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            payload = self._parse_form(content_type, body)
+        else:
+            payload = json.loads(body or b"{}")
+        question = payload.get("question", "")
+        session_id = (payload.get("overrideConfig") or {}).get("sessionId") or payload.get("chatId")
+
+        delay, failed = self.config.delay()
+        time.sleep(delay)
+        if failed:
+            self._send_json(500, {"message": "Тестовая ошибка сервера"})
+            return
+
+        tokens = self.config.answer_tokens(question)
+        if payload.get("streaming") and self.config.streaming:
+            self._stream(tokens, session_id)
+        else:
+            self._send_json(200, {
+                "text": "".join(tokens).strip(),
+                "question": question,
+                "chatId": payload.get("chatId"),
+                "sessionId": session_id,
+            })
+
+    def _parse_form(self, content_type, body):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("ascii") + body
+        )
+        payload = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                with self.config.lock:
+                    self.config.uploads.append(
+                        (part.get_filename(), part.get_content_type(), len(part.get_payload(decode=True)))
+                    )
+            else:
+                payload[name] = part.get_payload(decode=True).decode("utf-8")
+        payload["streaming"] = payload.get("streaming") == "true"
+        return payload
+
+    def _stream(self, tokens, session_id):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Как Flowise (Express): поток передается частями chunked encoding,
+        # каждое событие — отдельная часть
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(event, data):
+            line = json.dumps({"event": event, "data": data}, ensure_ascii=False)
+            chunk = f"data: {line}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.flush()
+
+        send("start", "")
+        for token in tokens:
+            time.sleep(self.config.token_delay_ms / 1000)
+            send("token", token)
+        send("metadata", {"sessionId": session_id})
+        send("end", "[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_server(config: FakeFlowiseConfig, host="127.0.0.1", port=0):
+    """Запуск сервера в фоновом потоке; возвращает (server, base_url)"""
+    handler = type("FakeFlowiseHandler", (_Handler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Тестовый сервер Flowise")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3999)
+    parser.add_argument("--latency-ms", type=float, default=500.0)
+    parser.add_argument("--jitter-ms", type=float, default=100.0)
+    parser.add_argument("--token-delay-ms", type=float, default=20.0)
+    parser.add_argument("--tokens", type=int, default=80)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = FakeFlowiseConfig(args.latency_ms, args.jitter_ms, args.token_delay_ms, args.tokens,
+                               args.streaming, args.error_rate)
+    server, base_url = start_server(config, args.host, args.port)
+    print(f"Тестовый Flowise: {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
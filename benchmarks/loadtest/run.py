@@ -0,0 +1,360 @@
+"""Нагрузочный тест страниц чата с несколькими одновременными сессиями.
+
+Каждый виртуальный пользователь — отдельный streamlit.testing.v1.AppTest
+в своем потоке: открывает страницу (new_chat, app или simple_chat),
+затем отправляет сообщения через поле ввода и кнопку «Отправить».
+Все сессии работают в одном процессе с общим DatabaseManager, как
+сессии одного сервера Streamlit. Flowise заменяется тестовым сервером
+fake_flowise.py с настраиваемой задержкой и потоковой передачей.
+
+Для каждого числа пользователей выводятся перцентили времени
+перезапуска скрипта (p50/p95/p99) и пропускная способность
+(перезапусков и ответов в секунду) — по этим строкам строятся кривые
+зависимости от нагрузки.
+
+Запуск из корня репозитория:
+    python benchmarks/loadtest/run.py --users 1,5,10,25 --messages 3
+    python benchmarks/loadtest/run.py --pages new_chat --latency-ms 1500 --streaming --json load.json
+    python benchmarks/loadtest/run.py --flowise-url http://127.0.0.1:3999 --backend secrets
+
+По умолчанию база — локальное хранилище (requirements-dev.txt); с
+--backend secrets используются MongoDB и Redis из .streamlit/secrets.toml,
+в которые генератор данных записывает пользователей load_user_*.
+Тестовый сервер в том же процессе конкурирует со страницами за GIL;
+для точных замеров его лучше запустить отдельно и передать --flowise-url.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import streamlit as st
+from unittest.mock import MagicMock
+
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+import dataset
+from fake_flowise import FakeFlowiseConfig, start_server
+from utils.database.database_manager import DatabaseManager
+
+PAGES = {
+    "new_chat": "pages/new_chat.py",
+    "app": "pages/app.py",
+    "simple_chat": "pages/simple_chat.py",
+}
+
+SIMPLE_CHAT_FLOW = "load-simple-chat"
+SEARCH_CHAT_FLOW = "load-search-chat"
+
+
+def share_server_objects():
+    """Общие для всех сессий Runtime и кэш байткода, как на сервере.
+
+    AppTest рассчитан на одну сессию в процессе:
+    - перед запуском он записывает в Runtime._instance заглушку, а после
+      запуска сбрасывает ее в None. Скрипт, который в это время еще
+      выполняется в другом потоке, падает с «Runtime hasn't been created!»,
+      и его AppTest ждет до таймаута. Вместо None отдается общая заглушка;
+    - каждый запуск создает свой ScriptCache и заново компилирует страницу.
+      Сервер компилирует страницу один раз, а одновременная компиляция в
+      нескольких потоках в Python 3.11 иногда завершается SystemError
+      «AST constructor recursion depth mismatch».
+    """
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: cls._instance or shared)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+
+def isolate_pages():
+    """Отдельный список страниц для каждой сессии AppTest.
+
+    AppTest хранит список страниц в общем для процесса кэше, который
+    строится по главному скрипту первой запущенной сессии. Сессия
+    страницы new_chat могла получить список, построенный для app.py, и
+    выполнить чужой скрипт. Здесь список всегда состоит из главного
+    скрипта самой сессии.
+    """
+    from pathlib import Path
+    from streamlit.runtime.pages_manager import PagesStrategyV1
+    from streamlit.source_util import page_icon_and_name
+    from streamlit.util import calc_md5
+
+    def get_pages(strategy):
+        script_path = strategy.pages_manager.main_script_path
+        page_hash = calc_md5(script_path)
+        icon, name = page_icon_and_name(Path(script_path))
+        return {page_hash: {
+            "page_script_hash": page_hash,
+            "page_name": name,
+            "icon": icon,
+            "script_path": str(Path(script_path).resolve()),
+        }}
+
+    PagesStrategyV1.get_pages = get_pages
+
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "mean": None}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50), 1),
+        "p95": round(percentile(values, 0.95), 1),
+        "p99": round(percentile(values, 0.99), 1),
+        "mean": round(statistics.mean(values), 1),
+    }
+
+
+class VirtualUser:
+    """Одна сессия браузера: открыть страницу и отправить несколько сообщений"""
+
+    def __init__(self, page, user, messages, think_ms, timeout):
+        self.page = page
+        self.user = user
+        self.messages = messages
+        self.think_ms = think_ms
+        self.timeout = timeout
+        self.samples = []
+
+    def _timed_run(self, at, kind):
+        started = time.perf_counter()
+        error = None
+        try:
+            at.run()
+            if at.exception:
+                error = at.exception[0].message
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        elapsed = (time.perf_counter() - started) * 1000
+        self.samples.append({"page": self.page, "kind": kind, "ms": elapsed, "error": error})
+        return error is None
+
+    def _missing(self, what, at):
+        """Ошибка сценария: на странице нет ожидаемого элемента"""
+        shown = [element.value for element in list(at.error) + list(at.warning)]
+        self.samples.append({"page": self.page, "kind": "send", "ms": 0.0,
+                             "error": f"{self.page}: {what}" + (f" ({shown[0]})" if shown else "")})
+
+    def _button(self, at, label=None, key=None):
+        return next((button for button in at.button
+                     if (label is None or button.label == label) and (key is None or button.key == key)), None)
+
+    def run(self, start_event):
+        at = AppTest.from_file(os.path.join(ROOT, PAGES[self.page]), default_timeout=self.timeout)
+        at.session_state["authenticated"] = True
+        at.session_state["username"] = self.user["username"]
+        at.session_state["email"] = self.user["email"]
+
+        start_event.wait()
+        if not self._timed_run(at, "load"):
+            return
+
+        for index in range(self.messages):
+            if self.think_ms:
+                time.sleep(self.think_ms / 1000)
+            # В бесплатном чате после лимита ответов поле ввода скрыто — историю очищают
+            if self.page == "simple_chat" and "message_input" not in [text.key for text in at.text_area]:
+                clear = self._button(at, key="clear_history_button")
+                if clear is None:
+                    self._missing("нет кнопки очистки истории", at)
+                    return
+                clear.click()
+                if not self._timed_run(at, "clear"):
+                    return
+            send = self._button(at, "Отправить")
+            if send is None:
+                self._missing("нет кнопки отправки", at)
+                return
+            at.text_area(key="message_input").input(f"{dataset.QUESTIONS[index % len(dataset.QUESTIONS)]} #{index}")
+            send.click()
+            if not self._timed_run(at, "send"):
+                return
+
+
+def run_step(users, pages, messages, think_ms, timeout):
+    """Одна ступень нагрузки: все пользователи стартуют одновременно"""
+    start_event = threading.Event()
+    virtual_users = [
+        VirtualUser(pages[index % len(pages)], user, messages, think_ms, timeout)
+        for index, user in enumerate(users)
+    ]
+    threads = [
+        threading.Thread(target=virtual_user.run, args=(start_event,), daemon=True)
+        for virtual_user in virtual_users
+    ]
+    for thread in threads:
+        thread.start()
+
+    started = time.perf_counter()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    samples = [sample for virtual_user in virtual_users for sample in virtual_user.samples]
+    ok = [sample for sample in samples if sample["error"] is None]
+    errors = [sample for sample in samples if sample["error"] is not None]
+
+    result = {
+        "users": len(users),
+        "duration_s": round(duration, 3),
+        "reruns": len(samples),
+        "errors": len(errors),
+        "reruns_per_s": round(len(ok) / duration, 2) if duration else None,
+        "answers_per_s": round(sum(1 for s in ok if s["kind"] == "send") / duration, 2) if duration else None,
+        "latency_ms": {
+            "all": summarize([s["ms"] for s in ok]),
+            "load": summarize([s["ms"] for s in ok if s["kind"] == "load"]),
+            "send": summarize([s["ms"] for s in ok if s["kind"] == "send"]),
+        },
+        "pages": {
+            page: summarize([s["ms"] for s in ok if s["page"] == page])
+            for page in pages
+        },
+        "error_samples": sorted({s["error"] for s in errors})[:5],
+    }
+    return result
+
+
+def print_header():
+    print(f"{'польз.':>6} {'перезап.':>8} {'ошибки':>6} {'перез./с':>9} {'отв./с':>7} "
+          f"{'p50':>8} {'p95':>8} {'p99':>8} {'send p50':>9} {'send p95':>9} {'send p99':>9}")
+
+
+def format_ms(value):
+    return f"{value:>8.1f}" if value is not None else f"{'—':>8}"
+
+
+def print_step(result):
+    latency = result["latency_ms"]
+    print(
+        f"{result['users']:>6} {result['reruns']:>8} {result['errors']:>6} "
+        f"{result['reruns_per_s']:>9.2f} {result['answers_per_s']:>7.2f} "
+        f"{format_ms(latency['all']['p50'])} {format_ms(latency['all']['p95'])} {format_ms(latency['all']['p99'])} "
+        f"{format_ms(latency['send']['p50']):>9} {format_ms(latency['send']['p95']):>9} {format_ms(latency['send']['p99']):>9}"
+    )
+    for error in result["error_samples"]:
+        print(f"       ошибка: {error[:120]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест страниц чата")
+    parser.add_argument("--users", default="1,5,10,25", help="ступени числа пользователей через запятую")
+    parser.add_argument("--pages", default="new_chat,app,simple_chat",
+                        help="страницы, между которыми распределяются пользователи")
+    parser.add_argument("--messages", type=int, default=3, help="сообщений на пользователя")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="пауза пользователя перед сообщением")
+    parser.add_argument("--timeout", type=float, default=120.0, help="предел одного перезапуска, с")
+    parser.add_argument("--backend", choices=["local", "secrets"], default="local")
+    parser.add_argument("--history", type=int, default=20, help="сообщений в каждой сессии набора данных")
+    parser.add_argument("--sessions", type=int, default=2, help="сессий на помощника в наборе данных")
+    parser.add_argument("--flowise-url", default=None, help="внешний сервер вместо встроенного")
+    parser.add_argument("--latency-ms", type=float, default=500.0)
+    parser.add_argument("--jitter-ms", type=float, default=100.0)
+    parser.add_argument("--token-delay-ms", type=float, default=20.0)
+    parser.add_argument("--tokens", type=int, default=80)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    steps = [int(value) for value in args.users.split(",") if value.strip()]
+    pages = [page.strip() for page in args.pages.split(",") if page.strip()]
+    unknown = [page for page in pages if page not in PAGES]
+    if unknown:
+        parser.error(f"неизвестные страницы: {', '.join(unknown)}")
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    share_server_objects()
+    isolate_pages()
+    os.chdir(ROOT)
+
+    server = None
+    base_url = args.flowise_url
+    if not base_url:
+        server, base_url = start_server(FakeFlowiseConfig(
+            args.latency_ms, args.jitter_ms, args.token_delay_ms, args.tokens,
+            args.streaming, args.error_rate, args.seed
+        ))
+
+    if args.backend == "local":
+        DatabaseManager._instance = DatabaseManager(config={"database": {"backend": "local"}})
+        database_secrets = {"backend": "local"}
+    else:
+        DatabaseManager._instance = DatabaseManager()
+        database_secrets = dict(st.secrets.get("database", {}))
+
+    # AppTest подменяет глобальный st.secrets на время каждого запуска и
+    # восстанавливает его после; из параллельных потоков это гонка,
+    # поэтому одинаковые для всех сессий настройки задаются один раз здесь
+    secrets = Secrets()
+    secrets._secrets = {
+        "flowise": {"base_url": base_url, "simple_chat_id": SIMPLE_CHAT_FLOW, "search_chat_id": SEARCH_CHAT_FLOW},
+        "database": database_secrets,
+    }
+    st.secrets = secrets
+
+    started = time.perf_counter()
+    users = dataset.generate(DatabaseManager._instance, users=max(steps), sessions=args.sessions,
+                             messages=args.history, seed=args.seed)
+    print(f"Набор данных: {len(users)} пользователей за {time.perf_counter() - started:.1f} с; "
+          f"Flowise: {base_url}; страницы: {', '.join(pages)}")
+
+    print_header()
+    results = []
+    for count in steps:
+        result = run_step(users[:count], pages, args.messages, args.think_ms, args.timeout)
+        results.append(result)
+        print_step(result)
+
+    if args.json_path:
+        report = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": DatabaseManager._instance.backend,
+            "config": {key: value for key, value in vars(args).items() if key != "json_path"},
+            "flowise_requests": server.RequestHandlerClass.config.requests if server else None,
+            "steps": results,
+        }
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if server:
+        server.shutdown()
+    return 1 if any(result["errors"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""Нагрузочный замер поиска по истории чатов.
+
+Заполняет отдельную базу MongoDB синтетическими сообщениями одного
+пользователя (по умолчанию 1 000 000), строит тот же текстовый индекс,
+что и приложение, и замеряет DatabaseManager.search_sessions на наборе
+запросов с редкими и частыми словами. Нужен работающий MongoDB.
+
+Запуск из корня репозитория:
+    python benchmarks/search_bench.py --mongo-uri mongodb://localhost:27017
+    python benchmarks/search_bench.py --messages 100000 --reuse --json search.json
+
+Скрипт завершается с кодом 1, если p95 превышает --target-ms.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+
+from utils.database.database_manager import DatabaseManager
+
+USERNAME = "search_bench_user"
+SESSIONS = 2000
+BATCH_SIZE = 10000
+
+_SYLLABLES = ["ка", "ро", "ми", "на", "то", "ле", "вы", "ст", "пр", "ин", "да", "ко", "ре", "зо", "ли"]
+
+
+def make_vocabulary(size, seed):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 5))))
+    return sorted(words)
+
+
+def seed_messages(database, total, vocabulary, seed):
+    """Синтетические сообщения: слова распределены по закону Ципфа"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    start = datetime.now() - timedelta(days=365)
+
+    database.chat_search.drop()
+    database.chat_sessions.drop()
+    database.chat_sessions.insert_many([
+        {"username": USERNAME, "flow_id": f"flow-{i % 20}", "session_id": f"session-{i}", "name": f"Сессия {i}"}
+        for i in range(SESSIONS)
+    ])
+
+    inserted = 0
+    while inserted < total:
+        batch = []
+        for i in range(min(BATCH_SIZE, total - inserted)):
+            number = inserted + i
+            session = number % SESSIONS
+            batch.append({
+                "username": USERNAME,
+                "flow_id": f"flow-{session % 20}",
+                "session_id": f"session-{session}",
+                "role": "user" if number % 2 == 0 else "assistant",
+                "content": " ".join(rng.choices(vocabulary, weights, k=rng.randint(8, 60))),
+                "timestamp": (start + timedelta(seconds=number * 30)).isoformat()
+            })
+        database.chat_search.insert_many(batch, ordered=False)
+        inserted += len(batch)
+        print(f"\rЗаписано сообщений: {inserted}/{total}", end="", flush=True)
+    print()
+
+    database.chat_search.create_index(
+        [("username", 1), ("content", "text")],
+        name="username_1_content_text",
+        default_language="russian"
+    )
+
+
+def make_queries(vocabulary, count, seed):
+    """Запросы из частых, средних и редких слов, одно- и двухсловные"""
+    rng = random.Random(seed + 1)
+    buckets = [vocabulary[:20], vocabulary[20:500], vocabulary[500:]]
+    queries = []
+    for i in range(count):
+        words = [rng.choice(buckets[i % 3])]
+        if i % 2:
+            words.append(rng.choice(buckets[(i + 1) % 3]))
+        queries.append(" ".join(words))
+    return queries
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер поиска по истории чатов")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="search_benchmark")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--target-ms", type=float, default=100.0)
+    parser.add_argument("--reuse", action="store_true",
+                        help="не заполнять базу заново, если сообщений уже достаточно")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    database = client[args.database]
+    vocabulary = make_vocabulary(args.vocabulary, args.seed)
+
+    if not (args.reuse and database.chat_search.estimated_document_count() >= args.messages):
+        seed_messages(database, args.messages, vocabulary, args.seed)
+
+    # Менеджер без Redis: поиску нужны только коллекции MongoDB
+    manager = DatabaseManager.__new__(DatabaseManager)
+    manager.chat_search = database.chat_search
+    manager.chat_sessions = database.chat_sessions
+
+    queries = make_queries(vocabulary, args.queries, args.seed)
+    for query in queries[:10]:
+        manager.search_sessions(USERNAME, query)  # прогрев
+
+    latencies = []
+    found = 0
+    for query in queries:
+        started = time.perf_counter()
+        results = manager.search_sessions(USERNAME, query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found += bool(results)
+
+    report = {
+        "messages": database.chat_search.estimated_document_count(),
+        "queries": len(queries),
+        "queries_with_results": found,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(max(latencies), 2),
+        "target_ms": args.target_ms,
+    }
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    return 0 if report["p95_ms"] <= args.target_ms else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
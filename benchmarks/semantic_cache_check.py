@@ -0,0 +1,50 @@
+"""Проверка кэша близких вопросов на парах вопросов.
+
+В кэш записывается ответ на первый вопрос пары, затем ищется второй:
+перефразированный вопрос должен получить ответ из кэша, вопрос с
+противоположным смыслом (другое действие, период, число, отрицание) — нет.
+Печатает косинус и результат для каждой пары.
+
+Запуск из корня репозитория:
+    python benchmarks/semantic_cache_check.py
+
+Скрипт завершается с кодом 1, если хотя бы одна пара дала неверный результат.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.semantic_cache import DEFAULT_THRESHOLD, SemanticCache, vectorize
+
+# (вопрос в кэше, новый вопрос, должен ли найтись ответ)
+PAIRS = [
+    ("Подскажите, как включить двухфакторную аутентификацию в аккаунте?",
+     "Подскажите, как отключить двухфакторную аутентификацию в аккаунте?", False),
+    ("What is the price of the monthly subscription plan?",
+     "What is the price of the yearly subscription plan?", False),
+    ("Как удалить аккаунт?", "Как не удалять аккаунт?", False),
+    ("Сколько стоит тариф на 2 месяца?", "Сколько стоит тариф на 3 месяца?", False),
+    ("сколько стоит подписка", "какова цена подписки", True),
+    ("Как сменить пароль от аккаунта?", "как сменить пароль аккаунта", True),
+    ("How much does the subscription cost?", "What is the price of the subscription?", True),
+]
+
+
+def main():
+    failures = 0
+    for cached, question, expected in PAIRS:
+        cache = SemanticCache(threshold=DEFAULT_THRESHOLD)
+        cache.add("flow", cached, "ответ")
+        found = cache.lookup("flow", question) is not None
+        similarity = float(vectorize(cached) @ vectorize(question))
+        ok = found == expected
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {similarity:.3f} {'попадание' if found else 'промах':10} "
+              f"{cached!r} -> {question!r}")
+    print(f"Неверных результатов: {failures} из {len(PAIRS)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
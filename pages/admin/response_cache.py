@@ -0,0 +1,62 @@
+import streamlit as st
+from utils.page_config import setup_pages
+from utils.database.database_manager import get_database
+from utils import response_cache
+
+# Настраиваем страницы
+setup_pages()
+
+# Получаем экземпляр базы данных
+db = get_database()
+
+# Проверка прав администратора
+if not st.session_state.get("is_admin", False):
+    st.error("Доступ запрещен. Страница доступна только администраторам.")
+    st.stop()
+
+# Дополнительная проверка имени пользователя и пароля администратора
+if "admin_verified" not in st.session_state:
+    admin_username = st.text_input("Введите имя пользователя администратора")
+    admin_password = st.text_input("Введите пароль администратора", type="password")
+
+    if admin_username != st.secrets["admin"]["admin_username"] or admin_password != st.secrets["admin"]["admin_password"]:
+        st.error("Неверное имя пользователя или пароль администратора")
+        st.stop()
+
+    st.session_state.admin_verified = True
+
+st.title("Кэш ответов (Админ панель)")
+
+if response_cache.is_enabled():
+    st.info("Кэш ответов включен")
+else:
+    st.warning("Кэш ответов выключен ([response_cache] enabled в secrets.toml)")
+if response_cache.is_semantic_enabled():
+    st.info("Кэш близких вопросов включен (хранится в памяти каждого процесса)")
+
+simple_chat_id = st.secrets.get("flowise", {}).get("simple_chat_id")
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    st.metric("Ответов в кэше", response_cache.count(db))
+with col2:
+    if simple_chat_id:
+        st.metric("Бесплатный чат", response_cache.count(db, simple_chat_id))
+with col3:
+    if response_cache.is_semantic_enabled():
+        st.metric("Близких вопросов (этот процесс)", response_cache.get_semantic_cache().size())
+
+st.markdown("---")
+
+# Очистка кэша
+st.subheader("Очистка")
+with st.form("purge_response_cache"):
+    flow_id = st.text_input("ID чат-потока (пусто — все потоки)", value=simple_chat_id or "")
+    purge_submit = st.form_submit_button("Очистить кэш")
+
+if purge_submit:
+    try:
+        deleted = response_cache.purge(db, flow_id.strip() or None)
+        st.success(f"Удалено ответов: {deleted}")
+    except Exception as e:
+        st.error(f"Ошибка при очистке кэша: {str(e)}")
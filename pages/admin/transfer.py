@@ -0,0 +1,79 @@
+import streamlit as st
+import tempfile
+from utils.page_config import setup_pages
+from utils.database.database_manager import get_database
+from utils.database.transfer import (
+    EXPORT_LINK_TTL, create_export_link, export_link_url, iter_records, write_records, read_records, import_records
+)
+
+# Настраиваем страницы
+setup_pages()
+
+# Получаем экземпляр базы данных
+db = get_database()
+
+# Проверка прав администратора
+if not st.session_state.get("is_admin", False):
+    st.error("Доступ запрещен. Страница доступна только администраторам.")
+    st.stop()
+
+# Дополнительная проверка имени пользователя и пароля администратора
+if "admin_verified" not in st.session_state:
+    admin_username = st.text_input("Введите имя пользователя администратора")
+    admin_password = st.text_input("Введите пароль администратора", type="password")
+
+    if admin_username != st.secrets["admin"]["admin_username"] or admin_password != st.secrets["admin"]["admin_password"]:
+        st.error("Неверное имя пользователя или пароль администратора")
+        st.stop()
+
+    st.session_state.admin_verified = True
+
+st.title("Перенос данных (Админ панель)")
+
+# Экспорт аккаунта
+st.subheader("Экспорт пользователя")
+with st.form("export_user"):
+    export_username = st.text_input("Имя пользователя")
+    include_account = st.checkbox("Включить учетную запись (пароль, ключ, помощники)", value=True)
+    export_submit = st.form_submit_button("Подготовить файл")
+
+if export_submit and export_username:
+    if not db.get_user(export_username):
+        st.error("Пользователь не найден")
+    else:
+        link = export_link_url(create_export_link(db, export_username, include_account=include_account))
+        if link:
+            # API отдает файл потоком по мере чтения из MongoDB
+            st.link_button("💾 Скачать", link)
+            st.caption(f"Ссылка одноразовая и действует {EXPORT_LINK_TTL // 60} мин.")
+        else:
+            # Без опубликованного API (секция [api], public_url) кнопка
+            # скачивания получает файл целиком; большие аккаунты переносите
+            # командой python -m utils.database.transfer
+            with st.spinner("Выгрузка истории..."), tempfile.TemporaryFile() as export_file:
+                count = write_records(iter_records(db, export_username, include_account=include_account), export_file)
+                export_file.seek(0)
+                st.success(f"Записей выгружено: {count}")
+                st.download_button(
+                    "💾 Скачать",
+                    data=export_file.read(),
+                    file_name=f"{export_username}.ndjson.gz",
+                    mime="application/gzip"
+                )
+
+st.markdown("---")
+
+# Импорт файла экспорта
+st.subheader("Импорт")
+uploaded_file = st.file_uploader("Файл экспорта (.ndjson.gz)", type=["gz"])
+if uploaded_file and st.button("Импортировать"):
+    try:
+        with st.spinner("Загрузка истории..."):
+            stats = import_records(db, read_records(uploaded_file))
+        st.success(
+            f"Пользователей: {stats['users']}, сессий: {stats['sessions']}, "
+            f"историй: {stats['histories']}, сегментов архива: {stats['archive_segments']}, "
+            f"сообщений: {stats['messages']}"
+        )
+    except Exception as e:
+        st.error(f"Ошибка при импорте: {str(e)}")
@@ -1,19 +1,14 @@
 import streamlit as st
-import requests
-import json
-import os
-from PIL import Image
 import hashlib
-import base64
-import mimetypes
 from datetime import datetime
-from googletrans import Translator
 from utils.page_config import setup_pages, PAGE_CONFIG, check_token_access
-import time
 from utils.translation import translate_text, display_message_with_translation
-from flowise import Flowise, PredictionData
 import uuid
 from utils.database.database_manager import get_database
+from utils import attachments, flowise_client, chat_service
+from utils.log import get_logger
+
+log = get_logger("pages.app")
 
 def save_session_history(username: str, flow_id: str, session_id: str, messages: list, display_name: str = None):
     """Сохраняет историю сессии в MongoDB"""
@@ -55,15 +50,7 @@ def save_session_history(username: str, flow_id: str, session_id: str, messages:
 
 def get_available_sessions(username: str, flow_id: str) -> list:
     """Получение доступных сессий чата"""
-    sessions = list(db.chat_sessions.find({
-        "username": username,
-        "flow_id": flow_id
-    }).sort("created_at", 1))
-    
-    return [{
-        'id': session['session_id'],
-        'display_name': session.get('name', f"Сессия {session['session_id'][:8]}")
-    } for session in sessions]
+    return db.get_available_sessions(username, flow_id)
 
 def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
     """Переименование сессии чата"""
@@ -94,6 +81,7 @@ def delete_session(username: str, flow_id: str, session_id: str):
         "flow_id": flow_id,
         "session_id": session_id
     })
+    db.forget_history(username, flow_id, session_id)
 
 def clear_session_history(username: str, flow_id: str, session_id: str):
     """Очистка истории сессии"""
@@ -106,10 +94,42 @@ def clear_session_history(username: str, flow_id: str, session_id: str):
         {
             "$set": {
                 "messages": [],
+                "archived_segments": 0,
+                "archived_messages": 0,
                 "updated_at": datetime.now()
             }
         }
     )
+    db.forget_history(username, flow_id, session_id)
+    st.session_state.pop(f"archived_history_{flow_id}_{session_id}", None)
+
+def load_archived_history(username: str, flow_id: str, session_id: str) -> list:
+    """Более ранние сообщения из архива, загруженные пользователем по кнопке"""
+    state_key = f"archived_history_{flow_id}_{session_id}"
+    if state_key not in st.session_state:
+        st.session_state[state_key] = {
+            "next_segment": db.get_archived_segment_count(username, flow_id, session_id) - 1,
+            "messages": []
+        }
+    loaded = st.session_state[state_key]
+    
+    if loaded["next_segment"] >= 0:
+        if st.button("⬆️ Показать более ранние сообщения", key=f"load_archive_{session_id}"):
+            older_messages = db.load_archived_segment(username, flow_id, session_id, loaded["next_segment"])
+            loaded["messages"] = older_messages + loaded["messages"]
+            loaded["next_segment"] -= 1
+    
+    return loaded["messages"]
+
+def delete_message(username: str, flow_id: str, session_id: str, message_id: str):
+    """Удаление одного сообщения из истории сессии"""
+    if not db.delete_message(username, flow_id, session_id, message_id):
+        st.error("Не удалось удалить сообщение")
+        return
+    # Убираем сообщение и из уже загруженной части архива
+    loaded = st.session_state.get(f"archived_history_{flow_id}_{session_id}")
+    if loaded:
+        loaded["messages"] = [m for m in loaded["messages"] if m.get("message_id") != message_id]
 
 def get_message_hash(role, content):
     """Создание хэша сообщения"""
@@ -124,7 +144,11 @@ def get_user_profile_image(username):
 
 def display_message(message, role):
     """Отображение сообщения в чате"""
-    display_message_with_translation(message, role)
+    avatar = "🤖" if role == "assistant" else get_user_profile_image(st.session_state.username)
+    message_id = message.get("message_id") or get_message_hash(role, message["content"])
+    if display_message_with_translation(message, message_id, avatar, role):
+        delete_message(st.session_state.username, "search", st.session_state.current_session, message_id)
+        st.rerun()
 
 def save_chat_flow(username, flow_id, flow_name=None):
     """Сохранение потока чата"""
@@ -146,21 +170,21 @@ def get_user_chat_flows(username):
     """Получение потоков чата пользователя"""
     return db.chat_sessions.find({"username": username})
 
-def generate_response(prompt: str, chat_id: str, session_id: str, uploaded_files=None):
+def generate_response(prompt: str, chat_id: str, session_id: str, files=None, cancel=None):
     """Генерация ответа от модели"""
     try:
-        prediction_data = PredictionData(
-            question=prompt,
-            chat_id=chat_id,
-            session_id=session_id,
-            files=uploaded_files
-        )
-        flowise = Flowise()
-        response = flowise.predict(prediction_data)
-        return response["text"] if response and "text" in response else "Извините, произошла ошибка при генерации ответа."
+        # Кэш ответов здесь не используется: у поискового чата есть память
+        # сессии, и ответ зависит от предыдущих вопросов пользователя
+        response = flowise_client.predict(chat_id, prompt, session_id=session_id, attachments=files, cancel=cancel)
+        if not response:
+            raise chat_service.ChatError("Извините, произошла ошибка при генерации ответа.", status=502)
+        return response
+    except (flowise_client.FlowiseError, chat_service.ChatError):
+        # Показывается на странице, вопрос без ответа не сохраняется
+        raise
     except Exception as e:
-        print(f"Ошибка при генерации ответа: {str(e)}")
-        return "Произошла ошибка при обработке запроса."
+        log.error(f"Ошибка при генерации ответа: {str(e)}", extra={"flow": chat_id, "session": session_id})
+        raise chat_service.ChatError("Произошла ошибка при обработке запроса.", status=502)
 
 def submit_message(user_input, uploaded_files=None):
     """Обработка отправки сообщения"""
@@ -175,49 +199,45 @@ def submit_message(user_input, uploaded_files=None):
         st.error("Ошибка: сессия не выбрана")
         return
 
-    messages = db.get_chat_history(st.session_state["username"], current_flow, current_session)
-    user_message = {
-        "role": "user",
-        "content": user_input,
-        "timestamp": datetime.now().isoformat(),
-        "message_id": get_message_hash("user", user_input)
-    }
-    messages.append(user_message)
-    db.save_chat_history(st.session_state["username"], current_flow, current_session, messages)
-    
-    files_data = []
-    if uploaded_files:
-        for file in uploaded_files:
-            file_content = file.read()
-            mime_type = mimetypes.guess_type(file.name)[0]
-            if mime_type and mime_type.startswith('image/'):
-                files_data.append({
-                    "name": file.name,
-                    "type": mime_type,
-                    "content": encode_file_to_base64(file_content)
-                })
+    # Файлы читаются частями, изображения уменьшаются, повторы отбрасываются
+    try:
+        files = attachments.prepare_attachments(uploaded_files)
+    except attachments.AttachmentError as e:
+        st.error(str(e))
+        return
     
-    assistant_response = generate_response(user_input, current_flow, current_session, files_data if files_data else None)
-    assistant_message = {
-        "role": "assistant",
-        "content": assistant_response,
-        "timestamp": datetime.now().isoformat(),
-        "message_id": get_message_hash("assistant", assistant_response)
-    }
-    messages.append(assistant_message)
-    db.save_chat_history(st.session_state["username"], current_flow, current_session, messages)
-    db.chat_sessions.update_one(
-        {
-            "username": st.session_state["username"],
-            "flow_id": current_flow,
-            "session_id": current_session
-        },
-        {"$set": {"updated_at": datetime.now()}}
+    search_chat_id = st.secrets["flowise"]["search_chat_id"]
+    # Повторная отправка того же вопроса во время ожидания присоединяется
+    # к выполняющемуся обмену (генерации в поиске не списываются, см.
+    # chat_service.is_charged)
+    exchange, _ = chat_service.submit_exchange(
+        db, st.session_state["username"], current_flow, current_session, user_input,
+        lambda cancel: generate_response(user_input, search_chat_id, current_session, files, cancel),
+        attachments=[file.digest.encode("ascii") for file in files]
     )
+    st.session_state.pending_exchange = exchange
 
-def encode_file_to_base64(file_content: bytes) -> str:
-    """Кодирование файла в base64"""
-    return base64.b64encode(file_content).decode('utf-8')
+def wait_for_response():
+    """Ожидание ответа; нажатие "Отменить" прерывает его и отменяет запрос"""
+    try:
+        chat_service.wait_for_generation(st.session_state.pending_exchange, st.empty())
+    except chat_service.GenerationCancelled:
+        st.info("Запрос отменен")
+    except flowise_client.FlowiseError as e:
+        st.error(flowise_client.describe_error(e))
+    except chat_service.ChatError as e:
+        st.error(str(e))
+    else:
+        st.session_state.pending_exchange = None
+        st.rerun()
+    st.session_state.pending_exchange = None
+    st.stop()
+
+def cancel_request():
+    """Очистка поля ввода и отмена ожидаемого ответа"""
+    st.session_state.message_input = ''
+    if chat_service.cancel_generation(st.session_state.pop("pending_exchange", None)):
+        st.toast("Запрос отменен")
 
 # Получаем экземпляр менеджера базы данных
 db = get_database()
@@ -262,6 +282,19 @@ if user_data:
 # Управление сессиями в боковой панели
 st.sidebar.title("Управление сессиями")
 
+# Поиск по истории сессий
+search_query = st.sidebar.text_input("🔎 Поиск по сессиям", key="session_search")
+if search_query:
+    search_results = db.search_sessions(st.session_state.username, search_query, flow_id="search")
+    if not search_results:
+        st.sidebar.caption("Ничего не найдено")
+    for result in search_results:
+        st.sidebar.markdown(f"**{result['name']}**  \n{result['snippet']}")
+        if st.sidebar.button("Открыть", key=f"search_open_{result['session_id']}", use_container_width=True):
+            st.session_state.current_session = result["session_id"]
+            st.session_state.current_flow = "search"
+            st.rerun()
+
 # Получаем доступные сессии
 available_sessions = get_available_sessions(st.session_state.username, "search")
 
@@ -361,8 +394,13 @@ if "current_session" in st.session_state:
         "search",
         st.session_state.current_session
     )
+    archived_messages = load_archived_history(
+        st.session_state.username,
+        "search",
+        st.session_state.current_session
+    )
     
-    for message in messages:
+    for message in archived_messages + messages:
         display_message(message, message["role"])
 
 # Поле ввода сообщения
@@ -379,7 +417,10 @@ with col1:
 with col2:
     clear_button = st.button("Очистить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True)
 with col3:
-    cancel_button = st.button("Отменить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True)
+    cancel_button = st.button("Отменить", on_click=cancel_request, use_container_width=True)
 
 if send_button and user_input and user_input.strip():
     submit_message(user_input)
+
+if st.session_state.get("pending_exchange") is not None:
+    wait_for_response()
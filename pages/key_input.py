@@ -5,6 +5,9 @@ from utils.database.database_manager import get_database
 import os
 import json
 from datetime import datetime
+from utils.log import get_logger
+
+log = get_logger("pages.key_input")
 
 # Получаем экземпляр базы данных
 db = get_database()
@@ -84,10 +87,11 @@ def verify_token(token: str, username: str) -> tuple[bool, str]:
                 }
             }
         )
+        db.invalidate_user(username)
         
         return True, "Токен успешно активирован"
     except Exception as e:
-        print(f"Ошибка при активации токена: {e}")
+        log.error(f"Ошибка при активации токена: {e}", extra={"user": username})
         return False, "Ошибка при активации токена"
 
 # Проверка токена
@@ -1,73 +1,44 @@
 import streamlit as st
-import requests
-import json
 import os
-from PIL import Image
 import hashlib
+import tempfile
 from utils.utils import verify_user_access, update_remaining_generations, get_data_file_path
-from utils.chat_database import ChatDatabase
-from tinydb import TinyDB, Query
-from googletrans import Translator
 from datetime import datetime
 from utils.page_config import setup_pages, PAGE_CONFIG, check_token_access
 import time
-from utils.translation import translate_text, display_message_with_translation
-from flowise import Flowise, PredictionData
+from utils.translation import (
+    display_message_with_translation, is_auto_translate_enabled, is_translation_pending, submit_reply_translation
+)
 import uuid
-from langdetect import detect
 from utils.database.database_manager import get_database
+from utils.database.transfer import create_export_link, export_link_url, iter_records, write_records
+from utils import attachments, documents, flowise_client, chat_service
+from utils.log import get_logger
+
+log = get_logger("pages.new_chat")
 
-def generate_response(prompt: str, chat_id: str, session_id: str):
+def generate_response(prompt: str, chat_id: str, session_id: str, files=None, cancel=None):
     try:
-        # Создаем клиент Flowise, если он еще не создан
-        if not hasattr(st.session_state, 'flowise_client'):
-            base_url = st.secrets["flowise"]["base_url"].replace('/api/v1/prediction', '')
-            st.session_state.flowise_client = Flowise(base_url=base_url)
+        # Отправляем запрос к API (cancel прерывает ожидание ответа)
+        text_response = flowise_client.predict(chat_id, prompt, session_id=session_id, attachments=files, cancel=cancel)
         
-        try:
-            # Отправляем запрос к API
-            prediction_data = PredictionData(
-                question=prompt,
-                chatId=chat_id,
-                sessionId=session_id,
-                overrideConfig={}
+        if not text_response:
+            raise chat_service.ChatError(
+                "Не удалось получить ответ в ожидаемом формате. Пожалуйста, попробуйте еще раз.", status=502
             )
-            
-            response = st.session_state.flowise_client.predict(
-                chat_id,
-                prediction_data
-            )
-            
-            if isinstance(response, dict):
-                text_response = response.get('text', '')
-            else:
-                text_response = str(response)
-            
-            if text_response:
-                try:
-                    detected_lang = detect(text_response)
-                    if detected_lang == 'en':
-                        translator = Translator()
-                        translated = translator.translate(text_response, dest='ru')
-                        if translated and translated.text:
-                            return translated.text
-                        else:
-                            return text_response
-                    else:
-                        return text_response
-                except Exception as e:
-                    print(f"Ошибка при переводе: {str(e)}")
-                    return text_response
-            
-            return "Не удалось получить ответ в ожидаемом формате. Пожалуйста, попробуйте еще раз."
-                    
-        except Exception as e:
-            if "Unknown model" in str(e):
-                return "Ошибка конфигурации модели. Пожалуйста, проверьте настройки чата."
-            return f"Ошибка при получении ответа: {str(e)}"
-            
+        # Перевод английского ответа выполняется отдельно, в фоне
+        # (submit_reply_translation), чтобы не задерживать ответ
+        return text_response
+                
+    except (flowise_client.FlowiseError, chat_service.ChatError):
+        # Ошибки показываются на странице; текст ошибки не сохраняется как
+        # ответ, зарезервированная генерация возвращается
+        raise
     except Exception as e:
-        return f"Произошла ошибка: {str(e)}"
+        log.error(f"Ошибка при получении ответа: {str(e)}", extra={"flow": chat_id, "session": session_id})
+        if "Unknown model" in str(e):
+            raise chat_service.ChatError("Ошибка конфигурации модели. Пожалуйста, проверьте настройки чата.", status=502)
+        raise chat_service.ChatError(f"Ошибка при получении ответа: {str(e)}", status=502)
 
 # Получаем экземпляр базы данных
 db = get_database()
@@ -94,12 +65,6 @@ if "flowise" not in st.secrets or "base_url" not in st.secrets["flowise"]:
     st.error("Ошибка: URL Flowise API не настроен в secrets.toml")
     st.stop()
 
-# Получаем базовый URL и очищаем его от /api/v1/prediction
-base_url = st.secrets["flowise"]["base_url"].replace('/api/v1/prediction', '')
-
-# Создаем клиент Flowise
-flowise_client = Flowise(base_url=base_url)
-
 # Инициализируем уникальный идентификатор сессии для пользователя
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
@@ -164,47 +129,11 @@ def save_session_history(username: str, flow_id: str, session_id: str, messages:
 
 def load_session_history(username: str, flow_id: str, session_id: str) -> list:
     """Загружает историю сессии из MongoDB"""
-    history = db.chat_history.find_one({
-        "username": username,
-        "flow_id": flow_id,
-        "session_id": session_id
-    })
-    return history.get("messages", []) if history else []
+    return db.get_chat_history(username, flow_id, session_id)
 
 def get_available_sessions(username: str, flow_id: str) -> list:
     """Получает список доступных сессий для чата"""
-    # Сначала получаем основную сессию
-    primary_session = db.chat_sessions.find_one({
-        "username": username,
-        "flow_id": flow_id,
-        "is_primary": True
-    })
-    
-    # Затем получаем все остальные сессии
-    other_sessions = list(db.chat_sessions.find({
-        "username": username,
-        "flow_id": flow_id,
-        "is_primary": {"$ne": True}
-    }).sort("created_at", 1))
-    
-    sessions = []
-    
-    # Добавляем основную сессию первой
-    if primary_session:
-        sessions.append({
-            'id': primary_session['session_id'],
-            'display_name': primary_session.get('name', "Основная сессия"),
-            'is_primary': True
-        })
-    
-    # Добавляем остальные сессии
-    sessions.extend([{
-        'id': session['session_id'],
-        'display_name': session.get('name', f"Сессия {session['session_id'][:8]}"),
-        'is_primary': False
-    } for session in other_sessions])
-    
-    return sessions
+    return db.get_available_sessions(username, flow_id)
 
 def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
     """Переименовывает сессию"""
@@ -256,6 +185,7 @@ def delete_session(username: str, flow_id: str, session_id: str):
             "flow_id": flow_id,
             "session_id": session_id
         })
+        db.forget_history(username, flow_id, session_id)
         
         # Если удалена текущая сессия, переключаемся на основную сессию
         if ('current_chat_flow' in st.session_state and 
@@ -291,10 +221,14 @@ def clear_session_history(username: str, flow_id: str, session_id: str):
             {
                 "$set": {
                     "messages": [],
+                    "archived_segments": 0,
+                    "archived_messages": 0,
                     "updated_at": datetime.now()
                 }
             }
         )
+        db.forget_history(username, flow_id, session_id)
+        st.session_state.pop(f"archived_history_{flow_id}_{session_id}", None)
         
         # Очищаем состояние сообщений в текущей сессии
         st.session_state.messages = []
@@ -302,6 +236,34 @@ def clear_session_history(username: str, flow_id: str, session_id: str):
     except Exception as e:
         st.error(f"Ошибка при очистке истории: {e}")
 
+def load_archived_history(username: str, flow_id: str, session_id: str) -> list:
+    """Более ранние сообщения из архива, загруженные пользователем по кнопке"""
+    state_key = f"archived_history_{flow_id}_{session_id}"
+    if state_key not in st.session_state:
+        st.session_state[state_key] = {
+            "next_segment": db.get_archived_segment_count(username, flow_id, session_id) - 1,
+            "messages": []
+        }
+    loaded = st.session_state[state_key]
+    
+    if loaded["next_segment"] >= 0:
+        if st.button("⬆️ Показать более ранние сообщения", key=f"load_archive_{session_id}"):
+            older_messages = db.load_archived_segment(username, flow_id, session_id, loaded["next_segment"])
+            loaded["messages"] = older_messages + loaded["messages"]
+            loaded["next_segment"] -= 1
+    
+    return loaded["messages"]
+
+def delete_message(username: str, flow_id: str, session_id: str, message_id: str):
+    """Удаление одного сообщения из истории сессии"""
+    if not db.delete_message(username, flow_id, session_id, message_id):
+        st.error("Не удалось удалить сообщение")
+        return
+    # Убираем сообщение и из уже загруженной части архива
+    loaded = st.session_state.get(f"archived_history_{flow_id}_{session_id}")
+    if loaded:
+        loaded["messages"] = [m for m in loaded["messages"] if m.get("message_id") != message_id]
+
 def get_message_hash(role, content):
     """Создает уникальный хэш для сообщения"""
     return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
@@ -311,6 +273,7 @@ def get_user_profile_image(username):
     user_data = db.get_user(username)
     if user_data and user_data.get('profile_image'):
         try:
+            from PIL import Image
             return Image.open(user_data['profile_image'])
         except Exception:
             return "👤"
@@ -319,8 +282,34 @@ def get_user_profile_image(username):
 def display_message(message, role):
     """Отображает сообщение"""
     avatar = "🤖" if role == "assistant" else get_user_profile_image(st.session_state.username)
-    with st.chat_message(role, avatar=avatar):
-        st.markdown(message["content"])
+    message_id = message.get("message_id") or get_message_hash(role, message["content"])
+    if display_message_with_translation(message, message_id, avatar, role):
+        delete_message(
+            st.session_state.username,
+            st.session_state.current_chat_flow['id'],
+            st.session_state.current_chat_flow['current_session'],
+            message_id
+        )
+        st.rerun()
+
+def cancel_request():
+    """Очистка поля ввода и отмена ожидаемого ответа"""
+    st.session_state.message_input = ''
+    pending = st.session_state.pop("pending_exchange", None)
+    if pending and chat_service.cancel_generation(pending["exchange"]):
+        st.toast("Запрос отменен, генерация возвращена")
+
+@st.fragment(run_every=2)
+def watch_translations():
+    """Ожидание фоновых переводов: страница перерисовывается, когда перевод готов"""
+    pending = [
+        message_id for message_id in st.session_state.get("pending_translations", [])
+        if is_translation_pending(message_id)
+    ]
+    if len(pending) != len(st.session_state.pending_translations):
+        st.session_state.pending_translations = pending
+        st.rerun()
+    st.caption("⏳ Перевод ответа готовится...")
 
 def save_chat_flow(username, flow_id, flow_name=None):
     """Сохранение нового чат-потока"""
@@ -369,11 +358,12 @@ def save_chat_flow(username, flow_id, flow_name=None):
                 }
             }
         )
+        db.invalidate_user(username)
         
         return result.matched_count > 0
         
     except Exception as e:
-        print(f"Ошибка при создании помощника: {str(e)}")
+        log.error(f"Ошибка при создании помощника: {str(e)}", extra={"user": username})
         return False
 
 def get_user_chat_flows(username):
@@ -408,26 +398,34 @@ def get_user_chat_flows(username):
         return chat_flows
         
     except Exception as e:
-        print(f"Ошибка при получении списка помощников: {str(e)}")
+        log.error(f"Ошибка при получении списка помощников: {str(e)}", extra={"user": username})
         return []
 
+def open_search_result(flow, session_id):
+    """Переход к сессии из результатов поиска (выполняется до перезапуска скрипта)"""
+    flow = dict(flow, current_session=session_id)
+    st.session_state.current_chat_flow = flow
+    st.session_state.flow_selector = f"{flow.get('name', 'Без имени')} ({flow['id']})"
+
 def delete_chat_flow(username, flow_id):
     """Удаление чат-потока и всех связанных данных"""
     try:
         # Удаляем все сессии и историю чатов
         db.chat_sessions.delete_many({"username": username, "flow_id": flow_id})
         db.chat_history.delete_many({"username": username, "flow_id": flow_id})
+        db.forget_history(username, flow_id)
         
         # Удаляем помощника из списка у пользователя
         result = db.users.update_one(
             {"username": username},
             {"$pull": {"chat_flows": {"id": flow_id}}}
         )
+        db.invalidate_user(username)
         
         return result.modified_count > 0
         
     except Exception as e:
-        print(f"Ошибка при удалении помощника: {str(e)}")
+        log.error(f"Ошибка при удалении помощника: {str(e)}", extra={"user": username, "flow": flow_id})
         return False
 
 # Отображение оставшихся генераций
@@ -471,6 +469,28 @@ with st.sidebar:
             st.session_state.current_chat_flow.get('id') != selected_flow['id']):
             st.session_state.current_chat_flow = selected_flow
             st.rerun()
+        
+        # Поиск по всем чатам пользователя
+        with st.expander("🔎 Поиск по чатам", expanded=False):
+            search_query = st.text_input("Текст для поиска:", key="chat_search_query")
+            if search_query:
+                flows_by_id = {flow['id']: flow for flow in chat_flows}
+                search_results = [
+                    result for result in db.search_sessions(st.session_state.username, search_query)
+                    if result['flow_id'] in flows_by_id
+                ]
+                if not search_results:
+                    st.caption("Ничего не найдено")
+                for result in search_results:
+                    flow = flows_by_id[result['flow_id']]
+                    st.markdown(f"**{flow.get('name', 'Без имени')} / {result['name']}**  \n{result['snippet']}")
+                    st.button(
+                        "Открыть",
+                        key=f"search_open_{result['flow_id']}_{result['session_id']}",
+                        use_container_width=True,
+                        on_click=open_search_result,
+                        args=(flow, result['session_id'])
+                    )
     
     st.markdown("<hr style='margin: 10px 0px; border: none; height: 1px; background: rgba(250, 250, 250, 0.2);'>", unsafe_allow_html=True)
     
@@ -537,6 +557,7 @@ with st.sidebar:
                             }
                         }
                     )
+                    db.invalidate_user(st.session_state.username)
                     
                     if result.modified_count > 0:
                         st.session_state.current_chat_flow['name'] = new_name
@@ -547,6 +568,24 @@ with st.sidebar:
                 except Exception as e:
                     st.error(f"Ошибка при переименовании помощника: {str(e)}")
             
+            # Автоматический перевод английских ответов на русский
+            auto_translate = st.toggle(
+                "Переводить ответы на русский",
+                value=is_auto_translate_enabled(st.session_state.current_chat_flow),
+                help="Ответ на английском показывается сразу, перевод появляется, когда будет готов",
+                key="auto_translate_toggle"
+            )
+            if auto_translate != is_auto_translate_enabled(st.session_state.current_chat_flow):
+                db.users.update_one(
+                    {
+                        "username": st.session_state.username,
+                        "chat_flows.id": st.session_state.current_chat_flow['id']
+                    },
+                    {"$set": {"chat_flows.$.auto_translate": auto_translate}}
+                )
+                db.invalidate_user(st.session_state.username)
+                st.session_state.current_chat_flow['auto_translate'] = auto_translate
+            
             st.markdown("---")
             
             # Удаление помощника
@@ -566,13 +605,48 @@ with st.sidebar:
     
     # Загрузка файлов
     with st.expander("📎 Загрузка файлов", expanded=False):
+        # Ключ меняется после отправки, чтобы файлы не уходили повторно
         uploaded_files = st.file_uploader(
             "Загрузите файлы",
             accept_multiple_files=True,
-            type=["png", "jpg", "jpeg", "pdf", "doc", "docx", "txt"]
+            type=["png", "jpg", "jpeg", "pdf", "doc", "docx", "txt"],
+            key=f"chat_uploads_{st.session_state.get('uploads_sent', 0)}"
         )
         if uploaded_files:
             st.success(f"Загружено файлов: {len(uploaded_files)}")
+            
+            # PDF, DOCX и TXT индексируются один раз на загрузку; тот же файл
+            # повторно не разбирается (проверка по хэшу содержимого)
+            ingested = st.session_state.setdefault("ingested_uploads", set())
+            new_documents = [
+                file for file in uploaded_files
+                if documents.is_document(file) and file.file_id not in ingested
+            ]
+            if new_documents:
+                progress_bar = st.progress(0.0, text="Обработка документов...")
+                results = documents.ingest_files(
+                    st.session_state.username, new_documents,
+                    progress=lambda done, total, name: progress_bar.progress(
+                        done / total, text=f"Обработано документов: {done} из {total}"
+                    )
+                )
+                progress_bar.empty()
+                ingested.update(file.file_id for file in new_documents)
+                for result in results:
+                    if result["status"] == "indexed":
+                        st.caption(f"📄 {result['name']}: фрагментов {result['chunks']}")
+                    elif result["status"] == "duplicate":
+                        st.caption(f"📄 {result['name']}: уже в базе")
+                    else:
+                        st.warning(result["error"])
+        
+        user_documents = documents.list_documents(st.session_state.username)
+        if user_documents:
+            st.caption(f"Документов в базе: {len(user_documents)}. Помощник учитывает их в ответах.")
+            if st.button("🗑️ Удалить документы", use_container_width=True, key="delete_documents_button"):
+                documents.delete_documents(st.session_state.username)
+                st.session_state.pop("ingested_uploads", None)
+                st.rerun()
 
 # Управление текущим чатом
 if 'current_chat_flow' in st.session_state:
@@ -684,7 +758,42 @@ if 'current_chat_flow' in st.session_state:
                     st.session_state.current_chat_flow['id'],
                     current_session
                 )
-    
+
+        # Экспорт текущего чата в файл: файл собирается только по нажатию и
+        # не хранится в session_state; при опубликованном API скачивается
+        # по одноразовой ссылке потоком, без сборки в памяти
+        if current_session:
+            if st.button("📥 Экспорт", use_container_width=True, key="export_chat_button"):
+                link = export_link_url(create_export_link(
+                    db,
+                    st.session_state.username,
+                    st.session_state.current_chat_flow['id'],
+                    current_session
+                ))
+                if link:
+                    st.link_button("💾 Скачать", link, use_container_width=True)
+                else:
+                    with tempfile.TemporaryFile() as export_file:
+                        write_records(
+                            iter_records(
+                                db,
+                                st.session_state.username,
+                                st.session_state.current_chat_flow['id'],
+                                current_session,
+                                include_account=False
+                            ),
+                            export_file
+                        )
+                        export_file.seek(0)
+                        st.download_button(
+                            "💾 Скачать",
+                            data=export_file.read(),
+                            file_name=f"chat_{current_session[:8]}.ndjson.gz",
+                            mime="application/gzip",
+                            use_container_width=True,
+                            key="download_chat_button"
+                        )
+
     st.markdown("---")
     
     # Отображение истории чата
@@ -694,9 +803,17 @@ if 'current_chat_flow' in st.session_state:
             st.session_state.current_chat_flow['id'],
             st.session_state.current_chat_flow['current_session']
         )
+        archived_messages = load_archived_history(
+            st.session_state.username,
+            st.session_state.current_chat_flow['id'],
+            st.session_state.current_chat_flow['current_session']
+        )
         
-        for message in messages:
+        for message in archived_messages + messages:
             display_message(message, message["role"])
+        
+        if st.session_state.get("pending_translations"):
+            watch_translations()
     
     # Поле ввода сообщения
     user_input = st.text_area(
@@ -712,62 +829,64 @@ if 'current_chat_flow' in st.session_state:
     with col2:
         clear_button = st.button("Очистить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="clear_message_button")
     with col3:
-        cancel_button = st.button("Отменить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="cancel_message_button")
+        cancel_button = st.button("Отменить", on_click=cancel_request, use_container_width=True, key="cancel_message_button")
     
     if send_button and user_input and user_input.strip():
         # Проверяем наличие активного токена перед отправкой
         check_token_access()
 
-        # Сохраняем сообщение пользователя
-        messages = load_session_history(
-            st.session_state.username,
-            st.session_state.current_chat_flow['id'],
-            st.session_state.current_chat_flow['current_session']
-        )
-        
-        user_message = {
-            "role": "user",
-            "content": user_input,
-            "timestamp": datetime.now().isoformat()
-        }
-        messages.append(user_message)
+        flow_id = st.session_state.current_chat_flow['id']
+        session_id = st.session_state.current_chat_flow['current_session']
         
-        save_session_history(
-            st.session_state.username,
-            st.session_state.current_chat_flow['id'],
-            st.session_state.current_chat_flow['current_session'],
-            messages
-        )
-        
-        # Получаем ответ от модели
-        with st.chat_message("assistant", avatar="🤖"):
-            response = generate_response(
-                user_input,
-                st.session_state.current_chat_flow['id'],
-                st.session_state.current_chat_flow['current_session']
+        # Документы уже проиндексированы и попадают в вопрос фрагментами;
+        # остальные файлы отправляются вложениями (изображения уменьшаются)
+        try:
+            files = attachments.prepare_attachments(
+                [file for file in uploaded_files or [] if not documents.is_document(file)]
             )
-            st.write(response)
-        
-        # Сохраняем ответ ассистента
-        assistant_message = {
-            "role": "assistant",
-            "content": response,
-            "timestamp": datetime.now().isoformat()
-        }
-        messages.append(assistant_message)
-        
-        save_session_history(
-            st.session_state.username,
-            st.session_state.current_chat_flow['id'],
-            st.session_state.current_chat_flow['current_session'],
-            messages
-        )
-        
-        # Обновляем количество оставшихся генераций
-        db.users.update_one(
-            {"username": st.session_state.username},
-            {"$inc": {"remaining_generations": -1}}
+        except attachments.AttachmentError as e:
+            st.error(str(e))
+            st.stop()
+        
+        # Вопрос, ответ и списание генерации выполняются в фоновом потоке;
+        # повторное нажатие во время ожидания присоединяется к тому же обмену
+        username = st.session_state.username
+        exchange, _ = chat_service.submit_exchange(
+            db, username, flow_id, session_id, user_input,
+            lambda cancel: generate_response(
+                documents.augment_prompt(username, user_input), flow_id, session_id, files, cancel
+            ),
+            attachments=[file.digest.encode("ascii") for file in files]
         )
+        st.session_state.pending_exchange = {"exchange": exchange, "flow_id": flow_id, "session_id": session_id}
+    
+    # Ожидание ответа; нажатие "Отменить" прерывает его и отменяет запрос
+    pending = st.session_state.get("pending_exchange")
+    if pending:
+        try:
+            with st.chat_message("assistant", avatar="🤖"):
+                reply = chat_service.wait_for_generation(pending["exchange"], st.empty())
+                st.write(reply["content"])
+        except chat_service.GenerationCancelled:
+            st.session_state.pop("pending_exchange", None)
+            st.info("Запрос отменен, генерация возвращена")
+            st.stop()
+        except flowise_client.FlowiseError as e:
+            st.session_state.pop("pending_exchange", None)
+            st.error(flowise_client.describe_error(e))
+            st.stop()
+        except chat_service.ChatError as e:
+            st.session_state.pop("pending_exchange", None)
+            st.error(str(e))
+            st.stop()
+        st.session_state.pop("pending_exchange", None)
+        # Отправленные файлы убираются из поля загрузки
+        st.session_state.uploads_sent = st.session_state.get("uploads_sent", 0) + 1
+        
+        # Ответ уже сохранен в исходном виде; перевод подставится, когда будет готов
+        if is_auto_translate_enabled(st.session_state.current_chat_flow):
+            submit_reply_translation(db, st.session_state.username, pending["flow_id"], pending["session_id"], reply)
+            st.session_state.setdefault("pending_translations", []).append(reply["message_id"])
         
         st.rerun()
 
@@ -1,14 +1,11 @@
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 import os
-from PIL import Image
 from utils.page_config import setup_pages, PAGE_CONFIG
 import hashlib
 import io
 import mimetypes
 from utils.security import hash_password, is_strong_password
-import requests
-from googletrans import Translator
 import streamlit.components.v1 as components
 from datetime import datetime
 from utils.database.database_manager import get_database
@@ -40,6 +37,7 @@ def clear_chat_history(username: str, flow_id: str, session_id: str):
 def is_valid_image(file_content):
     """Проверяет, является ли файл изображением"""
     try:
+        from PIL import Image
         Image.open(io.BytesIO(file_content))
         return True
     except Exception:
@@ -252,6 +250,7 @@ def main():
                 f.write(new_profile_image.getbuffer())
 
             # Проверяем валидность изображения
+            from PIL import Image
             img = Image.open(new_profile_image)
             img.verify()
             
@@ -1,7 +1,6 @@
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 import os
-from PIL import Image
 from utils.page_config import setup_pages, PAGE_CONFIG
 from utils.security import hash_password, is_strong_password, verify_password, check_login_attempts, increment_login_attempts, reset_login_attempts
 from datetime import datetime
@@ -91,6 +90,8 @@ def register_user(username, email, password, profile_image_path=None):
     
     # Сохраняем пользователя в MongoDB
     db.users.insert_one(user_data)
+    # Сбрасываем отрицательную запись кэша, если имя уже запрашивалось
+    db.invalidate_user(username)
     return True, "Регистрация успешна"
 
 # Функция для входа в систему
@@ -1,13 +1,11 @@
 import streamlit as st
-import requests
-from time import sleep
 import hashlib
 import os
-from PIL import Image
-from googletrans import Translator
-import time
-from flowise import Flowise, PredictionData
 import uuid
+from utils import metrics
+from utils.log import get_logger
+
+log = get_logger("pages.simple_chat")
 
 # Настройка заголовка страницы
 st.set_page_config(
@@ -23,15 +21,18 @@ MAX_API_RESPONSES = 5
 PROFILE_IMAGES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profile_images'))
 ASSISTANT_ICON_PATH = os.path.join(PROFILE_IMAGES_DIR, 'assistant_icon.png')
 
-# Загрузка аватара ассистента
-if os.path.exists(ASSISTANT_ICON_PATH):
-    try:
-        assistant_avatar = Image.open(ASSISTANT_ICON_PATH)
-    except Exception as e:
-        st.error(f"Ошибка при открытии изображения ассистента: {e}")
-        assistant_avatar = "🤖"
-else:
-    assistant_avatar = "🤖"
+@st.cache_resource
+def load_assistant_avatar():
+    """Загрузка аватара ассистента (один раз на процесс)"""
+    # Кэшируются байты файла, а не объект PIL: одно изображение, открытое
+    # лениво, одновременно сохраняли бы в разных сессиях
+    if os.path.exists(ASSISTANT_ICON_PATH):
+        try:
+            with open(ASSISTANT_ICON_PATH, 'rb') as f:
+                return f.read()
+        except Exception as e:
+            log.error(f"Ошибка при открытии изображения ассистента: {e}")
+    return "🤖"
 
 def clear_input():
     """Очистка поля ввода"""
@@ -43,6 +44,7 @@ def get_user_profile_image(username):
         image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
         if os.path.exists(image_path):
             try:
+                from PIL import Image
                 return Image.open(image_path)
             except Exception as e:
                 st.error(f"Ошибка при открытии изображения {image_path}: {e}")
@@ -75,67 +77,78 @@ def get_api_url():
         return None, None
 
 def query(question):
-    """Отправка запроса к API"""
+    """Отправка запроса к API в фоновом потоке; ответ ожидает wait_for_answer"""
+    from utils import chat_service, flowise_client, response_cache
+    from utils.database.database_manager import get_database
     try:
         base_url, flow_id = get_api_url()
         if not base_url or not flow_id:
             st.error("API URL или ID чата не найдены в конфигурации")
             return None
 
-        # Создаем клиент Flowise
-        client = Flowise(base_url=base_url)
-        
-        # Получаем ключ для сообщений пользователя
-        messages_key = get_user_messages_key()
-        
-        try:
-            # Создаем предсказание
-            prediction = client.create_prediction(
-                PredictionData(
-                    chatflowId=flow_id,
-                    question=question,
-                    overrideConfig={
-                        "sessionId": get_user_chat_id()
-                    }
-                )
-            )
-            
-            # Собираем ответ из потока
-            full_response = ""
-            for chunk in prediction:
-                if chunk:
-                    if isinstance(chunk, dict):
-                        chunk_text = chunk.get('text', str(chunk))
-                    else:
-                        chunk_text = str(chunk)
-                    full_response += chunk_text
-            
-            if full_response:
-                # Добавляем сообщения в историю
-                if messages_key not in st.session_state:
-                    st.session_state[messages_key] = []
-                
-                # Добавляем сообщение пользователя
-                user_message = {"role": "user", "content": question}
-                st.session_state[messages_key].append(user_message)
-                
-                # Добавляем ответ ассистента
-                assistant_message = {"role": "assistant", "content": full_response}
-                st.session_state[messages_key].append(assistant_message)
-                
-                st.rerun()
-                return {"text": full_response}
-                
-        except Exception as e:
-            st.error(f"Ошибка при получении ответа: {str(e)}")
-            return None
-            
+        session_id = get_user_chat_id()
+
+        def generate(cancel):
+            # Частые вопросы берутся из кэша ответов без обращения к Flowise;
+            # ответ из кэша добавляется в историю и учитывается в лимите
+            full_response = response_cache.get_response(get_database(), flow_id, question)
+            if full_response is None:
+                full_response = flowise_client.predict(flow_id, question, session_id=session_id, cancel=cancel)
+                response_cache.store_response(get_database(), flow_id, question, full_response)
+            return full_response
+
+        st.session_state.pending_query = {
+            "generation": chat_service.submit_generation(generate),
+            "question": question
+        }
     except Exception as e:
         st.error(f"Общая ошибка: {str(e)}")
         return None
 
     return None
 
+def wait_for_answer():
+    """Ожидание ответа; нажатие "Отменить" прерывает его и отменяет запрос"""
+    from utils import chat_service, flowise_client
+    pending = st.session_state.pending_query
+    try:
+        with st.spinner('Отправляем ваш запрос...'):
+            full_response = chat_service.wait_for_generation(pending["generation"], st.empty())
+    except chat_service.GenerationCancelled:
+        st.session_state.pending_query = None
+        st.info("Запрос отменен")
+        return None
+    except flowise_client.FlowiseError as e:
+        st.session_state.pending_query = None
+        st.error(flowise_client.describe_error(e))
+        return None
+    except Exception as e:
+        st.session_state.pending_query = None
+        st.error(f"Ошибка при получении ответа: {str(e)}")
+        return None
+    st.session_state.pending_query = None
+
+    if full_response:
+        # Получаем ключ для сообщений пользователя
+        messages_key = get_user_messages_key()
+        if messages_key not in st.session_state:
+            st.session_state[messages_key] = []
+
+        # Добавляем сообщение пользователя и ответ ассистента
+        st.session_state[messages_key].append({"role": "user", "content": pending["question"]})
+        st.session_state[messages_key].append({"role": "assistant", "content": full_response})
+
+        st.rerun()
+    return None
+
+def cancel_request():
+    """Очистка поля ввода и отмена ожидаемого ответа"""
+    from utils import chat_service
+    clear_input()
+    pending = st.session_state.pop("pending_query", None)
+    if pending and chat_service.cancel_generation(pending["generation"]):
+        st.toast("Запрос отменен")
+
 def count_api_responses():
     """Подсчет количества ответов от API в истории"""
     messages_key = get_user_messages_key()
@@ -176,7 +189,11 @@ def sidebar_content():
             user_avatar = get_user_profile_image(st.session_state.get("username", ""))
             col1, col2 = st.columns([1, 3])
             with col1:
-                st.image(user_avatar, width=50)
+                # Без фотографии профиля аватар — эмодзи, а не изображение
+                if isinstance(user_avatar, str):
+                    st.markdown(f"## {user_avatar}")
+                else:
+                    st.image(user_avatar, width=50)
             with col2:
                 st.info(f"Пользователь: {st.session_state.get('email')}")
         
@@ -195,12 +212,14 @@ def sidebar_content():
                      key="clear_history_button"):
             reset_chat_session()
 
+@metrics.timed("translation")
 def translate_text(text, target_lang='ru'):
     """
     Переводит текст на указанный язык
     target_lang: 'ru' для русского или 'en' для английского
     """
     try:
+        from googletrans import Translator
         translator = Translator()
         
         if text is None or not isinstance(text, str) or text.strip() == '':
@@ -220,20 +239,14 @@ def translate_text(text, target_lang='ru'):
         return f"Ошибка перевода: некорректный ответ от переводчика"
         
     except Exception as e:
+        metrics.inc("translation_errors_total", stage="total")
         st.error(f"Ошибка при переводе: {str(e)}")
         return text
 
-def display_message_with_translation(message):
-    """Отображает сообщение с кнопкой перевода"""
+def display_message_with_translation(message, index):
+    """Отображает сообщение с кнопкой перевода (index — позиция в истории)"""
     message_hash = get_message_hash(message["role"], message["content"])
-    avatar = assistant_avatar if message["role"] == "assistant" else get_user_profile_image(st.session_state.get("username", ""))
-    
-    # Добавляем уникальный идентификатор сообщения
-    if 'message_ids' not in st.session_state:
-        st.session_state.message_ids = {}
-    
-    if message_hash not in st.session_state.message_ids:
-        st.session_state.message_ids[message_hash] = len(st.session_state.message_ids)
+    avatar = load_assistant_avatar() if message["role"] == "assistant" else get_user_profile_image(st.session_state.get("username", ""))
     
     # Инициализируем состояние перевода для этого сообщения
     translation_key = f"translation_state_{message_hash}"
@@ -270,8 +283,9 @@ def display_message_with_translation(message):
                 """,
                 unsafe_allow_html=True
             )
-            # Используем комбинацию хэша, ID сообщения и роли для уникального ключа
-            button_key = f"translate_{message_hash}_{st.session_state.message_ids[message_hash]}_{message['role']}"
+            # Ключ включает позицию в истории: одинаковые ответы (например, из
+            # кэша ответов) встречаются в истории несколько раз
+            button_key = f"translate_{message_hash}_{index}_{message['role']}"
             if st.button("🔄", key=button_key, help="Перевести сообщение"):
                 current_state = st.session_state[translation_key]
                 
@@ -291,6 +305,9 @@ def get_message_hash(role, content):
     return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
 
 def main():
+    # Страница не вызывает setup_pages, поэтому сервер метрик запускается здесь
+    metrics.start_server()
+    
     # Проверка аутентификации
     if not st.session_state.get("authenticated", False):
         st.warning("Пожалуйста, войдите в систему")
@@ -316,8 +333,8 @@ def main():
     sidebar_content()
 
     # Отображение истории сообщений
-    for message in st.session_state[messages_key]:
-        display_message_with_translation(message)
+    for index, message in enumerate(st.session_state[messages_key]):
+        display_message_with_translation(message, index)
 
     # Проверяем лимит ответов
     if count_api_responses() >= MAX_API_RESPONSES:
@@ -340,13 +357,15 @@ def main():
     with col2:
         clear_button = st.button("Очистить", key="clear_input", on_click=clear_input, use_container_width=True)
     with col3:
-        cancel_button = st.button("Отменить", key="cancel_request", on_click=clear_input, use_container_width=True)
+        cancel_button = st.button("Отменить", key="cancel_request", on_click=cancel_request, use_container_width=True)
 
     # Обработка отправки сообщения
     if send_button and user_input and user_input.strip():
         st.session_state['_last_input'] = user_input
-        with st.spinner('Отправляем ваш запрос...'):
-            query(user_input)
+        query(user_input)
+
+    if st.session_state.get("pending_query"):
+        wait_for_answer()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
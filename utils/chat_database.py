@@ -1,78 +1,187 @@
-from tinydb import TinyDB, Query
+"""Локальная история чатов в SQLite.
+
+Все чаты хранятся в одном файле chat_history/chats.sqlite3 в режиме WAL:
+добавление сообщения — одна вставка строки, а читатели не блокируют
+писателя и друг друга. У каждого потока свое соединение.
+
+Раньше каждый чат был отдельным файлом TinyDB (chat_history/<chat_id>.json),
+который целиком перезаписывался при каждой вставке. Такой файл переносится
+в SQLite при первом открытии чата и переименовывается в *.json.migrated.
+"""
 import os
+import sqlite3
+import threading
 from datetime import datetime
 import hashlib
 import json
+import uuid
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+CHAT_HISTORY_DIR = 'chat_history'
+DATABASE_FILE = 'chats.sqlite3'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    message_id TEXT NOT NULL UNIQUE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    edited_at TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_chat_id_timestamp ON messages (chat_id, timestamp, id);
+"""
 
 def get_message_hash(role, content):
     """Создает уникальный хэш для сообщения"""
     return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
 
+class _SqliteStore:
+    """Файл SQLite с отдельным соединением на поток"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # В режиме WAL NORMAL сохраняет целостность, fsync только при checkpoint
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _get_store(directory):
+    path = os.path.abspath(os.path.join(directory, DATABASE_FILE))
+    with _stores_lock:
+        if path not in _stores:
+            os.makedirs(directory, exist_ok=True)
+            _stores[path] = _SqliteStore(path)
+        return _stores[path]
+
 class ChatDatabase:
-    def __init__(self, chat_id):
-        # Создаем директорию chat_history, если её нет
-        chat_history_dir = 'chat_history'
-        if not os.path.exists(chat_history_dir):
-            os.makedirs(chat_history_dir)
-        
-        # Создаем путь к файлу в папке chat_history
-        self.db_path = os.path.join(chat_history_dir, f'{chat_id}.json')
-        
-        # Проверяем существование файла и его содержимое
-        if not os.path.exists(self.db_path):
-            # Создаем пустой файл с правильной структурой
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump({"_default": {}}, f, ensure_ascii=False, indent=2)
-        
-        # Инициализируем TinyDB с указанием кодировки
-        self.db = TinyDB(self.db_path, encoding='utf-8')
-        
-    def add_message(self, role, content):
+    def __init__(self, chat_id, directory=CHAT_HISTORY_DIR):
+        self.chat_id = str(chat_id)
+        self.store = _get_store(directory)
+        self._migrate_json(os.path.join(directory, f'{self.chat_id}.json'))
+
+    def _migrate_json(self, json_path):
+        """Перенос истории из старого файла TinyDB"""
+        if not os.path.exists(json_path):
+            return
         try:
-            self.db.insert({
-                'role': role,
-                'content': content,
-                'timestamp': datetime.now().isoformat()
-            })
+            with open(json_path, encoding='utf-8') as f:
+                documents = json.load(f).get("_default", {})
+            # Порядок вставки в TinyDB задается номерами документов
+            rows = [
+                (
+                    self.chat_id,
+                    doc.get('message_id') or str(uuid.uuid4()),
+                    doc.get('role', ''),
+                    doc.get('content', ''),
+                    doc.get('timestamp') or datetime.now().isoformat(),
+                    doc.get('edited_at')
+                )
+                for _, doc in sorted(documents.items(), key=lambda item: int(item[0]))
+            ]
+            with self.store.connection() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO messages (chat_id, message_id, role, content, timestamp, edited_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            os.replace(json_path, json_path + '.migrated')
         except Exception as e:
-            print(f"Ошибка при добавлении сообщения: {e}")
-        
+            log.error(f"Ошибка при переносе истории {json_path}: {e}", extra={"session": self.chat_id})
+
+    def add_message(self, role, content, message_id=None):
+        """Добавляет сообщение и возвращает его постоянный идентификатор"""
+        message_id = message_id or str(uuid.uuid4())
+        try:
+            with self.store.connection() as conn:
+                conn.execute(
+                    "INSERT INTO messages (chat_id, message_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (self.chat_id, message_id, role, content, datetime.now().isoformat())
+                )
+        except Exception as e:
+            log.error(f"Ошибка при добавлении сообщения: {e}", extra={"session": self.chat_id})
+        return message_id
+
     def get_history(self):
         try:
-            return self.db.all()
+            rows = self.store.connection().execute(
+                "SELECT message_id, role, content, timestamp, edited_at FROM messages "
+                "WHERE chat_id = ? ORDER BY timestamp, id",
+                (self.chat_id,)
+            ).fetchall()
+            history = []
+            for row in rows:
+                message = dict(row)
+                if message['edited_at'] is None:
+                    del message['edited_at']
+                history.append(message)
+            return history
         except Exception as e:
-            print(f"Ошибка при получении истории: {e}")
+            log.error(f"Ошибка при получении истории: {e}", extra={"session": self.chat_id})
             return []
-        
+
     def clear_history(self):
         try:
-            # Сначала закрываем текущее соединение
-            self.db.close()
-            
-            # Создаем новый пустой файл
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump({"_default": {}}, f, ensure_ascii=False, indent=2)
-            
-            # Переоткрываем базу данных
-            self.db = TinyDB(self.db_path, encoding='utf-8')
+            with self.store.connection() as conn:
+                conn.execute("DELETE FROM messages WHERE chat_id = ?", (self.chat_id,))
         except Exception as e:
-            print(f"Ошибка при очистке истории: {e}")
-        
-    def delete_message(self, message_hash):
-        """Удаляет конкретное сообщение из истории чата по его хэшу"""
+            log.error(f"Ошибка при очистке истории: {e}", extra={"session": self.chat_id})
+
+    def _find_row_id(self, message_id):
+        """Строка с этим message_id (или с хэшем сообщения, как в старых вызовах)"""
+        conn = self.store.connection()
+        row = conn.execute(
+            "SELECT id FROM messages WHERE chat_id = ? AND message_id = ?",
+            (self.chat_id, message_id)
+        ).fetchone()
+        if row:
+            return row['id']
+        for row in conn.execute("SELECT id, role, content FROM messages WHERE chat_id = ? ORDER BY id", (self.chat_id,)):
+            if get_message_hash(row['role'], row['content']) == message_id:
+                return row['id']
+        return None
+
+    def delete_message(self, message_id):
+        """Удаляет одно сообщение по его идентификатору"""
         try:
-            history = self.get_history()
-            updated_history = [msg for msg in history if get_message_hash(msg["role"], msg["content"]) != message_hash]
-            
-            # Очищаем базу и добавляем обновленную историю
-            self.clear_history()
-            for msg in updated_history:
-                self.add_message(msg["role"], msg["content"])
+            row_id = self._find_row_id(message_id)
+            if row_id is None:
+                return False
+            with self.store.connection() as conn:
+                conn.execute("DELETE FROM messages WHERE id = ?", (row_id,))
+            return True
         except Exception as e:
-            print(f"Ошибка при удалении сообщения: {e}")            
-    def __del__(self):
-        """Деструктор для закрытия соединения с базой данных"""
+            log.error(f"Ошибка при удалении сообщения: {e}", extra={"session": self.chat_id})
+            return False
+
+    def edit_message(self, message_id, content):
+        """Изменяет текст одного сообщения по его идентификатору"""
         try:
-            self.db.close()
-        except:
-            pass
+            row_id = self._find_row_id(message_id)
+            if row_id is None:
+                return False
+            with self.store.connection() as conn:
+                conn.execute(
+                    "UPDATE messages SET content = ?, edited_at = ? WHERE id = ?",
+                    (content, datetime.now().isoformat(), row_id)
+                )
+            return True
+        except Exception as e:
+            log.error(f"Ошибка при изменении сообщения: {e}", extra={"session": self.chat_id})
+            return False
@@ -0,0 +1,369 @@
+"""Операции чата без привязки к интерфейсу.
+
+Функции принимают DatabaseManager и имя пользователя и не обращаются к
+st.session_state, поэтому их используют и страницы Streamlit, и HTTP API
+(api/app.py). Ошибки доступа и квоты передаются исключениями ChatError.
+
+Обмен сообщениями (вопрос, ответ Flowise, списание генерации) выполняется
+в фоновом потоке через submit_exchange. Одинаковые отправки одного
+пользователя в ту же сессию, пока обмен выполняется (и еще
+EXCHANGE_LINGER секунд после него), получают тот же результат: двойное
+нажатие "Отправить" или перезапуск скрипта во время ожидания не
+отправляют вопрос повторно и не списывают вторую генерацию.
+
+Генерация резервируется (списывается) до запроса к Flowise и
+возвращается, если ответ не получен или обмен отменен (cancel_generation).
+Отмена прерывает поток ответа Flowise между частями; страница, ожидающая
+ответ (wait_for_generation), освобождается сразу.
+"""
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import streamlit as st
+
+from utils import metrics
+
+# Поток страницы поиска (pages/app.py); остальные потоки — помощники из
+# chat_flows пользователя, их id совпадает с id чат-потока Flowise
+SEARCH_FLOW = "search"
+
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+EXCHANGE_WORKERS = 32  # одновременных обменов с Flowise на процесс
+EXCHANGE_LINGER = 3.0  # секунд после завершения, в течение которых повтор получает тот же ответ
+WAIT_POLL_INTERVAL = 0.25  # секунд между проверками ожидающей страницы
+
+_executor = None
+_exchanges: Dict[Tuple, list] = {}  # ключ -> [Future, время завершения или None]
+_exchanges_lock = threading.Lock()
+
+
+class ChatError(Exception):
+    """Ошибка операции чата; status соответствует коду ответа HTTP"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class GenerationCancelled(ChatError):
+    """Генерация отменена пользователем"""
+
+    def __init__(self, message: str = "Запрос отменен", status: int = 499):
+        super().__init__(message, status)
+
+
+class Generation(Future):
+    """Future фоновой генерации; cancel_event передается функции генерации"""
+
+    def __init__(self):
+        super().__init__()
+        self.cancel_event = threading.Event()
+
+
+def authenticate(db, token: str) -> Dict:
+    """Пользователь по активному ключу доступа"""
+    username = db.find_username_by_token(token)
+    user = db.get_user(username) if username else None
+    # Кэш мог устареть: ключ должен быть активен и в документе пользователя
+    if not user or user.get("active_token") != token:
+        raise ChatError("Недействительный ключ доступа", status=401)
+    return user
+
+
+def get_quota(user: Dict) -> Dict:
+    return {
+        "username": user["username"],
+        "remaining_generations": user.get("remaining_generations", 0),
+        "token_activated_at": user.get("token_activated_at")
+    }
+
+
+def list_flows(user: Dict) -> List[Dict]:
+    """Помощники пользователя и поток поиска"""
+    flows = [{"id": SEARCH_FLOW, "name": "Поиск", "current_session": None}]
+    for flow in user.get("chat_flows", []):
+        flows.append({
+            "id": flow["id"],
+            "name": flow.get("name", "Без имени"),
+            "current_session": flow.get("current_session")
+        })
+    return flows
+
+
+def get_flow(user: Dict, flow_id: str) -> Dict:
+    for flow in list_flows(user):
+        if flow["id"] == flow_id:
+            return flow
+    raise ChatError("Помощник не найден", status=404)
+
+
+def is_charged(flow_id: str) -> bool:
+    """Списывается ли генерация за ответ в потоке (поиск бесплатный)"""
+    return flow_id != SEARCH_FLOW
+
+
+def get_chatflow_id(flow_id: str) -> str:
+    """Чат-поток Flowise, который отвечает в потоке"""
+    if flow_id == SEARCH_FLOW:
+        return st.secrets["flowise"]["search_chat_id"]
+    return flow_id
+
+
+def list_sessions(db, user: Dict, flow_id: str) -> List[Dict]:
+    get_flow(user, flow_id)
+    return db.get_available_sessions(user["username"], flow_id)
+
+
+def check_session(db, user: Dict, flow_id: str, session_id: str):
+    """Сессия существует и принадлежит пользователю"""
+    flow = get_flow(user, flow_id)
+    if session_id == flow["current_session"]:
+        return
+    session = db.chat_sessions.find_one(
+        {"username": user["username"], "flow_id": flow_id, "session_id": session_id},
+        {"_id": 1}
+    )
+    if not session:
+        raise ChatError("Сессия не найдена", status=404)
+
+
+def get_history_page(db, user: Dict, flow_id: str, session_id: str,
+                     offset: int = 0, limit: int = HISTORY_PAGE_SIZE) -> Dict:
+    """Страница истории, считая от последнего сообщения.
+
+    offset — сколько самых новых сообщений пропустить. Сообщения страницы
+    идут в хронологическом порядке; архивные сегменты читаются, только
+    если страница до них доходит.
+    """
+    check_session(db, user, flow_id, session_id)
+    username = user["username"]
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    offset = max(0, offset)
+
+    messages = db.get_chat_history(username, flow_id, session_id)
+    segment = db.get_archived_segment_count(username, flow_id, session_id) - 1
+    # Подгружаем архив, пока в памяти не хватает сообщений на страницу
+    while len(messages) < offset + limit + 1 and segment >= 0:
+        messages = db.load_archived_segment(username, flow_id, session_id, segment) + messages
+        segment -= 1
+
+    end = len(messages) - offset
+    start = max(0, end - limit)
+    return {
+        "messages": messages[start:max(end, 0)],
+        "offset": offset,
+        "has_more": start > 0 or segment >= 0
+    }
+
+
+def check_quota(user: Dict, charged: bool = True):
+    if not user.get("active_token"):
+        raise ChatError("Нет активного ключа доступа", status=403)
+    if charged and user.get("remaining_generations", 0) <= 0:
+        raise ChatError("Закончились генерации", status=402)
+
+
+def check_send(db, user: Dict, flow_id: str, session_id: str):
+    """Пользователь может отправить вопрос в эту сессию"""
+    check_session(db, user, flow_id, session_id)
+    check_quota(user, charged=is_charged(flow_id))
+
+
+def save_exchange(db, username: str, flow_id: str, session_id: str, prompt: str, response: str) -> Dict:
+    """Сохраняет вопрос вместе с полученным ответом; генерация уже зарезервирована.
+
+    Если Flowise недоступен, не ответил в срок или запрос отменен, в
+    истории не остается вопроса без ответа.
+    """
+    user_message = {"role": "user", "content": prompt, "timestamp": datetime.now().isoformat()}
+    db.append_messages(username, flow_id, session_id, [user_message])
+    return add_assistant_message(db, username, flow_id, session_id, response, charge=False)
+
+
+def add_assistant_message(db, username: str, flow_id: str, session_id: str, response: str,
+                          charge: bool = True) -> Dict:
+    """Сохраняет ответ, списывает генерацию и обновляет время сессии"""
+    message = {"role": "assistant", "content": response, "timestamp": datetime.now().isoformat()}
+    db.append_messages(username, flow_id, session_id, [message])
+    if charge:
+        charge_generation(db, username)
+    db.chat_sessions.update_one(
+        {"username": username, "flow_id": flow_id, "session_id": session_id},
+        {"$set": {"updated_at": datetime.now()}}
+    )
+    return message
+
+
+def charge_generation(db, username: str) -> bool:
+    """Списание одной генерации (не уходит ниже нуля)"""
+    result = db.users.update_one(
+        {"username": username, "remaining_generations": {"$gt": 0}},
+        {"$inc": {"remaining_generations": -1}}
+    )
+    db.invalidate_user(username)
+    return result.modified_count > 0
+
+
+def refund_generation(db, username: str):
+    """Возврат зарезервированной генерации"""
+    db.users.update_one({"username": username}, {"$inc": {"remaining_generations": 1}})
+    db.invalidate_user(username)
+    metrics.inc("generations_refunded_total")
+
+
+def get_remaining_generations(db, username: str) -> int:
+    user = db.get_user(username)
+    return user.get("remaining_generations", 0) if user else 0
+
+
+def exchange_key(username: str, flow_id: str, session_id: str, prompt: str,
+                 attachments: Iterable[bytes] = ()) -> Tuple:
+    """Ключ обмена: пользователь, поток, сессия и хэш вопроса с вложениями"""
+    digest = hashlib.sha256(prompt.encode("utf-8"))
+    for attachment in attachments:
+        digest.update(hashlib.sha256(attachment).digest())
+    return (username, flow_id, session_id, digest.hexdigest())
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _exchanges_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=EXCHANGE_WORKERS, thread_name_prefix="chat-exchange")
+    return _executor
+
+
+def _run_generation(generation: Generation, generate: Callable[[threading.Event], object]):
+    # Future создается до запуска, чтобы ключ обмена был занят сразу
+    if not generation.set_running_or_notify_cancel():
+        return
+    try:
+        generation.set_result(generate(generation.cancel_event))
+    except GenerationCancelled as e:
+        generation.set_exception(e)
+    except BaseException as e:
+        if generation.cancel_event.is_set():
+            # Ошибка прерванного запроса к Flowise — следствие отмены
+            e = GenerationCancelled()
+        generation.set_exception(e)
+
+
+def submit_generation(generate: Callable[[threading.Event], object]) -> Generation:
+    """Запуск функции generate(cancel_event) в фоновом потоке.
+
+    Функция должна проверять cancel_event (или передать его во
+    flowise_client) и не обращаться к st.*. Если отмена запрошена,
+    результат отбрасывается и Future завершается GenerationCancelled.
+    """
+    def run(cancel: threading.Event):
+        result = generate(cancel)
+        if cancel.is_set():
+            raise GenerationCancelled()
+        return result
+
+    generation = Generation()
+    _get_executor().submit(_run_generation, generation, run)
+    return generation
+
+
+def cancel_generation(generation: Optional[Generation]) -> bool:
+    """Запрос отмены; False, если генерация уже завершена"""
+    if generation is None or generation.done() or generation.cancel_event.is_set():
+        return False
+    generation.cancel_event.set()
+    metrics.inc("chat_generations_cancelled_total")
+    return True
+
+
+def wait_for_generation(generation: Generation, placeholder=None):
+    """Ожидание результата на странице Streamlit.
+
+    Ожидание не блокирует поток скрипта целиком: элемент placeholder
+    (st.empty()) обновляется каждые WAIT_POLL_INTERVAL секунд, и нажатие
+    любой кнопки, в том числе "Отменить", сразу прерывает выполнение скрипта.
+    """
+    started = time.monotonic()
+    while True:
+        try:
+            return generation.result(timeout=WAIT_POLL_INTERVAL)
+        except FuturesTimeout:
+            if placeholder is not None:
+                placeholder.caption(f"⏱️ {int(time.monotonic() - started)} с")
+
+
+def _run_exchange(db, username: str, flow_id: str, session_id: str, prompt: str,
+                  generate: Callable[[threading.Event], str], charge: bool,
+                  cancel: threading.Event) -> Dict:
+    # Генерация резервируется до запроса, чтобы одновременные отправки не
+    # вывели остаток ниже нуля; при ошибке или отмене она возвращается
+    if charge and not charge_generation(db, username):
+        raise ChatError("Закончились генерации", status=402)
+    try:
+        response = generate(cancel)
+        if cancel.is_set():
+            raise GenerationCancelled()
+        return save_exchange(db, username, flow_id, session_id, prompt, response)
+    except BaseException:
+        if charge:
+            refund_generation(db, username)
+        raise
+
+
+def _exchange_done(key: Tuple, future: Future):
+    with _exchanges_lock:
+        entry = _exchanges.get(key)
+        if entry is None or entry[0] is not future:
+            return
+        if future.exception() is not None:
+            # После ошибки повторная отправка должна выполниться заново
+            del _exchanges[key]
+        else:
+            entry[1] = time.monotonic()
+
+
+def _prune_exchanges(now: float):
+    expired = [
+        key for key, (_, finished_at) in _exchanges.items()
+        if finished_at is not None and now - finished_at > EXCHANGE_LINGER
+    ]
+    for key in expired:
+        del _exchanges[key]
+
+
+def submit_exchange(db, username: str, flow_id: str, session_id: str, prompt: str,
+                    generate: Callable[[threading.Event], str], charge: Optional[bool] = None,
+                    attachments: Iterable[bytes] = ()) -> Tuple[Generation, bool]:
+    """Запуск обмена в фоновом потоке или присоединение к такому же.
+
+    generate(cancel_event) возвращает текст ответа; она вызывается вне
+    потока скрипта Streamlit и не должна обращаться к st.*. Future
+    возвращает сохраненное сообщение помощника. Второй элемент результата —
+    True, если присоединились к уже выполняющемуся обмену. Без charge
+    списание определяется потоком (is_charged).
+    """
+    if charge is None:
+        charge = is_charged(flow_id)
+    key = exchange_key(username, flow_id, session_id, prompt, attachments)
+    with _exchanges_lock:
+        _prune_exchanges(time.monotonic())
+        entry = _exchanges.get(key)
+        if entry is not None:
+            metrics.inc("chat_exchanges_coalesced_total")
+            return entry[0], True
+        future = Generation()
+        _exchanges[key] = [future, None]
+
+    future.add_done_callback(lambda done: _exchange_done(key, done))
+    _get_executor().submit(
+        _run_generation, future,
+        lambda cancel: _run_exchange(db, username, flow_id, session_id, prompt, generate, charge, cancel)
+    )
+    return future, False
@@ -0,0 +1,198 @@
+"""Перенос старых сообщений чата в сжатый архив.
+
+Документ chat_history хранит весь массив messages, поэтому длинные сессии
+растут без ограничений (лимит документа MongoDB — 16 МБ) и занимают
+рабочий набор памяти. Задача архивации переносит сообщения старше порога
+в коллекцию chat_archive блоками (сегментами) в сжатом BSON и оставляет
+в документе только последние сообщения. Сегменты читаются по одному,
+когда пользователь листает историю назад.
+
+Запуск (например, по расписанию):
+    python -m utils.database.archive --days 30 --keep 200
+"""
+import argparse
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import bson
+from bson import Binary
+from bson.codec_options import CodecOptions
+
+from utils.database.message_ids import assign_message_ids
+from utils.log import get_logger
+
+try:
+    import zstandard
+except ImportError:  # zstandard не обязателен, по умолчанию используется zlib
+    zstandard = None
+
+log = get_logger(__name__)
+
+ARCHIVE_AFTER_DAYS = 30  # сообщения старше этого срока переносятся в архив
+HOT_TAIL = 200  # сообщений, которые всегда остаются в документе
+SEGMENT_SIZE = 500  # сообщений в одном сегменте архива
+IDLE_MINUTES = 30  # архивируются только сессии без изменений за это время
+MIN_ARCHIVE_BATCH = 50  # меньшие порции не переносятся
+
+_BSON_OPTIONS = CodecOptions(tz_aware=False)
+
+
+def pack_messages(messages: List[Dict]) -> Tuple[str, bytes]:
+    """Сжатие сегмента сообщений; возвращает (алгоритм, данные)"""
+    payload = bson.encode({"messages": messages})
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(payload)
+    return "zlib", zlib.compress(payload, 9)
+
+
+def unpack_messages(compression: str, data: bytes) -> List[Dict]:
+    """Распаковка сегмента сообщений"""
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("Для чтения сегмента архива установите пакет zstandard")
+        payload = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        payload = zlib.decompress(data)
+    return bson.decode(payload, codec_options=_BSON_OPTIONS)["messages"]
+
+
+def _message_time(message: Dict) -> Optional[datetime]:
+    timestamp = message.get("timestamp")
+    if isinstance(timestamp, datetime):
+        return timestamp
+    if isinstance(timestamp, str):
+        try:
+            return datetime.fromisoformat(timestamp)
+        except ValueError:
+            return None
+    return None
+
+
+def archive_session(db, history_id, older_than: datetime, keep_tail: int = HOT_TAIL) -> int:
+    """Переносит старые сообщения одной сессии в архив.
+
+    Документ обновляется только если он не менялся с момента чтения;
+    при конфликте записанные сегменты удаляются. Возвращает число
+    перенесенных сообщений.
+    """
+    history = db.chat_history.find_one({"_id": history_id})
+    if not history:
+        return 0
+
+    messages = history.get("messages", [])
+    movable = 0
+    limit = len(messages) - keep_tail
+    while movable < limit:
+        message_time = _message_time(messages[movable])
+        # Сообщения без времени — самые старые, созданные до его появления
+        if message_time is not None and message_time >= older_than:
+            break
+        movable += 1
+
+    if movable < MIN_ARCHIVE_BATCH:
+        return 0
+
+    key = {
+        "username": history["username"],
+        "flow_id": history["flow_id"],
+        "session_id": history["session_id"]
+    }
+    first_segment = history.get("archived_segments", 0)
+    segments = []
+    for number, start in enumerate(range(0, movable, SEGMENT_SIZE), start=first_segment):
+        chunk = messages[start:min(start + SEGMENT_SIZE, movable)]
+        assign_message_ids(chunk)
+        compression, data = pack_messages(chunk)
+        segments.append({
+            **key,
+            "segment": number,
+            "count": len(chunk),
+            "first_timestamp": chunk[0].get("timestamp"),
+            "last_timestamp": chunk[-1].get("timestamp"),
+            "compression": compression,
+            "data": Binary(data),
+            # Для поиска сегмента при удалении и редактировании сообщения
+            "message_ids": [message["message_id"] for message in chunk],
+            "created_at": datetime.now()
+        })
+
+    db.chat_archive.insert_many(segments)
+    result = db.chat_history.update_one(
+        {"_id": history_id, "updated_at": history.get("updated_at")},
+        {
+            "$set": {"messages": messages[movable:]},
+            "$inc": {
+                "archived_segments": len(segments),
+                "archived_messages": movable
+            }
+        }
+    )
+    if result.matched_count == 0:
+        # Сессия изменилась во время переноса: откатываем сегменты
+        db.chat_archive.delete_many({
+            **key,
+            "segment": {"$gte": first_segment, "$lt": first_segment + len(segments)}
+        })
+        return 0
+
+    db.redis_client.delete(f"chat_history:{key['username']}:{key['flow_id']}:{key['session_id']}")
+    return movable
+
+
+def run_archiving(db, older_than_days: int = ARCHIVE_AFTER_DAYS, keep_tail: int = HOT_TAIL,
+                  idle_minutes: int = IDLE_MINUTES, limit: Optional[int] = None) -> Dict:
+    """Архивация всех подходящих сессий"""
+    now = datetime.now()
+    older_than = now - timedelta(days=older_than_days)
+    candidates = db.chat_history.find(
+        {
+            "updated_at": {"$lt": now - timedelta(minutes=idle_minutes)},
+            # Длина массива больше keep_tail + MIN_ARCHIVE_BATCH
+            f"messages.{keep_tail + MIN_ARCHIVE_BATCH - 1}": {"$exists": True}
+        },
+        {"_id": 1, "username": 1, "flow_id": 1, "session_id": 1}
+    )
+    if limit:
+        candidates = candidates.limit(limit)
+
+    stats = {"sessions_checked": 0, "sessions_archived": 0, "messages_archived": 0}
+    for candidate in candidates:
+        stats["sessions_checked"] += 1
+        try:
+            moved = archive_session(db, candidate["_id"], older_than, keep_tail)
+        except Exception as e:
+            log.error(f"Ошибка при архивации сессии {candidate['_id']}: {str(e)}", extra={
+                "user": candidate.get("username"), "flow": candidate.get("flow_id"),
+                "session": candidate.get("session_id")
+            })
+            continue
+        if moved:
+            stats["sessions_archived"] += 1
+            stats["messages_archived"] += moved
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос старых сообщений чата в архив")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="архивировать сообщения старше N дней")
+    parser.add_argument("--keep", type=int, default=HOT_TAIL,
+                        help="сколько последних сообщений оставлять в сессии")
+    parser.add_argument("--idle", type=int, default=IDLE_MINUTES,
+                        help="пропускать сессии, изменявшиеся за последние N минут")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="максимум сессий за запуск")
+    args = parser.parse_args()
+
+    from utils.database.database_manager import get_database
+    stats = run_archiving(get_database(), args.days, args.keep, args.idle, args.limit)
+    print(
+        f"Проверено сессий: {stats['sessions_checked']}, "
+        f"архивировано сессий: {stats['sessions_archived']}, "
+        f"сообщений: {stats['messages_archived']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
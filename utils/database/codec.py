@@ -0,0 +1,161 @@
+"""Кодеки значений для кэша Redis.
+
+Значение хранится как один байт заголовка и полезная нагрузка:
+младшие биты заголовка задают формат (JSON, BSON, msgpack),
+флаг COMPRESSED означает, что нагрузка сжата zlib. Значения,
+записанные раньше как обычный JSON-текст, начинаются с печатного
+символа и читаются как JSON, поэтому старый кэш остается валидным.
+
+BSON и msgpack сохраняют типы datetime и ObjectId, в отличие от
+json.dumps(..., default=str), поэтому пользователь из кэша не отличается
+от только что прочитанного из MongoDB.
+"""
+import json
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+
+try:
+    import msgpack
+except ImportError:  # msgpack не обязателен
+    msgpack = None
+
+FORMAT_MASK = 0x0F
+COMPRESSED = 0x10
+
+# Отметка отрицательного кэша: ключа нет в базе данных
+MISSING = b"\x00"
+
+DEFAULT_COMPRESS_THRESHOLD = 4096
+DEFAULT_COMPRESS_LEVEL = 3
+
+_BSON_OPTIONS = CodecOptions(tz_aware=False)
+
+# Коды расширений msgpack
+_EXT_DATETIME = 1
+_EXT_OBJECT_ID = 2
+
+
+class JsonCodec:
+    """Текущий формат: JSON, datetime и ObjectId превращаются в строки"""
+    name = "json"
+    marker = 0x01
+
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value, default=str, ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class BsonCodec:
+    """BSON из pymongo: те же типы, что возвращает MongoDB"""
+    name = "bson"
+    marker = 0x02
+
+    def dumps(self, value: Any) -> bytes:
+        # BSON кодирует только документы, поэтому значение оборачивается
+        return bson.encode({"v": value})
+
+    def loads(self, data: bytes) -> Any:
+        return bson.decode(data, codec_options=_BSON_OPTIONS)["v"]
+
+
+class MsgpackCodec:
+    """msgpack с расширениями для datetime и ObjectId"""
+    name = "msgpack"
+    marker = 0x03
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("Для кодека msgpack установите пакет msgpack")
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            return msgpack.ExtType(_EXT_DATETIME, value.isoformat().encode("ascii"))
+        if isinstance(value, ObjectId):
+            return msgpack.ExtType(_EXT_OBJECT_ID, value.binary)
+        raise TypeError(f"Неподдерживаемый тип для msgpack: {type(value)!r}")
+
+    @staticmethod
+    def _ext_hook(code, data):
+        if code == _EXT_DATETIME:
+            return datetime.fromisoformat(data.decode("ascii"))
+        if code == _EXT_OBJECT_ID:
+            return ObjectId(data)
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, default=self._default, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+
+
+_FORMATS = {
+    JsonCodec.name: JsonCodec,
+    BsonCodec.name: BsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+class ValueCodec:
+    """Кодирование значений кэша с заголовком формата и сжатием"""
+
+    def __init__(self, name: str = "bson",
+                 compress_threshold: Optional[int] = DEFAULT_COMPRESS_THRESHOLD,
+                 compress_level: int = DEFAULT_COMPRESS_LEVEL):
+        if name not in _FORMATS:
+            raise ValueError(f"Неизвестный кодек кэша: {name}")
+        self.format = _FORMATS[name]()
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self._decoders: Dict[int, Any] = {self.format.marker: self.format}
+
+    def encode(self, value: Any, compress: Optional[bool] = None) -> bytes:
+        """Кодирует значение; compress=None сжимает только крупные значения"""
+        payload = self.format.dumps(value)
+        header = self.format.marker
+        if compress is None:
+            compress = self.compress_threshold is not None and len(payload) >= self.compress_threshold
+        if compress:
+            payload = zlib.compress(payload, self.compress_level)
+            header |= COMPRESSED
+        return bytes([header]) + payload
+
+    def decode(self, data: Optional[bytes]) -> Any:
+        """Декодирует значение любого известного формата"""
+        if not data:
+            return None
+        if isinstance(data, str):
+            return json.loads(data)
+
+        header = data[0]
+        marker = header & FORMAT_MASK
+        if header & ~(FORMAT_MASK | COMPRESSED) or marker == 0:
+            # Значение старого формата: JSON-текст без заголовка
+            return json.loads(data)
+
+        decoder = self._decoders.get(marker)
+        if decoder is None:
+            decoder = self._decoder_for(marker)
+
+        payload = data[1:]
+        if header & COMPRESSED:
+            payload = zlib.decompress(payload)
+        return decoder.loads(payload)
+
+    def _decoder_for(self, marker: int):
+        for codec_class in _FORMATS.values():
+            if codec_class.marker == marker:
+                decoder = codec_class()
+                self._decoders[marker] = decoder
+                return decoder
+        raise ValueError(f"Неизвестный формат значения кэша: {marker:#x}")
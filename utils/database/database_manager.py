@@ -1,43 +1,270 @@
 import os
-import json
+import copy
+import random
+import threading
+import time
 from datetime import datetime
 from typing import Dict, List, Optional
 import streamlit as st
-from pymongo import MongoClient
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from pymongo import MongoClient, monitoring
 from pymongo.collection import Collection
 import redis
 from bson import ObjectId
+from utils.database.codec import ValueCodec, DEFAULT_COMPRESS_THRESHOLD, MISSING
+from utils.database.singleflight import SingleFlight
+from utils.database.local_cache import LocalCache, MISS
+from utils.database.archive import pack_messages, unpack_messages
+from utils.database.message_ids import assign_message_ids, backfill_history, backfill_segment, has_stable_id
+from utils.search import make_snippet, stems_pattern
+from utils import metrics
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+# Параметры подключений по умолчанию (переопределяются в secrets.toml)
+MONGO_DEFAULTS = {
+    "max_pool_size": 50,
+    "min_pool_size": 5,
+    "server_selection_timeout_ms": 5000,
+    "connect_timeout_ms": 5000,
+    "socket_timeout_ms": 10000,
+    "wait_queue_timeout_ms": 5000
+}
+
+DATABASE_DEFAULTS = {
+    "backend": "mongo",
+    "name": "panel_product"  # имя базы для backend = "local"
+}
+
+REDIS_DEFAULTS = {
+    "codec": "bson",
+    "compress_threshold": DEFAULT_COMPRESS_THRESHOLD,
+    "max_connections": 50,
+    "socket_timeout": 2.0,
+    "socket_connect_timeout": 2.0,
+    "health_check_interval": 30,
+    "l1_ttl": 5,
+    "l1_max_size": 1024
+}
+
+# Кэш пользователей
+USER_CACHE_TTL = 300  # секунд
+USER_NEGATIVE_TTL = 30  # секунд для несуществующих пользователей
+CACHE_TTL_JITTER = 0.1  # разброс TTL, чтобы ключи не истекали одновременно
+USER_LOAD_LOCK_MS = 3000  # блокировка загрузки пользователя между процессами
+USER_LOAD_WAIT = 1.0  # секунд ожидания загрузки другим процессом
+
+# Канал Redis для инвалидации локальных кэшей всех процессов
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+_instance_lock = threading.Lock()
+
+def _jittered_ttl(seconds: int) -> int:
+    """TTL со случайным разбросом"""
+    return max(1, int(seconds * random.uniform(1 - CACHE_TTL_JITTER, 1 + CACHE_TTL_JITTER)))
+
+def _setting(config, section: str, key: str, defaults: Dict):
+    """Параметр из secrets.toml (или переданной конфигурации) со значением по умолчанию"""
+    try:
+        return config[section].get(key, defaults[key])
+    except (KeyError, FileNotFoundError):
+        return defaults[key]
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Счетчики пула соединений MongoDB для мониторинга"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checked_out": 0,
+            "checkout_failures": 0,
+            "pool_clears": 0
+        }
+
+    def _inc(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats["open_connections"] = stats["connections_created"] - stats["connections_closed"]
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc("pool_clears")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._inc("checkout_failures")
+
+    def connection_checked_out(self, event):
+        self._inc("checked_out")
+
+    def connection_checked_in(self, event):
+        self._inc("checked_out", -1)
 
 class DatabaseManager:
     _instance = None
 
-    def __init__(self):
-        # MongoDB подключение
-        self.mongo_uri = st.secrets["mongodb"]["uri"]
-        self.mongo_client = MongoClient(
-            self.mongo_uri,
-            username=st.secrets["mongodb"]["username"],
-            password=st.secrets["mongodb"]["password"]
-        )
-        self.db = self.mongo_client[st.secrets["mongodb"]["database"]]
+    def __init__(self, config=None):
+        """Подключение к хранилищам.
+        
+        config — словарь в формате secrets.toml (по умолчанию st.secrets).
+        Параметр [database] backend выбирает хранилище: "mongo" (по умолчанию)
+        — MongoDB и Redis из [mongodb] и [redis]; "local" — mongomock и
+        fakeredis в памяти процесса для разработки и замеров без серверов.
+        """
+        self.config = st.secrets if config is None else config
+        self.backend = _setting(self.config, "database", "backend", DATABASE_DEFAULTS)
+        if self.backend == "local":
+            self._connect_local()
+        elif self.backend == "mongo":
+            self._connect_mongo()
+            self._connect_redis()
+        else:
+            raise ValueError(f"Неизвестное хранилище: {self.backend}")
         
         # Коллекции MongoDB
         self.users = self.db.users
         self.chat_sessions = self.db.chat_sessions
         self.chat_history = self.db.chat_history
         self.access_tokens = self.db.access_tokens
+        self.chat_archive = self.db.chat_archive
+        self.chat_search = self.db.chat_search
         
         # Создаем индексы
         self._create_indexes()
         
-        # Redis подключение
-        self.redis_client = redis.Redis(
-            host=st.secrets["redis"]["host"],
-            port=st.secrets["redis"]["port"],
-            password=st.secrets["redis"]["password"],
-            db=st.secrets["redis"]["db"],
-            decode_responses=True
+        self.codec = ValueCodec(
+            _setting(self.config, "redis", "codec", REDIS_DEFAULTS),
+            compress_threshold=_setting(self.config, "redis", "compress_threshold", REDIS_DEFAULTS)
         )
+        self._user_loads = SingleFlight()
+        
+        # Локальный кэш процесса перед Redis, инвалидируется через pub/sub
+        self.local_cache = LocalCache(
+            max_size=_setting(self.config, "redis", "l1_max_size", REDIS_DEFAULTS),
+            ttl=_setting(self.config, "redis", "l1_ttl", REDIS_DEFAULTS)
+        )
+        self._invalidation_thread = None
+        self._start_invalidation_listener()
+    
+    def _connect_mongo(self):
+        """MongoDB с явными параметрами пула"""
+        config = self.config
+        self.mongo_pool_listener = MongoPoolListener()
+        self.mongo_uri = config["mongodb"]["uri"]
+        self.mongo_client = MongoClient(
+            self.mongo_uri,
+            username=config["mongodb"]["username"],
+            password=config["mongodb"]["password"],
+            maxPoolSize=_setting(config, "mongodb", "max_pool_size", MONGO_DEFAULTS),
+            minPoolSize=_setting(config, "mongodb", "min_pool_size", MONGO_DEFAULTS),
+            serverSelectionTimeoutMS=_setting(config, "mongodb", "server_selection_timeout_ms", MONGO_DEFAULTS),
+            connectTimeoutMS=_setting(config, "mongodb", "connect_timeout_ms", MONGO_DEFAULTS),
+            socketTimeoutMS=_setting(config, "mongodb", "socket_timeout_ms", MONGO_DEFAULTS),
+            waitQueueTimeoutMS=_setting(config, "mongodb", "wait_queue_timeout_ms", MONGO_DEFAULTS),
+            event_listeners=[self.mongo_pool_listener]
+        )
+        self.db = self.mongo_client[config["mongodb"]["database"]]
+    
+    def _connect_redis(self):
+        """Redis через общий пул с проверкой соединений.
+        
+        Значения кэша бинарные (см. codec.py), поэтому ответы не декодируются.
+        """
+        config = self.config
+        self.redis_pool = redis.ConnectionPool(
+            host=config["redis"]["host"],
+            port=config["redis"]["port"],
+            password=config["redis"]["password"],
+            db=config["redis"]["db"],
+            decode_responses=False,
+            max_connections=_setting(config, "redis", "max_connections", REDIS_DEFAULTS),
+            socket_timeout=_setting(config, "redis", "socket_timeout", REDIS_DEFAULTS),
+            socket_connect_timeout=_setting(config, "redis", "socket_connect_timeout", REDIS_DEFAULTS),
+            health_check_interval=_setting(config, "redis", "health_check_interval", REDIS_DEFAULTS),
+            retry_on_timeout=True
+        )
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+    
+    def _connect_local(self):
+        """Хранилища в памяти процесса: mongomock вместо MongoDB, fakeredis вместо Redis"""
+        try:
+            import mongomock
+            import fakeredis
+        except ImportError:
+            raise ImportError(
+                'Для backend = "local" установите пакеты из requirements-dev.txt (mongomock, fakeredis)'
+            )
+        self.mongo_pool_listener = MongoPoolListener()
+        self.mongo_uri = "mongomock://localhost"
+        self.mongo_client = mongomock.MongoClient()
+        self.db = self.mongo_client[_setting(self.config, "database", "name", DATABASE_DEFAULTS)]
+        self.redis_client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.redis_pool = self.redis_client.connection_pool
+    
+    def _start_invalidation_listener(self):
+        """Подписка на сообщения об инвалидации от других процессов"""
+        try:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidation})
+            self._invalidation_thread = pubsub.run_in_thread(
+                sleep_time=1.0,
+                daemon=True,
+                exception_handler=self._on_invalidation_error
+            )
+        except Exception as e:
+            # Без подписки локальный кэш устаревает не дольше своего TTL
+            log.error(f"Ошибка подписки на инвалидацию кэша: {str(e)}")
+    
+    def _on_invalidation(self, message):
+        key = message["data"]
+        self.local_cache.delete(key.decode() if isinstance(key, bytes) else key)
+    
+    def _on_invalidation_error(self, error, pubsub, thread):
+        # Пока соединение недоступно, сообщения могли быть потеряны
+        log.error(f"Ошибка канала инвалидации кэша: {str(error)}")
+        self.local_cache.clear()
+        time.sleep(1.0)
+    
+    def _rerun_memo(self) -> Optional[Dict]:
+        """Память чтений в рамках текущего перезапуска скрипта Streamlit"""
+        # Вне потока скрипта (фоновые потоки, API) память не используется
+        ctx = get_script_run_ctx(suppress_warning=True)
+        if ctx is None:
+            return None
+        memo = getattr(ctx, "_db_rerun_memo", None)
+        # ScriptRunContext.reset() создает новый словарь cursors при каждом
+        # перезапуске скрипта, поэтому по нему определяется смена перезапуска
+        if memo is None or memo[0] is not ctx.cursors:
+            memo = (ctx.cursors, {})
+            ctx._db_rerun_memo = memo
+        return memo[1]
     
     def _create_indexes(self):
         """Создание индексов для оптимизации запросов"""
@@ -50,6 +277,9 @@ class DatabaseManager:
                 self.users.create_index("username", unique=True)
             if "email_1" not in user_indexes:
                 self.users.create_index("email", unique=True)
+            if "active_token_1" not in user_indexes:
+                # Поиск пользователя по ключу доступа (авторизация API)
+                self.users.create_index("active_token", sparse=True)
             
             # Индексы для сессий
             existing_session_indexes = self.chat_sessions.list_indexes()
@@ -73,6 +303,35 @@ class DatabaseManager:
                     ("session_id", 1)
                 ])
             
+            # Индекс для сегментов архива истории
+            existing_archive_indexes = self.chat_archive.list_indexes()
+            archive_indexes = {idx['name'] for idx in existing_archive_indexes}
+            
+            if "username_1_flow_id_1_session_id_1_segment_1" not in archive_indexes:
+                self.chat_archive.create_index([
+                    ("username", 1),
+                    ("flow_id", 1),
+                    ("session_id", 1),
+                    ("segment", 1)
+                ], unique=True)
+            
+            # Полнотекстовый индекс сообщений (поиск всегда в рамках пользователя)
+            existing_search_indexes = self.chat_search.list_indexes()
+            search_indexes = {idx['name'] for idx in existing_search_indexes}
+            
+            if "username_1_content_text" not in search_indexes:
+                self.chat_search.create_index(
+                    [("username", 1), ("content", "text")],
+                    name="username_1_content_text",
+                    default_language="russian"
+                )
+            if "username_1_flow_id_1_session_id_1" not in search_indexes:
+                self.chat_search.create_index([
+                    ("username", 1),
+                    ("flow_id", 1),
+                    ("session_id", 1)
+                ])
+            
             # Индекс для токенов
             existing_token_indexes = self.access_tokens.list_indexes()
             token_indexes = {idx['name'] for idx in existing_token_indexes}
@@ -81,25 +340,97 @@ class DatabaseManager:
                 self.access_tokens.create_index("token", unique=True)
             
         except Exception as e:
-            print(f"Ошибка при создании индексов: {str(e)}")
+            log.error(f"Ошибка при создании индексов: {str(e)}")
             # Не прерываем работу приложения при ошибке создания индексов
     
     def get_user(self, username: str) -> Optional[Dict]:
-        """Получение данных пользователя с кэшированием"""
+        """Получение данных пользователя с кэшированием.
+        
+        Чтение идет по уровням: память текущего перезапуска скрипта, локальный
+        кэш процесса, Redis, MongoDB. Промах кэша загружается одним потоком на
+        ключ (остальные ждут его результат), несуществующие пользователи
+        кэшируются на короткое время.
+        """
+        cache_key = f"user:{username}"
+        
+        memo = self._rerun_memo()
+        if memo is not None and cache_key in memo:
+            metrics.cache_result("user_rerun", True)
+            return copy.deepcopy(memo[cache_key])
+        
+        user = self.local_cache.get(cache_key)
+        metrics.cache_result("user_local", user is not MISS)
+        if user is MISS:
+            user = self._get_user_from_redis(username)
+            self.local_cache.set(cache_key, user)
+        
+        if memo is not None:
+            memo[cache_key] = user
+        # Вызывающий код может изменять документ, поэтому возвращается копия
+        return copy.deepcopy(user)
+    
+    def find_username_by_token(self, token: str) -> Optional[str]:
+        """Имя пользователя с этим активным ключом доступа"""
+        if not token:
+            return None
+        user = self.users.find_one({"active_token": token}, {"_id": 0, "username": 1})
+        return user["username"] if user else None
+    
+    def _get_user_from_redis(self, username: str) -> Optional[Dict]:
         cache_key = f"user:{username}"
         
         # Пробуем получить из кэша
         cached_user = self.redis_client.get(cache_key)
+        metrics.cache_result("user_redis", bool(cached_user))
+        if cached_user == MISSING:
+            return None
         if cached_user:
-            return json.loads(cached_user)
+            return self.codec.decode(cached_user)
         
-        # Если нет в кэше, получаем из MongoDB
-        user = self.users.find_one({"username": username})
-        if user:
-            # Кэшируем на 5 минут
-            self.redis_client.setex(cache_key, 300, json.dumps(user, default=str))
+        user, _ = self._user_loads.do(cache_key, lambda: self._load_user(username))
         return user
     
+    def _load_user(self, username: str) -> Optional[Dict]:
+        """Загрузка пользователя из MongoDB в кэш (одна на ключ во всех процессах)"""
+        cache_key = f"user:{username}"
+        lock_key = f"lock:{cache_key}"
+        
+        has_lock = self.redis_client.set(lock_key, 1, nx=True, px=USER_LOAD_LOCK_MS)
+        if not has_lock:
+            # Пользователя уже загружает другой процесс: ждем его результат
+            deadline = time.monotonic() + USER_LOAD_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                cached_user = self.redis_client.get(cache_key)
+                if cached_user == MISSING:
+                    return None
+                if cached_user:
+                    return self.codec.decode(cached_user)
+        
+        try:
+            user = self.users.find_one({"username": username})
+            if user:
+                self.redis_client.setex(cache_key, _jittered_ttl(USER_CACHE_TTL), self.codec.encode(user))
+            else:
+                self.redis_client.setex(cache_key, _jittered_ttl(USER_NEGATIVE_TTL), MISSING)
+            return user
+        finally:
+            if has_lock:
+                self.redis_client.delete(lock_key)
+    
+    def invalidate_user(self, username: str):
+        """Удаление пользователя из всех уровней кэша во всех процессах"""
+        cache_key = f"user:{username}"
+        memo = self._rerun_memo()
+        if memo is not None:
+            memo.pop(cache_key, None)
+        self.local_cache.delete(cache_key)
+        try:
+            self.redis_client.delete(cache_key)
+            self.redis_client.publish(INVALIDATION_CHANNEL, cache_key)
+        except Exception as e:
+            log.error(f"Ошибка при инвалидации кэша пользователя: {str(e)}", extra={"user": username})
+    
     def update_user(self, username: str, update_data: Dict) -> bool:
         """Обновление данных пользователя с инвалидацией кэша"""
         try:
@@ -109,11 +440,13 @@ class DatabaseManager:
             )
             
             # Инвалидируем кэш
-            self.redis_client.delete(f"user:{username}")
+            self.invalidate_user(username)
+            if update_data.get("username") and update_data["username"] != username:
+                self.invalidate_user(update_data["username"])
             
             return result.modified_count > 0
         except Exception as e:
-            print(f"Ошибка при обновлении пользователя: {str(e)}")
+            log.error(f"Ошибка при обновлении пользователя: {str(e)}", extra={"user": username})
             return False
     
     def get_chat_history(self, username: str, flow_id: str, session_id: str) -> List[Dict]:
@@ -122,8 +455,9 @@ class DatabaseManager:
         
         # Пробуем получить из кэша
         cached_history = self.redis_client.get(cache_key)
+        metrics.cache_result("history_redis", bool(cached_history))
         if cached_history:
-            return json.loads(cached_history)
+            return self.codec.decode(cached_history)
         
         # Если нет в кэше, получаем из MongoDB
         history = self.chat_history.find_one({
@@ -132,16 +466,44 @@ class DatabaseManager:
             "session_id": session_id
         })
         
-        messages = history.get("messages", []) if history else []
+        # Сообщениям, записанным до появления message_id, он назначается сейчас
+        messages = backfill_history(self, history) if history else []
         
-        # Кэшируем на 1 минуту
-        self.redis_client.setex(cache_key, 60, json.dumps(messages, default=str))
+        # Кэшируем на 1 минуту; историю, которой не удалось сохранить
+        # идентификаторы, не кэшируем, чтобы их назначило следующее чтение
+        if all(has_stable_id(message) for message in messages):
+            self.redis_client.setex(cache_key, 60, self.codec.encode(messages))
         
         return messages
     
+    def get_available_sessions(self, username: str, flow_id: str) -> List[Dict]:
+        """Сессии помощника: основная первой, остальные по времени создания"""
+        sessions = self.chat_sessions.find(
+            {"username": username, "flow_id": flow_id},
+            {"_id": 0, "session_id": 1, "name": 1, "is_primary": 1, "created_at": 1}
+        ).sort("created_at", 1)
+        
+        primary = []
+        others = []
+        for session in sessions:
+            if session.get("is_primary"):
+                primary.append({
+                    'id': session['session_id'],
+                    'display_name': session.get('name', "Основная сессия"),
+                    'is_primary': True
+                })
+            else:
+                others.append({
+                    'id': session['session_id'],
+                    'display_name': session.get('name', f"Сессия {session['session_id'][:8]}"),
+                    'is_primary': False
+                })
+        return primary[:1] + others
+    
     def save_chat_history(self, username: str, flow_id: str, session_id: str, messages: List[Dict]) -> bool:
         """Сохранение истории чата с обновлением кэша"""
         try:
+            assign_message_ids(messages)
             self.chat_history.update_one(
                 {
                     "username": username,
@@ -159,36 +521,358 @@ class DatabaseManager:
             
             # Обновляем кэш
             cache_key = f"chat_history:{username}:{flow_id}:{session_id}"
-            self.redis_client.setex(cache_key, 60, json.dumps(messages, default=str))
+            self.redis_client.setex(cache_key, 60, self.codec.encode(messages))
+            
+            # История перезаписана целиком, поэтому индекс сессии строится заново
+            self._delete_search_entries(username, flow_id, session_id)
+            self.index_messages(username, flow_id, session_id, messages)
             
             return True
         except Exception as e:
-            print(f"Ошибка при сохранении истории: {str(e)}")
+            log.error(f"Ошибка при сохранении истории: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
             return False
     
+    def append_messages(self, username: str, flow_id: str, session_id: str, messages: List[Dict]) -> bool:
+        """Добавление сообщений в конец истории без перезаписи всего массива.
+        
+        Сообщениям назначается message_id (словари изменяются на месте).
+        """
+        assign_message_ids(messages)
+        try:
+            self.chat_history.update_one(
+                {
+                    "username": username,
+                    "flow_id": flow_id,
+                    "session_id": session_id
+                },
+                {
+                    "$push": {"messages": {"$each": messages}},
+                    "$set": {"updated_at": datetime.now()}
+                },
+                upsert=True
+            )
+            self.redis_client.delete(f"chat_history:{username}:{flow_id}:{session_id}")
+        except Exception as e:
+            log.error(f"Ошибка при сохранении истории: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+            return False
+        
+        self.index_messages(username, flow_id, session_id, messages)
+        return True
+    
+    def index_messages(self, username: str, flow_id: str, session_id: str, messages: List[Dict]):
+        """Добавление сообщений в полнотекстовый индекс"""
+        documents = [
+            {
+                "username": username,
+                "flow_id": flow_id,
+                "session_id": session_id,
+                "message_id": message.get("message_id"),
+                "role": message.get("role"),
+                "content": message["content"],
+                "timestamp": message.get("timestamp")
+            }
+            for message in messages
+            if isinstance(message.get("content"), str) and message["content"].strip()
+        ]
+        if not documents:
+            return
+        try:
+            self.chat_search.insert_many(documents, ordered=False)
+        except Exception as e:
+            # Ошибка индексации не должна мешать сохранению сообщения
+            log.error(f"Ошибка при индексации сообщений: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+    
+    def _delete_search_entries(self, username: str, flow_id: str, session_id: Optional[str] = None):
+        query = {"username": username, "flow_id": flow_id}
+        if session_id:
+            query["session_id"] = session_id
+        try:
+            self.chat_search.delete_many(query)
+        except Exception as e:
+            log.error(f"Ошибка при удалении из поискового индекса: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+    
+    def search_sessions(self, username: str, query: str, flow_id: Optional[str] = None, limit: int = 10) -> List[Dict]:
+        """Поиск сессий пользователя по тексту сообщений.
+        
+        Возвращает сессии по убыванию релевантности с фрагментом лучшего
+        совпадения в каждой.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        
+        projection = {"flow_id": 1, "session_id": 1, "role": 1, "content": 1, "timestamp": 1}
+        if self.backend == "local":
+            # В mongomock нет $text: совпадение по основам слов, новые сообщения первыми
+            pattern = stems_pattern(query)
+            if not pattern:
+                return []
+            search_filter = {"username": username, "content": {"$regex": pattern, "$options": "i"}}
+            sort = [("timestamp", -1)]
+        else:
+            search_filter = {"username": username, "$text": {"$search": query}}
+            projection["score"] = {"$meta": "textScore"}
+            sort = [("score", {"$meta": "textScore"})]
+        if flow_id:
+            search_filter["flow_id"] = flow_id
+        
+        try:
+            hits = self.chat_search.find(search_filter, projection).sort(sort).limit(limit * 5)
+            
+            results = {}
+            for hit in hits:
+                session_key = (hit["flow_id"], hit["session_id"])
+                if session_key in results:
+                    continue
+                results[session_key] = {
+                    "flow_id": hit["flow_id"],
+                    "session_id": hit["session_id"],
+                    "role": hit.get("role"),
+                    "timestamp": hit.get("timestamp"),
+                    "snippet": make_snippet(hit["content"], query),
+                    "score": hit.get("score", 0)
+                }
+                if len(results) >= limit:
+                    break
+            
+            if not results:
+                return []
+            
+            # Названия найденных сессий одним запросом
+            sessions = self.chat_sessions.find(
+                {
+                    "username": username,
+                    "session_id": {"$in": [key[1] for key in results]}
+                },
+                {"flow_id": 1, "session_id": 1, "name": 1}
+            )
+            for session in sessions:
+                result = results.get((session["flow_id"], session["session_id"]))
+                if result:
+                    result["name"] = session.get("name")
+            
+            for result in results.values():
+                if not result.get("name"):
+                    result["name"] = f"Сессия {result['session_id'][:8]}"
+            return list(results.values())
+        except Exception as e:
+            log.error(f"Ошибка при поиске по истории: {str(e)}", extra={"user": username, "flow": flow_id})
+            return []
+    
+    def delete_message(self, username: str, flow_id: str, session_id: str, message_id: str) -> bool:
+        """Удаление одного сообщения по message_id из истории или архива"""
+        key = {"username": username, "flow_id": flow_id, "session_id": session_id}
+        try:
+            # Возвращается документ до изменения с одним найденным сообщением
+            history = self.chat_history.find_one_and_update(
+                {**key, "messages.message_id": message_id},
+                {
+                    "$pull": {"messages": {"message_id": message_id}},
+                    "$set": {"updated_at": datetime.now()}
+                },
+                projection={"messages": {"$elemMatch": {"message_id": message_id}}}
+            )
+            if history:
+                old_message = history["messages"][0]
+            else:
+                old_message = self._change_archived_message(key, message_id)
+        except Exception as e:
+            log.error(f"Ошибка при удалении сообщения: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+            return False
+        
+        if old_message is None:
+            return False
+        self.redis_client.delete(f"chat_history:{username}:{flow_id}:{session_id}")
+        self._update_search_entry(key, old_message)
+        return True
+    
+    def edit_message(self, username: str, flow_id: str, session_id: str, message_id: str, content: str) -> bool:
+        """Изменение текста одного сообщения по message_id"""
+        key = {"username": username, "flow_id": flow_id, "session_id": session_id}
+        now = datetime.now()
+        try:
+            history = self.chat_history.find_one_and_update(
+                {**key, "messages.message_id": message_id},
+                {"$set": {
+                    "messages.$.content": content,
+                    "messages.$.edited_at": now,
+                    "updated_at": now
+                }},
+                projection={"messages": {"$elemMatch": {"message_id": message_id}}}
+            )
+            if history:
+                old_message = history["messages"][0]
+            else:
+                old_message = self._change_archived_message(key, message_id, content)
+        except Exception as e:
+            log.error(f"Ошибка при изменении сообщения: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+            return False
+        
+        if old_message is None:
+            return False
+        self.redis_client.delete(f"chat_history:{username}:{flow_id}:{session_id}")
+        self._update_search_entry(key, old_message, content)
+        return True
+    
+    def set_message_translation(self, username: str, flow_id: str, session_id: str, message_id: str,
+                                translation: str) -> bool:
+        """Сохранение перевода сообщения рядом с исходным текстом (content не меняется).
+        
+        Переводятся только что полученные ответы, поэтому архив не проверяется.
+        """
+        try:
+            result = self.chat_history.update_one(
+                {"username": username, "flow_id": flow_id, "session_id": session_id,
+                 "messages.message_id": message_id},
+                {"$set": {"messages.$.translation": translation}}
+            )
+        except Exception as e:
+            log.error(f"Ошибка при сохранении перевода: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+            return False
+        self.redis_client.delete(f"chat_history:{username}:{flow_id}:{session_id}")
+        return result.modified_count > 0
+    
+    def _change_archived_message(self, key: Dict, message_id: str, content: Optional[str] = None) -> Optional[Dict]:
+        """Удаление (content=None) или изменение сообщения в сегменте архива.
+        
+        Переупаковывается только сегмент с этим сообщением. Возвращает
+        прежнее сообщение или None, если оно не найдено.
+        """
+        segment = self.chat_archive.find_one({**key, "message_ids": message_id})
+        if not segment:
+            return None
+        
+        messages = unpack_messages(segment.get("compression", "zlib"), segment["data"])
+        old_message = next((m for m in messages if m.get("message_id") == message_id), None)
+        if old_message is None:
+            return None
+        if content is None:
+            messages = [m for m in messages if m is not old_message]
+        else:
+            messages = [
+                dict(m, content=content, edited_at=datetime.now()) if m is old_message else m
+                for m in messages
+            ]
+        
+        compression, data = pack_messages(messages)
+        result = self.chat_archive.update_one(
+            # Сегмент не должен был измениться с момента чтения
+            {"_id": segment["_id"], "data": segment["data"]},
+            {"$set": {
+                "compression": compression,
+                "data": data,
+                "count": len(messages),
+                "message_ids": [m["message_id"] for m in messages]
+            }}
+        )
+        if result.modified_count == 0:
+            return None
+        if content is None:
+            self.chat_history.update_one(key, {"$inc": {"archived_messages": -1}})
+        return old_message
+    
+    def _update_search_entry(self, key: Dict, old_message: Dict, content: Optional[str] = None):
+        """Удаление (content=None) или изменение сообщения в поисковом индексе"""
+        message_id = old_message["message_id"]
+        try:
+            if content is None:
+                result = self.chat_search.delete_one({**key, "message_id": message_id})
+            else:
+                result = self.chat_search.update_one({**key, "message_id": message_id}, {"$set": {"content": content}})
+            if (result.deleted_count if content is None else result.matched_count):
+                return
+            
+            # Запись проиндексирована до появления message_id: ищем по тексту
+            legacy_entry = {
+                **key,
+                "message_id": None,
+                "content": old_message.get("content")
+            }
+            if content is None:
+                self.chat_search.delete_one(legacy_entry)
+            else:
+                self.chat_search.update_one(legacy_entry, {"$set": {"content": content, "message_id": message_id}})
+        except Exception as e:
+            log.error(f"Ошибка при обновлении поискового индекса: {str(e)}")
+    
+    def forget_history(self, username: str, flow_id: str, session_id: Optional[str] = None):
+        """Удаление архива, поискового индекса и кэша истории сессии (или всех сессий помощника)"""
+        self.delete_archive(username, flow_id, session_id)
+        self._delete_search_entries(username, flow_id, session_id)
+        try:
+            if session_id:
+                self.redis_client.delete(f"chat_history:{username}:{flow_id}:{session_id}")
+            else:
+                keys = self.redis_client.keys(f"chat_history:{username}:{flow_id}:*")
+                if keys:
+                    self.redis_client.delete(*keys)
+        except Exception as e:
+            log.error(f"Ошибка при очистке кэша истории: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+    
+    def get_archived_segment_count(self, username: str, flow_id: str, session_id: str) -> int:
+        """Количество сегментов архива сессии"""
+        history = self.chat_history.find_one(
+            {
+                "username": username,
+                "flow_id": flow_id,
+                "session_id": session_id
+            },
+            {"archived_segments": 1}
+        )
+        return history.get("archived_segments", 0) if history else 0
+    
+    def load_archived_segment(self, username: str, flow_id: str, session_id: str, segment: int) -> List[Dict]:
+        """Распаковка одного сегмента архива (сегмент 0 — самые старые сообщения)"""
+        try:
+            archived = self.chat_archive.find_one({
+                "username": username,
+                "flow_id": flow_id,
+                "session_id": session_id,
+                "segment": segment
+            })
+            if not archived:
+                return []
+            if "message_ids" not in archived:
+                return backfill_segment(self, archived)
+            return unpack_messages(archived.get("compression", "zlib"), archived["data"])
+        except Exception as e:
+            log.error(f"Ошибка при чтении архива истории: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+            return []
+    
+    def delete_archive(self, username: str, flow_id: str, session_id: Optional[str] = None):
+        """Удаление архива сессии (или всех сессий помощника)"""
+        query = {"username": username, "flow_id": flow_id}
+        if session_id:
+            query["session_id"] = session_id
+        try:
+            self.chat_archive.delete_many(query)
+        except Exception as e:
+            log.error(f"Ошибка при удалении архива истории: {str(e)}", extra={"user": username, "flow": flow_id, "session": session_id})
+    
     def cache_set(self, key: str, value: any, expire: int = 300):
         """Сохранение данных в кэш"""
         try:
-            self.redis_client.setex(key, expire, json.dumps(value, default=str))
+            self.redis_client.setex(key, expire, self.codec.encode(value))
             return True
         except Exception as e:
-            print(f"Ошибка при сохранении в кэш: {str(e)}")
+            log.warning(f"Ошибка при сохранении в кэш: {str(e)}")
             return False
     
     def cache_get(self, key: str) -> any:
         """Получение данных из кэша"""
         try:
             data = self.redis_client.get(key)
-            return json.loads(data) if data else None
+            metrics.cache_result("kv_redis", data is not None)
+            return self.codec.decode(data)
         except Exception as e:
-            print(f"Ошибка при получении из кэша: {str(e)}")
+            log.warning(f"Ошибка при получении из кэша: {str(e)}")
             return None
     
     def clear_user_cache(self, username: str):
         """Очистка всего кэша пользователя"""
         try:
             # Удаляем кэш пользователя
-            self.redis_client.delete(f"user:{username}")
+            self.invalidate_user(username)
             
             # Удаляем кэш истории чатов
             pattern = f"chat_history:{username}:*"
@@ -198,19 +882,53 @@ class DatabaseManager:
             
             return True
         except Exception as e:
-            print(f"Ошибка при очистке кэша: {str(e)}")
+            log.error(f"Ошибка при очистке кэша: {str(e)}", extra={"user": username})
             return False
     
+    def get_pool_stats(self) -> Dict:
+        """Состояние пулов соединений MongoDB и Redis для мониторинга"""
+        mongo_stats = self.mongo_pool_listener.snapshot()
+        if self.backend == "mongo":
+            mongo_stats["max_pool_size"] = self.mongo_client.options.pool_options.max_pool_size
+            mongo_stats["min_pool_size"] = self.mongo_client.options.pool_options.min_pool_size
+        
+        redis_stats = {
+            "max_connections": self.redis_pool.max_connections,
+            "created_connections": getattr(self.redis_pool, "_created_connections", 0),
+            "available_connections": len(getattr(self.redis_pool, "_available_connections", [])),
+            "in_use_connections": len(getattr(self.redis_pool, "_in_use_connections", []))
+        }
+        
+        return {"mongodb": mongo_stats, "redis": redis_stats}
+    
     def __del__(self):
         """Закрытие соединений при удалении объекта"""
         try:
+            if self._invalidation_thread is not None:
+                self._invalidation_thread.stop()
             self.mongo_client.close()
-            self.redis_client.close()
+            self.redis_pool.disconnect()
         except:
             pass
 
+# Время и исключения публичных операций (метрики db_operation_*)
+metrics.instrument_methods(DatabaseManager, "db_operation", [
+    "get_user", "find_username_by_token", "invalidate_user", "update_user",
+    "get_chat_history", "get_available_sessions", "save_chat_history", "append_messages",
+    "index_messages", "search_sessions", "delete_message", "edit_message",
+    "set_message_translation", "forget_history",
+    "get_archived_segment_count", "load_archived_segment", "delete_archive",
+    "cache_set", "cache_get", "clear_user_cache",
+])
+
 def get_database() -> DatabaseManager:
-    """Получение единственного экземпляра DatabaseManager"""
-    if not DatabaseManager._instance:
-        DatabaseManager._instance = DatabaseManager()
+    """Получение единственного экземпляра DatabaseManager.
+    
+    Сессии Streamlit выполняются в отдельных потоках, поэтому создание
+    защищено блокировкой: клиенты и индексы создаются один раз на процесс.
+    """
+    if DatabaseManager._instance is None:
+        with _instance_lock:
+            if DatabaseManager._instance is None:
+                DatabaseManager._instance = DatabaseManager()
     return DatabaseManager._instance 
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""Постоянные идентификаторы сообщений.
+
+Идентификатор (message_id) назначается при записи сообщения и больше не
+меняется, поэтому удаление и редактирование затрагивают одно сообщение:
+$pull и позиционное обновление "messages.$" в документе chat_history или
+один сегмент архива. Раньше сообщения различались по MD5 от роли и текста,
+который совпадает у одинаковых сообщений.
+
+Сообщения, записанные до появления message_id, получают его при первом
+чтении истории. Это же касается MD5-хэшей, которые страница поиска
+раньше сохраняла в message_id. Всю базу можно обработать сразу:
+    python -m utils.database.message_ids
+"""
+import argparse
+import re
+import uuid
+from typing import Dict, List
+
+# MD5 из get_message_hash: одинаков у одинаковых сообщений, заменяется
+LEGACY_HASH_RE = re.compile(r"^[0-9a-f]{32}$")
+BACKFILL_ATTEMPTS = 3  # попыток записи, если документ меняется одновременно
+
+
+def new_message_id() -> str:
+    return str(uuid.uuid4())
+
+
+def has_stable_id(message: Dict) -> bool:
+    message_id = message.get("message_id")
+    return bool(message_id) and not LEGACY_HASH_RE.match(message_id)
+
+
+def assign_message_ids(messages: List[Dict]) -> bool:
+    """Назначает message_id сообщениям без него; True, если что-то изменилось"""
+    changed = False
+    for message in messages:
+        if not has_stable_id(message):
+            message["message_id"] = new_message_id()
+            changed = True
+    return changed
+
+
+def backfill_history(db, history: Dict) -> List[Dict]:
+    """Идентификаторы для сообщений документа chat_history.
+
+    Документ перезаписывается, только если не менялся с момента чтения.
+    При конфликте он читается заново: возвращаются только сохраненные
+    идентификаторы, иначе удаление и редактирование по ним не найдут
+    сообщение. Если записать так и не удалось, сообщения возвращаются без
+    новых идентификаторов и получат их при следующем чтении.
+    """
+    for _ in range(BACKFILL_ATTEMPTS):
+        messages = history.get("messages", [])
+        if not assign_message_ids(messages):
+            return messages
+        result = db.chat_history.update_one(
+            {"_id": history["_id"], "updated_at": history.get("updated_at")},
+            {"$set": {"messages": messages}}
+        )
+        if result.matched_count:
+            return messages
+        history = db.chat_history.find_one({"_id": history["_id"]})
+        if history is None:
+            return []
+    return history.get("messages", [])
+
+
+def backfill_segment(db, segment: Dict) -> List[Dict]:
+    """Идентификаторы для сообщений сегмента архива (как в backfill_history)"""
+    from utils.database.archive import pack_messages, unpack_messages
+
+    for _ in range(BACKFILL_ATTEMPTS):
+        messages = unpack_messages(segment.get("compression", "zlib"), segment["data"])
+        if not assign_message_ids(messages) and "message_ids" in segment:
+            return messages
+        compression, data = pack_messages(messages)
+        result = db.chat_archive.update_one(
+            {"_id": segment["_id"], "data": segment["data"]},
+            {"$set": {
+                "compression": compression,
+                "data": data,
+                "message_ids": [message["message_id"] for message in messages]
+            }}
+        )
+        if result.matched_count:
+            return messages
+        segment = db.chat_archive.find_one({"_id": segment["_id"]})
+        if segment is None:
+            return []
+    return unpack_messages(segment.get("compression", "zlib"), segment["data"])
+
+
+def run_backfill(db) -> Dict:
+    """Назначение идентификаторов во всей истории и архиве"""
+    stats = {"histories": 0, "segments": 0}
+    histories = db.chat_history.find(
+        {"$or": [
+            {"messages": {"$elemMatch": {"message_id": {"$exists": False}}}},
+            {"messages.message_id": {"$regex": LEGACY_HASH_RE.pattern}}
+        ]},
+        {"_id": 1},
+        batch_size=100
+    )
+    for candidate in histories:
+        history = db.chat_history.find_one({"_id": candidate["_id"]})
+        if history:
+            backfill_history(db, history)
+            stats["histories"] += 1
+
+    for candidate in db.chat_archive.find({"message_ids": {"$exists": False}}, {"_id": 1}, batch_size=10):
+        segment = db.chat_archive.find_one({"_id": candidate["_id"]})
+        if segment:
+            backfill_segment(db, segment)
+            stats["segments"] += 1
+    return stats
+
+
+def main():
+    argparse.ArgumentParser(description="Назначение message_id существующим сообщениям").parse_args()
+
+    from utils.database.database_manager import get_database
+    stats = run_backfill(get_database())
+    print(f"Обработано историй: {stats['histories']}, сегментов архива: {stats['segments']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""Экспорт и импорт истории чатов в gzip NDJSON.
+
+Каждая строка файла — одна запись в Extended JSON (bson.json_util),
+поэтому datetime, ObjectId и двоичные данные переносятся без потерь:
+
+    {"type": "header", "version": 1, ...}
+    {"type": "user", "doc": {...}}             только при экспорте аккаунта
+    {"type": "session", "doc": {...}}
+    {"type": "history", "doc": {...}}          документ chat_history без messages
+    {"type": "archive", "doc": {...}}          сжатый сегмент архива как есть
+    {"type": "message", "key": {...}, "message": {...}}
+
+Сообщения читаются из MongoDB курсором ($unwind) с ограниченным размером
+пакета, а при импорте записываются пакетами через bulk_write, поэтому
+расход памяти не зависит от длины истории. Поисковый индекс не
+экспортируется и перестраивается после импорта.
+
+Со страниц файл скачивается через HTTP API (GET /v1/exports/<ссылка>):
+страница выдает одноразовую ссылку (create_export_link), а API сжимает
+записи на лету (iter_gzip_chunks), не собирая файл в памяти.
+
+Запуск:
+    python -m utils.database.transfer export --user имя -o user.ndjson.gz
+    python -m utils.database.transfer export --user имя --flow ID --session ID -o chat.ndjson.gz
+    python -m utils.database.transfer import user.ndjson.gz
+"""
+import argparse
+import gzip
+import io
+import json
+import secrets
+import zlib
+from datetime import datetime
+from typing import Dict, IO, Iterable, Iterator, Optional
+
+from bson import json_util
+from pymongo import ReplaceOne, UpdateOne
+
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+FORMAT_VERSION = 1
+CURSOR_BATCH_SIZE = 500  # документов за одно обращение к MongoDB
+WRITE_BATCH_SIZE = 500  # операций в одном bulk_write
+MESSAGE_BATCH_SIZE = 1000  # сообщений в одной операции $push
+GZIP_CHUNK_SIZE = 64 * 1024  # байт несжатых данных между выдачами сжатого блока
+EXPORT_LINK_TTL = 300  # секунд действия ссылки на скачивание
+
+_JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+
+def _session_key(doc: Dict) -> Dict:
+    return {
+        "username": doc["username"],
+        "flow_id": doc["flow_id"],
+        "session_id": doc["session_id"]
+    }
+
+
+def _without_id(doc: Dict) -> Dict:
+    # _id не переносится: в другой базе документ получает свой
+    doc.pop("_id", None)
+    return doc
+
+
+def iter_records(db, username: str, flow_id: Optional[str] = None, session_id: Optional[str] = None,
+                 include_account: bool = True) -> Iterator[Dict]:
+    """Записи экспорта пользователя, помощника или одной сессии"""
+    query = {"username": username}
+    if flow_id:
+        query["flow_id"] = flow_id
+    if session_id:
+        query["session_id"] = session_id
+
+    yield {
+        "type": "header",
+        "version": FORMAT_VERSION,
+        "exported_at": datetime.now(),
+        "scope": query
+    }
+
+    if include_account and not flow_id and not session_id:
+        user = db.users.find_one({"username": username})
+        if user:
+            yield {"type": "user", "doc": _without_id(user)}
+
+    for session in db.chat_sessions.find(query, batch_size=CURSOR_BATCH_SIZE):
+        yield {"type": "session", "doc": _without_id(session)}
+
+    histories = db.chat_history.find(query, {"messages": 0}, batch_size=CURSOR_BATCH_SIZE)
+    for history in histories:
+        history_id = history["_id"]
+        key = _session_key(history)
+        yield {"type": "history", "doc": _without_id(history)}
+
+        segments = db.chat_archive.find(key, batch_size=1).sort("segment", 1)
+        for segment in segments:
+            yield {"type": "archive", "doc": _without_id(segment)}
+
+        messages = db.chat_history.aggregate(
+            [
+                {"$match": {"_id": history_id}},
+                {"$unwind": "$messages"},
+                {"$replaceRoot": {"newRoot": "$messages"}}
+            ],
+            batchSize=CURSOR_BATCH_SIZE
+        )
+        for message in messages:
+            yield {"type": "message", "key": key, "message": message}
+
+
+def write_records(records: Iterable[Dict], fileobj: IO[bytes]) -> int:
+    """Запись NDJSON в gzip-поток; возвращает число записей"""
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as archive:
+        for record in records:
+            archive.write(json_util.dumps(record, json_options=_JSON_OPTIONS).encode("utf-8"))
+            archive.write(b"\n")
+            count += 1
+    return count
+
+
+def read_records(fileobj: IO[bytes]) -> Iterator[Dict]:
+    """Построчное чтение gzip NDJSON"""
+    with gzip.GzipFile(fileobj=fileobj, mode="rb") as archive:
+        for line in io.TextIOWrapper(archive, encoding="utf-8"):
+            if line.strip():
+                yield json_util.loads(line)
+
+
+def iter_gzip_chunks(records: Iterable[Dict]) -> Iterator[bytes]:
+    """gzip NDJSON блоками по мере чтения записей (для потокового ответа HTTP)"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    pending = []
+    pending_size = 0
+    for record in records:
+        line = json_util.dumps(record, json_options=_JSON_OPTIONS).encode("utf-8") + b"\n"
+        pending.append(line)
+        pending_size += len(line)
+        if pending_size >= GZIP_CHUNK_SIZE:
+            chunk = compressor.compress(b"".join(pending))
+            pending, pending_size = [], 0
+            if chunk:
+                yield chunk
+    yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+
+def create_export_link(db, username: str, flow_id: Optional[str] = None, session_id: Optional[str] = None,
+                       include_account: bool = False) -> str:
+    """Одноразовая ссылка на скачивание экспорта через API; возвращает ее код"""
+    code = secrets.token_urlsafe(24)
+    scope = {"username": username, "flow_id": flow_id, "session_id": session_id,
+             "include_account": include_account}
+    db.redis_client.setex(f"export_link:{code}", EXPORT_LINK_TTL, json.dumps(scope))
+    return code
+
+
+def export_link_url(code: str) -> Optional[str]:
+    """Адрес ссылки на скачивание или None, если API не опубликован ([api] public_url)"""
+    import streamlit as st
+    try:
+        public_url = st.secrets["api"].get("public_url", "")
+    except (KeyError, FileNotFoundError):
+        public_url = ""
+    return f"{public_url.rstrip('/')}/v1/exports/{code}" if public_url else None
+
+
+def take_export_link(db, code: str) -> Optional[Dict]:
+    """Параметры экспорта по коду ссылки; ссылка после этого недействительна"""
+    key = f"export_link:{code}"
+    pipe = db.redis_client.pipeline()
+    pipe.get(key)
+    pipe.delete(key)
+    scope, _ = pipe.execute()
+    return json.loads(scope) if scope else None
+
+
+class _BulkWriter:
+    """Накопление операций и запись пакетами"""
+
+    def __init__(self, collection, ordered: bool):
+        self.collection = collection
+        self.ordered = ordered
+        self.operations = []
+        self.written = 0
+
+    def add(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.operations:
+            self.collection.bulk_write(self.operations, ordered=self.ordered)
+            self.written += len(self.operations)
+            self.operations = []
+
+
+def import_records(db, records: Iterable[Dict]) -> Dict:
+    """Импорт записей экспорта.
+
+    Пользователи, сессии, история и сегменты архива заменяются целиком,
+    сообщения добавляются пакетами $push в порядке файла. После импорта
+    сбрасываются кэши и перестраивается поисковый индекс.
+    """
+    users = _BulkWriter(db.users, ordered=False)
+    sessions = _BulkWriter(db.chat_sessions, ordered=False)
+    archive = _BulkWriter(db.chat_archive, ordered=False)
+    # Порядок важен: замена документа истории, затем добавление сообщений
+    history = _BulkWriter(db.chat_history, ordered=True)
+
+    stats = {"users": 0, "sessions": 0, "histories": 0, "archive_segments": 0, "messages": 0}
+    usernames = set()
+    pending_key = None
+    pending_messages = []
+
+    def flush_messages():
+        if pending_messages:
+            history.add(UpdateOne(pending_key, {"$push": {"messages": {"$each": list(pending_messages)}}}))
+            pending_messages.clear()
+
+    for record in records:
+        record_type = record.get("type")
+        if record_type == "header":
+            if record.get("version") != FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемая версия файла экспорта: {record.get('version')}")
+        elif record_type == "user":
+            doc = _without_id(record["doc"])
+            users.add(ReplaceOne({"username": doc["username"]}, doc, upsert=True))
+            usernames.add(doc["username"])
+            stats["users"] += 1
+        elif record_type == "session":
+            doc = _without_id(record["doc"])
+            sessions.add(ReplaceOne(_session_key(doc), doc, upsert=True))
+            usernames.add(doc["username"])
+            stats["sessions"] += 1
+        elif record_type == "history":
+            flush_messages()
+            doc = _without_id(record["doc"])
+            doc["messages"] = []
+            history.add(ReplaceOne(_session_key(doc), doc, upsert=True))
+            usernames.add(doc["username"])
+            stats["histories"] += 1
+        elif record_type == "archive":
+            doc = _without_id(record["doc"])
+            archive.add(ReplaceOne({**_session_key(doc), "segment": doc["segment"]}, doc, upsert=True))
+            stats["archive_segments"] += 1
+        elif record_type == "message":
+            if record["key"] != pending_key or len(pending_messages) >= MESSAGE_BATCH_SIZE:
+                flush_messages()
+                pending_key = record["key"]
+            pending_messages.append(record["message"])
+            stats["messages"] += 1
+        else:
+            raise ValueError(f"Неизвестный тип записи: {record_type}")
+
+    flush_messages()
+    for writer in (users, sessions, archive, history):
+        writer.flush()
+
+    from utils.search import reindex
+    for username in usernames:
+        db.invalidate_user(username)
+        try:
+            keys = list(db.redis_client.scan_iter(f"chat_history:{username}:*"))
+            if keys:
+                db.redis_client.delete(*keys)
+        except Exception as e:
+            log.error(f"Ошибка при очистке кэша истории: {str(e)}", extra={"user": username})
+        reindex(db, username)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Экспорт и импорт истории чатов (gzip NDJSON)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="выгрузить пользователя или сессию")
+    export_parser.add_argument("--user", required=True)
+    export_parser.add_argument("--flow", default=None, help="только один помощник")
+    export_parser.add_argument("--session", default=None, help="только одна сессия (вместе с --flow)")
+    export_parser.add_argument("--no-account", action="store_true", help="не выгружать документ пользователя")
+    export_parser.add_argument("-o", "--output", required=True)
+
+    import_parser = commands.add_parser("import", help="загрузить файл экспорта")
+    import_parser.add_argument("path")
+
+    args = parser.parse_args()
+
+    from utils.database.database_manager import get_database
+    db = get_database()
+
+    if args.command == "export":
+        if args.session and not args.flow:
+            parser.error("--session требует --flow")
+        records = iter_records(db, args.user, args.flow, args.session, include_account=not args.no_account)
+        with open(args.output, "wb") as f:
+            count = write_records(records, f)
+        print(f"Записей выгружено: {count}")
+    else:
+        with open(args.path, "rb") as f:
+            stats = import_records(db, read_records(f))
+        print(
+            f"Пользователей: {stats['users']}, сессий: {stats['sessions']}, "
+            f"историй: {stats['histories']}, сегментов архива: {stats['archive_segments']}, "
+            f"сообщений: {stats['messages']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
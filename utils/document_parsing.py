@@ -0,0 +1,87 @@
+"""Извлечение текста из документов и разбиение на фрагменты.
+
+Функции выполняются в процессах пула utils/documents.py, поэтому модуль
+не импортирует streamlit и зависит только от библиотек разбора:
+pypdf (PDF) и python-docx (DOCX) подключаются при первом обращении и
+нужны, только если загружаются файлы этих типов.
+"""
+import io
+from typing import List
+
+TEXT_TYPES = {"text/plain", "text/markdown", "text/csv"}
+PDF_TYPE = "application/pdf"
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class DocumentError(ValueError):
+    """Документ не удалось разобрать"""
+
+
+def document_type(name: str, mime: str) -> str:
+    """Тип документа по MIME или расширению: pdf, docx, text или пустая строка"""
+    extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    if mime == PDF_TYPE or extension == "pdf":
+        return "pdf"
+    if mime == DOCX_TYPE or extension == "docx":
+        return "docx"
+    if mime in TEXT_TYPES or extension in ("txt", "md", "csv"):
+        return "text"
+    return ""
+
+
+def _decode_text(data: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def _pdf_text(data: bytes) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise DocumentError("Для PDF установите пакет pypdf")
+    reader = PdfReader(io.BytesIO(data))
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _docx_text(data: bytes) -> str:
+    try:
+        import docx
+    except ImportError:
+        raise DocumentError("Для DOCX установите пакет python-docx")
+    document = docx.Document(io.BytesIO(data))
+    return "\n".join(paragraph.text for paragraph in document.paragraphs)
+
+
+def extract_text(name: str, mime: str, data: bytes) -> str:
+    kind = document_type(name, mime)
+    try:
+        if kind == "pdf":
+            return _pdf_text(data)
+        if kind == "docx":
+            return _docx_text(data)
+        if kind == "text":
+            return _decode_text(data)
+    except DocumentError:
+        raise
+    except Exception as e:
+        raise DocumentError(f"Не удалось прочитать {name}: {str(e)}")
+    raise DocumentError(f"Формат файла {name} не поддерживается")
+
+
+def split_text(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [chunk for chunk in splitter.split_text(text) if chunk.strip()]
+
+
+def parse_document(name: str, mime: str, data: bytes, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Фрагменты текста документа (выполняется в процессе пула)"""
+    text = extract_text(name, mime, data)
+    if not text.strip():
+        raise DocumentError(f"В файле {name} нет текста")
+    return split_text(text, chunk_size, chunk_overlap)
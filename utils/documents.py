@@ -0,0 +1,322 @@
+"""Документы пользователя, на которые опираются ответы помощников.
+
+Файлы PDF, DOCX и TXT, загруженные на странице помощников, разбираются и
+делятся на фрагменты (langchain-text-splitters) в пуле процессов, чтобы
+разбор больших файлов не занимал поток скрипта и GIL. Фрагменты хранятся
+в локальном файле SQLite пользователя с полнотекстовым индексом FTS5.
+Перед отправкой вопроса во Flowise к нему добавляются самые подходящие
+фрагменты (augment_prompt). Служебные слова вопроса не учитываются, а
+фрагмент считается подходящим, только если в нем есть не меньше
+min_match_ratio значимых слов вопроса: иначе к любому вопросу
+добавлялись бы фрагменты любых документов.
+
+Повторная загрузка того же файла определяется по SHA-256 содержимого и не
+запускает ни разбор, ни индексирование.
+
+Настройки в secrets.toml:
+    [documents]
+    directory = "chat_history/documents"
+    chunk_size = 1000          # символов во фрагменте
+    chunk_overlap = 150
+    workers = 2                # процессов разбора
+    top_k = 4                  # фрагментов в вопросе
+    max_context_chars = 4000
+    min_match_ratio = 0.5      # доля значимых слов вопроса во фрагменте
+"""
+import hashlib
+import math
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+import streamlit as st
+
+from utils import metrics
+from utils.document_parsing import DocumentError, document_type, parse_document
+from utils.log import get_logger
+from utils.stopwords import NEGATIONS, STOPWORDS
+
+log = get_logger(__name__)
+
+DOCUMENTS_DEFAULTS = {
+    "directory": os.path.join("chat_history", "documents"),
+    "chunk_size": 1000,
+    "chunk_overlap": 150,
+    "workers": 2,
+    "top_k": 4,
+    "max_context_chars": 4000,
+    "min_match_ratio": 0.5
+}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+CANDIDATES_PER_RESULT = 5  # фрагментов из индекса на каждый возвращаемый
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    digest TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    mime TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+    content, digest UNINDEXED, position UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+_stores: Dict[str, "_DocumentStore"] = {}
+_stores_lock = threading.Lock()
+
+
+def _documents_setting(key: str):
+    try:
+        return st.secrets["documents"].get(key, DOCUMENTS_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return DOCUMENTS_DEFAULTS[key]
+
+
+class _DocumentStore:
+    """Файл SQLite документов одного пользователя, соединение на поток"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def has_document(self, digest: str) -> bool:
+        return self.connection().execute(
+            "SELECT 1 FROM documents WHERE digest = ?", (digest,)
+        ).fetchone() is not None
+
+    def add_document(self, digest: str, name: str, mime: str, size: int, chunks: List[str]):
+        with self.connection() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO documents (digest, name, mime, size, chunk_count, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, name, mime, size, len(chunks), datetime.now().isoformat())
+            ).rowcount
+            # Тот же файл мог проиндексировать другой сеанс пользователя
+            if inserted:
+                conn.executemany(
+                    "INSERT INTO chunks (content, digest, position) VALUES (?, ?, ?)",
+                    [(chunk, digest, position) for position, chunk in enumerate(chunks)]
+                )
+
+
+def _store_path(username: str) -> str:
+    # Имя файла не зависит от символов в имени пользователя
+    name = hashlib.sha256(username.encode("utf-8")).hexdigest()[:32]
+    return os.path.abspath(os.path.join(_documents_setting("directory"), f"{name}.sqlite3"))
+
+
+def _get_store(username: str, create: bool = True) -> Optional[_DocumentStore]:
+    path = _store_path(username)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store = _stores[path] = _DocumentStore(path)
+        return store
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn: процесс Streamlit многопоточный, fork мог бы
+                # скопировать захваченные другими потоками блокировки
+                _pool = ProcessPoolExecutor(
+                    max_workers=int(_documents_setting("workers")),
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _pool
+
+
+def is_document(file) -> bool:
+    """Файл индексируется как документ (иначе отправляется вложением)"""
+    return bool(document_type(getattr(file, "name", ""), getattr(file, "type", None) or ""))
+
+
+def file_digest(file) -> str:
+    """SHA-256 содержимого файла, прочитанного частями"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def ingest_files(username: str, files: Iterable,
+                 progress: Optional[Callable[[int, int, str], None]] = None) -> List[Dict]:
+    """Разбор и индексирование документов пользователя.
+
+    progress(готово, всего, имя файла) вызывается в текущем потоке по мере
+    завершения разбора. Возвращает по записи на файл со статусом indexed,
+    duplicate или error.
+    """
+    store = _get_store(username)
+    chunk_size = int(_documents_setting("chunk_size"))
+    chunk_overlap = int(_documents_setting("chunk_overlap"))
+    started = time.perf_counter()
+
+    results = []
+    pending = {}
+    seen = set()
+    for file in files:
+        name = getattr(file, "name", "file")
+        mime = getattr(file, "type", None) or ""
+        digest = file_digest(file)
+        if digest in seen or store.has_document(digest):
+            metrics.inc("documents_ingested_total", result="duplicate")
+            results.append({"name": name, "status": "duplicate"})
+            continue
+        seen.add(digest)
+        data = file.read()
+        future = _get_pool().submit(parse_document, name, mime, data, chunk_size, chunk_overlap)
+        pending[future] = (name, mime, digest, len(data))
+
+    if progress is not None and pending:
+        progress(0, len(pending), "")
+    for done, future in enumerate(as_completed(pending), 1):
+        name, mime, digest, size = pending[future]
+        try:
+            chunks = future.result()
+            store.add_document(digest, name, mime, size, chunks)
+        except DocumentError as e:
+            metrics.inc("documents_ingested_total", result="error")
+            results.append({"name": name, "status": "error", "error": str(e)})
+        except Exception as e:
+            log.error(f"Ошибка при индексировании {name}: {str(e)}", extra={"user": username})
+            metrics.inc("documents_ingested_total", result="error")
+            results.append({"name": name, "status": "error", "error": f"Не удалось обработать {name}"})
+        else:
+            metrics.inc("documents_ingested_total", result="indexed")
+            results.append({"name": name, "status": "indexed", "chunks": len(chunks)})
+        if progress is not None:
+            progress(done, len(pending), name)
+
+    if pending:
+        log.info(f"Проиндексировано документов: {len(pending)}", extra={
+            "user": username, "duration_ms": round((time.perf_counter() - started) * 1000)
+        })
+    return results
+
+
+def list_documents(username: str) -> List[Dict]:
+    store = _get_store(username, create=False)
+    if store is None:
+        return []
+    rows = store.connection().execute(
+        "SELECT digest, name, size, chunk_count, created_at FROM documents ORDER BY created_at"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def delete_documents(username: str, digest: Optional[str] = None) -> int:
+    """Удаление документа (или всех документов пользователя); возвращает количество"""
+    store = _get_store(username, create=False)
+    if store is None:
+        return 0
+    with store.connection() as conn:
+        if digest is None:
+            conn.execute("DELETE FROM chunks")
+            return conn.execute("DELETE FROM documents").rowcount
+        conn.execute("DELETE FROM chunks WHERE digest = ?", (digest,))
+        return conn.execute("DELETE FROM documents WHERE digest = ?", (digest,)).rowcount
+
+
+def _query_stems(query: str) -> List[str]:
+    # Основы значимых слов — как в поиске по истории (utils/search.py)
+    stems = []
+    for word in _WORD_RE.findall(query.lower()):
+        # Служебные слова как префиксы FTS5 совпали бы почти с каждым фрагментом
+        if len(word) < 3 or word in STOPWORDS or word in NEGATIONS:
+            continue
+        stem = word[:max(4, len(word) - 2)] if len(word) > 4 else word
+        if stem not in stems:
+            stems.append(stem)
+    return stems
+
+
+def search_chunks(username: str, query: str, limit: Optional[int] = None) -> List[Dict]:
+    """Фрагменты документов, подходящие к запросу (по убыванию релевантности).
+
+    Кандидаты отбираются по bm25 с любой основой запроса, затем остаются
+    только фрагменты, где встречается не меньше min_match_ratio основ.
+    """
+    store = _get_store(username, create=False)
+    stems = _query_stems(query)
+    if store is None or not stems:
+        return []
+    limit = int(limit or _documents_setting("top_k"))
+    required = max(1, math.ceil(len(stems) * float(_documents_setting("min_match_ratio"))))
+    # Любая основа слова запроса как префикс; кавычки экранируют синтаксис FTS5
+    match = " OR ".join('"' + stem.replace('"', '""') + '"*' for stem in stems)
+    rows = store.connection().execute(
+        "SELECT chunks.content, documents.name FROM chunks "
+        "JOIN documents ON documents.digest = chunks.digest "
+        "WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+        (match, limit * CANDIDATES_PER_RESULT)
+    ).fetchall()
+
+    results = []
+    for row in rows:
+        words = set(_WORD_RE.findall(row["content"].lower()))
+        matched = sum(1 for stem in stems if any(word.startswith(stem) for word in words))
+        if matched >= required:
+            results.append({"name": row["name"], "content": row["content"]})
+            if len(results) >= limit:
+                break
+    return results
+
+
+def augment_prompt(username: str, question: str) -> str:
+    """Вопрос с подходящими фрагментами документов пользователя"""
+    try:
+        chunks = search_chunks(username, question)
+    except sqlite3.Error as e:
+        log.error(f"Ошибка поиска по документам: {str(e)}", extra={"user": username})
+        return question
+    if not chunks:
+        return question
+
+    budget = int(_documents_setting("max_context_chars"))
+    parts = []
+    for chunk in chunks:
+        text = chunk["content"][:budget]
+        if not text:
+            break
+        parts.append(f"[{chunk['name']}]\n{text}")
+        budget -= len(text)
+    context = "\n\n".join(parts)
+    return (
+        "Фрагменты документов пользователя (используй их, если они относятся к вопросу):\n\n"
+        f"{context}\n\nВопрос: {question}"
+    )
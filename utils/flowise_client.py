@@ -0,0 +1,497 @@
+"""Запросы к Flowise.
+
+Запросы выполняются напрямую через requests (общая сессия с пулом
+соединений) по тому же протоколу, что и пакет flowise:
+POST /api/v1/prediction/<id> отвечает одним JSON или, при streaming=True и
+поддержке потока чат-потоком, событиями SSE (строки "data: {...}" вида
+{"event": "token", "data": "..."}). Вид ответа определяется по Content-Type,
+поэтому отдельный запрос GET /chatflows-streaming не нужен. Вопрос с
+вложениями отправляется как multipart/form-data (поля question, chatId,
+sessionId, streaming и файлы в поле files), см. utils/attachments.py.
+
+У каждого вызова есть срок (deadline). Ошибки, при которых запрос заведомо
+не обработан (соединение не установлено, 429/502/503/504), повторяются с
+паузой со случайным разбросом; обрыв соединения после отправки запроса не
+повторяется. Предохранитель (circuit breaker), общий для всех
+сессий процесса, после серии сбоев отклоняет вызовы сразу
+(FlowiseUnavailable), а по истечении паузы пропускает один пробный запрос.
+
+Вызов можно отменить из другого потока (threading.Event в параметре
+cancel): повторы прекращаются, вызывающий получает FlowiseCancelled, не
+дожидаясь ни первого байта, ни следующей части ответа. Соединение
+открытого ответа закрывается сразу, ответ, пришедший после отмены, —
+как только придет; Flowise прекращает генерацию, когда клиент отключается.
+
+Настройки в secrets.toml:
+    [flowise]
+    base_url = "https://flowise.example.com"   # можно с суффиксом /api/v1/prediction
+    api_key = "..."                            # необязательно
+    simple_chat_id = "..."                     # чат-поток бесплатного чата
+    search_chat_id = "..."                     # чат-поток поискового отдела
+    connect_timeout = 3.05                     # секунд
+    read_timeout = 60                          # секунд без данных от сервера
+    deadline = 120                             # секунд на весь вызов с повторами
+    retries = 2
+    breaker_failures = 5                       # сбоев подряд до размыкания
+    breaker_reset = 30                         # секунд до пробного запроса
+"""
+import json
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from utils import metrics
+from utils.attachments import Attachment, MultipartBody
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+FLOWISE_DEFAULTS = {
+    "api_key": None,
+    "connect_timeout": 3.05,
+    "read_timeout": 60,
+    "deadline": 120,
+    "retries": 2,
+    "breaker_failures": 5,
+    "breaker_reset": 30,
+    "pool_size": 50
+}
+
+RETRY_STATUSES = {429, 502, 503, 504}
+BACKOFF_BASE = 0.5  # секунд
+BACKOFF_MAX = 4.0
+CANCEL_POLL = 0.1  # секунд между проверками отмены во время ожидания ответа
+
+_session = None
+_session_lock = threading.Lock()
+_breakers: Dict[str, "CircuitBreaker"] = {}
+_breakers_lock = threading.Lock()
+
+
+class FlowiseError(RuntimeError):
+    """Ошибка запроса к Flowise"""
+
+
+class FlowiseTimeout(FlowiseError):
+    """Flowise не ответил в срок"""
+
+
+class FlowiseUnavailable(FlowiseError):
+    """Flowise недоступен: предохранитель разомкнут"""
+
+
+class FlowiseCancelled(FlowiseError):
+    """Запрос отменен вызывающим"""
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после серии сбоев -> half_open -> closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Секунд до пробного запроса (0, если вызовы разрешены)"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise FlowiseUnavailable(self._unavailable_message())
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                # В полуоткрытом состоянии проходит один пробный запрос
+                if self._probe_in_flight:
+                    raise FlowiseUnavailable(self._unavailable_message())
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info("Flowise снова доступен")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Снятие резерва пробного запроса, прерванного не ответом сервера"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    log.warning(f"Flowise недоступен, запросы приостановлены на {self.reset_timeout} с")
+                    metrics.inc("flowise_breaker_open_total")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def _unavailable_message(self) -> str:
+        wait = max(1, round(self.opened_at + self.reset_timeout - time.monotonic()))
+        return f"Сервис ответов временно недоступен. Попробуйте еще раз через {wait} с."
+
+
+def describe_error(error: Exception) -> str:
+    """Сообщение об ошибке Flowise для пользователя"""
+    if isinstance(error, FlowiseUnavailable):
+        return str(error)
+    if isinstance(error, FlowiseCancelled):
+        return "Запрос отменен."
+    if isinstance(error, FlowiseTimeout):
+        return "Ассистент не ответил вовремя. Попробуйте еще раз."
+    return "Не удалось получить ответ ассистента. Попробуйте еще раз."
+
+
+def _flowise_setting(key: str):
+    return st.secrets["flowise"].get(key, FLOWISE_DEFAULTS[key])
+
+
+def get_base_url() -> str:
+    return st.secrets["flowise"]["base_url"].replace('/api/v1/prediction', '').rstrip('/')
+
+
+def get_session() -> requests.Session:
+    """Общая сессия requests процесса (пул соединений к Flowise)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                pool_size = int(_flowise_setting("pool_size"))
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_breaker() -> CircuitBreaker:
+    """Предохранитель для текущего адреса Flowise"""
+    base_url = get_base_url()
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(base_url)
+            if breaker is None:
+                breaker = _breakers[base_url] = CircuitBreaker(
+                    int(_flowise_setting("breaker_failures")), float(_flowise_setting("breaker_reset"))
+                )
+    return breaker
+
+
+def _headers() -> Dict[str, str]:
+    api_key = _flowise_setting("api_key")
+    return {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+
+def _payload(chatflow_id: str, question: str, session_id: Optional[str], streaming: bool) -> Dict:
+    return {
+        "chatflowId": chatflow_id,
+        "question": question,
+        "overrideConfig": {"sessionId": session_id} if session_id else None,
+        "chatId": session_id,
+        "streaming": streaming,
+        "history": []
+    }
+
+
+def _form_fields(payload: Dict) -> Dict[str, str]:
+    """Поля формы для запроса с файлами (Flowise читает overrideConfig из полей)"""
+    fields = {"question": payload["question"], "streaming": "true" if payload["streaming"] else "false"}
+    if payload["chatId"]:
+        fields["chatId"] = payload["chatId"]
+        fields["sessionId"] = payload["chatId"]
+    return fields
+
+
+def _backoff(attempt: int) -> float:
+    # Полный случайный разброс: повторы разных сессий не совпадают по времени
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _not_connected(error: requests.exceptions.ConnectionError) -> bool:
+    """Запрос не дошел до Flowise: таймаут или отказ при установке соединения"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests заворачивает MaxRetryError, причина в reason
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _check_cancel(cancel: Optional[threading.Event]):
+    if cancel is not None and cancel.is_set():
+        raise FlowiseCancelled("Запрос к Flowise отменен")
+
+
+def _send(cancel: Optional[threading.Event], url: str, **kwargs) -> requests.Response:
+    """POST через общую сессию.
+
+    С cancel запрос выполняется в отдельном потоке, а вызывающий ждет его
+    вместе с отменой: чат-поток без потоковой передачи молчит до конца
+    генерации, и без этого отмена ждала бы весь ответ. Ответ, пришедший
+    после отмены, закрывается в том же потоке.
+    """
+    session = get_session()
+    if cancel is None:
+        return session.post(url, **kwargs)
+    lock = threading.Lock()
+    done = threading.Event()
+    state = {}
+
+    def run():
+        try:
+            response = session.post(url, **kwargs)
+        except BaseException as e:
+            with lock:
+                state["error"] = e
+                done.set()
+            return
+        with lock:
+            state["response"] = response
+            done.set()
+            abandoned = state.get("abandoned", False)
+        if abandoned:
+            response.close()
+
+    threading.Thread(target=run, name="flowise-request", daemon=True).start()
+    while not done.wait(CANCEL_POLL):
+        with lock:
+            if cancel.is_set() and not done.is_set():
+                state["abandoned"] = True
+                raise FlowiseCancelled("Запрос к Flowise отменен")
+    if "error" in state:
+        raise state["error"]
+    return state["response"]
+
+
+def _shutdown(response: requests.Response):
+    """Разрывает соединение ответа, не закрывая объекты, которые читает другой поток"""
+    # Сокет берется из файла ответа http.client: при "Connection: close"
+    # соединение передает сокет ответу и само его уже не хранит
+    reader = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(reader, "raw", None), "_sock", None)
+    if sock is None:
+        sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is None:
+        return
+    try:
+        # shutdown, в отличие от close, будит поток, заблокированный в recv
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+@contextmanager
+def _shutdown_on_cancel(response: requests.Response, cancel: Optional[threading.Event]):
+    """Пока выполняется блок, отмена сразу разрывает соединение ответа;
+    чтение ответа завершается ошибкой или концом данных"""
+    if cancel is None:
+        yield
+        return
+    finished = threading.Event()
+
+    def watch():
+        while not finished.is_set():
+            if cancel.wait(CANCEL_POLL):
+                if not finished.is_set():
+                    _shutdown(response)
+                return
+
+    threading.Thread(target=watch, name="flowise-cancel", daemon=True).start()
+    try:
+        yield
+    finally:
+        finished.set()
+
+
+def _post(chatflow_id: str, payload: Dict, deadline: float, stream: bool,
+          cancel: Optional[threading.Event] = None, attachments: Optional[List] = None) -> requests.Response:
+    """POST с повторами и предохранителем; возвращает ответ со статусом 2xx"""
+    breaker = get_breaker()
+    url = f"{get_base_url()}/api/v1/prediction/{chatflow_id}"
+    retries = int(_flowise_setting("retries"))
+    connect_timeout = float(_flowise_setting("connect_timeout"))
+    read_timeout = float(_flowise_setting("read_timeout"))
+
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FlowiseTimeout("Flowise не ответил в отведенное время")
+        _check_cancel(cancel)
+        breaker.before_call()
+        retryable = False
+        # Любой выход без record_success/record_failure (ошибка сборки тела,
+        # неожиданное исключение) снимает резерв пробного запроса, иначе
+        # полуоткрытый предохранитель отклонял бы все следующие вызовы
+        try:
+            if attachments:
+                # Тело читается из файлов по мере отправки; для повтора — заново
+                body = MultipartBody(_form_fields(payload), attachments)
+                request_args = {"data": body, "headers": {**_headers(), "Content-Type": body.content_type}}
+            else:
+                request_args = {"json": payload, "headers": _headers()}
+            try:
+                response = _send(
+                    cancel, url, stream=stream, timeout=(min(connect_timeout, remaining), min(read_timeout, remaining)),
+                    **request_args
+                )
+            except requests.exceptions.ConnectionError as e:
+                breaker.record_failure()
+                error = FlowiseError(f"Нет соединения с Flowise: {e}")
+                # Повтор безопасен, только если соединение не установлено; обрыв
+                # после отправки тела (RemoteDisconnected, ProtocolError) запустил
+                # бы генерацию второй раз и задвоил память сессии
+                retryable = _not_connected(e)
+            except requests.exceptions.Timeout as e:
+                # Сервер мог начать обработку: повтор запустил бы генерацию второй раз
+                breaker.record_failure()
+                raise FlowiseTimeout(f"Flowise не ответил в отведенное время: {e}") from e
+            except requests.exceptions.RequestException as e:
+                # Оборванный ответ, неверный адрес и т.п.: без повтора
+                breaker.record_failure()
+                raise FlowiseError(f"Ошибка запроса к Flowise: {e}") from e
+            else:
+                if response.status_code < 400:
+                    breaker.record_success()
+                    return response
+                body = response.text[:200]
+                response.close()
+                if response.status_code >= 500 or response.status_code == 429:
+                    breaker.record_failure()
+                else:
+                    # Ошибка запроса (неверный чат-поток и т.п.) не говорит о сбое сервера
+                    breaker.record_success()
+                error = FlowiseError(f"Flowise ответил {response.status_code}: {body}")
+                retryable = response.status_code in RETRY_STATUSES
+        except BaseException:
+            breaker.release_probe()
+            raise
+
+        if not retryable or attempt >= retries:
+            raise error
+        pause = _backoff(attempt)
+        if time.monotonic() + pause >= deadline:
+            raise error
+        attempt += 1
+        metrics.inc("flowise_retries_total")
+        log.warning(f"Повтор запроса к Flowise ({attempt}/{retries}): {error}")
+        if cancel is not None:
+            cancel.wait(pause)
+        else:
+            time.sleep(pause)
+
+
+def _deadline(timeout: Optional[float]) -> float:
+    return time.monotonic() + (float(_flowise_setting("deadline")) if timeout is None else timeout)
+
+
+def stream_tokens(chatflow_id: str, question: str, session_id: Optional[str] = None,
+                  attachments: Optional[List[Attachment]] = None, timeout: Optional[float] = None,
+                  cancel: Optional[threading.Event] = None) -> Iterator[str]:
+    """Части ответа по мере поступления.
+
+    Если чат-поток не поддерживает потоковую передачу, Flowise отвечает
+    одним JSON, и весь текст приходит одной частью. После cancel.set()
+    соединение закрывается сразу, в том числе посреди чтения ответа.
+    """
+    started = time.perf_counter()
+    deadline = _deadline(timeout)
+    first = True
+    with metrics.timed("flowise_request", mode="stream"):
+        response = _post(chatflow_id, _payload(chatflow_id, question, session_id, True), deadline,
+                         stream=True, cancel=cancel, attachments=attachments)
+        # Выход из with закрывает соединение, в том числе при отмене:
+        # Flowise прекращает генерацию, когда клиент отключается
+        with response, _shutdown_on_cancel(response, cancel):
+            if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                _check_cancel(cancel)
+                try:
+                    text = response.json().get("text")
+                except (requests.exceptions.RequestException, ValueError):
+                    # Соединение разорвано отменой посреди тела ответа
+                    _check_cancel(cancel)
+                    raise
+                _check_cancel(cancel)
+                if text:
+                    metrics.observe("flowise_first_token_seconds", time.perf_counter() - started)
+                    yield text
+                return
+            try:
+                for line in response.iter_lines(chunk_size=None, decode_unicode=False):
+                    _check_cancel(cancel)
+                    if time.monotonic() > deadline:
+                        raise FlowiseTimeout("Flowise не завершил ответ в отведенное время")
+                    if not line or not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip().decode("utf-8")
+                    try:
+                        event = json.loads(data)
+                    except ValueError:
+                        event = {"event": "token", "data": data}
+                    if not isinstance(event, dict):
+                        continue
+                    if event.get("event") == "error":
+                        raise FlowiseError(event.get("data") or "Ошибка Flowise")
+                    text = event.get("data") if event.get("event") == "token" else None
+                    if text:
+                        if first:
+                            metrics.observe("flowise_first_token_seconds", time.perf_counter() - started)
+                            first = False
+                        yield text
+                # Разрыв соединения при отмене может выглядеть как конец потока
+                _check_cancel(cancel)
+            except requests.exceptions.RequestException as e:
+                _check_cancel(cancel)
+                get_breaker().record_failure()
+                raise FlowiseError(f"Поток ответа Flowise прерван: {e}") from e
+
+
+def predict(chatflow_id: str, question: str, session_id: Optional[str] = None,
+            attachments: Optional[List[Attachment]] = None, timeout: Optional[float] = None,
+            cancel: Optional[threading.Event] = None) -> str:
+    """Полный текст ответа.
+
+    С cancel ответ запрашивается потоком (stream_tokens), чтобы отмену можно
+    было применить, не дожидаясь конца генерации.
+    """
+    if cancel is not None:
+        return "".join(stream_tokens(chatflow_id, question, session_id, attachments, timeout, cancel)).strip()
+    deadline = _deadline(timeout)
+    with metrics.timed("flowise_request", mode="predict"):
+        response = _post(chatflow_id, _payload(chatflow_id, question, session_id, False), deadline,
+                         stream=False, attachments=attachments)
+        try:
+            result = response.json()
+        except ValueError:
+            return response.text
+    if isinstance(result, dict):
+        return result.get("text", "") or ""
+    return str(result)
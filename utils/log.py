@@ -0,0 +1,145 @@
+"""Логирование, которое не блокирует потоки сессий.
+
+Записи из потоков страниц кладутся в очередь (QueueHandler), а в stdout их
+пишет один фоновый поток (QueueListener). Если очередь заполнена, запись
+отбрасывается и учитывается в метрике log_dropped_total: поток сессии не
+ждет вывода.
+
+Структурированные поля передаются через extra:
+
+    log = get_logger(__name__)
+    log.error("Ошибка при сохранении истории",
+              extra={"user": username, "flow": flow_id, "session": session_id})
+
+Настройки в secrets.toml:
+
+    [logging]
+    level = "INFO"
+    format = "text"        # или "json" — одна запись JSON на строку
+    queue_size = 10000
+
+    [logging.sample]       # доля записей уровня, которая попадает в лог
+    DEBUG = 0.1
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+
+from utils import metrics
+
+ROOT_LOGGER = "app"
+
+# Поля extra, которые выводятся в записи
+FIELDS = ("user", "flow", "session", "duration_ms")
+
+LOGGING_DEFAULTS = {
+    "level": "INFO",
+    "format": "text",
+    "queue_size": 10000,
+    "sample": {"DEBUG": 0.1}
+}
+
+_configured = False
+_configure_lock = threading.Lock()
+_listener = None
+
+
+def _logging_setting(key: str):
+    import streamlit as st
+    try:
+        return st.secrets["logging"].get(key, LOGGING_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return LOGGING_DEFAULTS[key]
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает заданную долю записей каждого уровня; ошибки считаются в метриках"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {logging.getLevelName(level.upper()): float(rate) for level, rate in rates.items()}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            metrics.inc("log_errors_total", logger=record.name)
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не ждет и не пишет в stderr при заполненной очереди"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_dropped_total")
+
+
+class TextFormatter(logging.Formatter):
+    """Время, уровень, логгер, сообщение и поля вида key=value"""
+
+    def format(self, record):
+        line = (f"{datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')} "
+                f"{record.levelname} {record.name}: {record.getMessage()}")
+        fields = " ".join(f"{name}={getattr(record, name)}" for name in FIELDS if getattr(record, name, None) is not None)
+        if fields:
+            line += f" [{fields}]"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись JSON на строку"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _configure():
+    global _configured, _listener
+    with _configure_lock:
+        if _configured:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(str(_logging_setting("level")).upper())
+        root.propagate = False
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if _logging_setting("format") == "json" else TextFormatter())
+
+        handler = DroppingQueueHandler(queue.Queue(maxsize=int(_logging_setting("queue_size"))))
+        handler.addFilter(SamplingFilter(dict(_logging_setting("sample"))))
+        root.addHandler(handler)
+
+        _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Логгер модуля в иерархии app (настраивается при первом вызове)"""
+    if not _configured:
+        _configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
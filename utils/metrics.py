@@ -0,0 +1,252 @@
+"""Метрики процесса в текстовом формате Prometheus.
+
+Счетчики и гистограммы хранятся в памяти процесса. Страницы запускают
+небольшой HTTP-сервер (FastAPI + uvicorn в фоновом потоке), который отдает
+их по адресу /metrics:
+
+    [metrics]
+    enabled = true        # по умолчанию включено
+    host = "127.0.0.1"
+    port = 9108
+
+Основные метрики:
+    db_operation_seconds{operation}          время операций DatabaseManager
+    db_operation_errors_total{operation}     исключения в этих операциях
+    cache_requests_total{cache,result}       попадания и промахи кэшей (hit/miss)
+    flowise_request_seconds{mode}            запросы к Flowise (predict/stream)
+    flowise_request_errors_total{mode}
+    flowise_first_token_seconds              время до первой части потокового ответа
+    flowise_retries_total                    повторы запросов к Flowise
+    flowise_breaker_open_total               размыкания предохранителя Flowise
+    attachment_resize_seconds                уменьшение и перекодирование изображений-вложений
+    documents_ingested_total{result}         загруженные документы (indexed/duplicate/error)
+    translation_seconds                      translate_text
+    translation_errors_total{stage}
+    reply_translations_total{result}         фоновый автоперевод ответов (translated/skipped/failed)
+    log_errors_total{logger}                 записи журнала уровня ERROR и выше
+    log_dropped_total                        записи, отброшенные при заполненной очереди
+    chat_exchanges_coalesced_total           повторные отправки, присоединенные к выполняющемуся обмену
+    chat_generations_cancelled_total         генерации, отмененные пользователем
+    generations_refunded_total               возвраты зарезервированных генераций (ошибка или отмена)
+"""
+import functools
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+# Границы корзин гистограмм в секундах (как у клиентов Prometheus)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_DEFAULTS = {
+    "enabled": True,
+    "host": "127.0.0.1",
+    "port": 9108
+}
+
+HELP = {
+    "db_operation_seconds": "Время операций DatabaseManager",
+    "db_operation_errors_total": "Исключения в операциях DatabaseManager",
+    "cache_requests_total": "Обращения к кэшам по результату (hit/miss)",
+    "flowise_request_seconds": "Время запросов к Flowise",
+    "flowise_request_errors_total": "Ошибки запросов к Flowise",
+    "flowise_first_token_seconds": "Время до первой части потокового ответа Flowise",
+    "flowise_retries_total": "Повторы запросов к Flowise",
+    "flowise_breaker_open_total": "Размыкания предохранителя Flowise",
+    "attachment_resize_seconds": "Время уменьшения и перекодирования изображений-вложений",
+    "documents_ingested_total": "Загруженные документы по результату индексирования",
+    "translation_seconds": "Время перевода текста",
+    "translation_errors_total": "Ошибки перевода",
+    "reply_translations_total": "Фоновый автоперевод ответов помощника по результату",
+    "log_errors_total": "Записи журнала уровня ERROR и выше",
+    "log_dropped_total": "Записи журнала, отброшенные при заполненной очереди",
+    "chat_exchanges_coalesced_total": "Повторные отправки, присоединенные к выполняющемуся обмену",
+    "chat_generations_cancelled_total": "Генерации, отмененные пользователем",
+    "generations_refunded_total": "Возвраты зарезервированных генераций",
+}
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[Tuple, float]] = {}
+_histograms: Dict[str, Dict[Tuple, list]] = {}
+
+
+def _key(labels: Dict) -> Tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличение счетчика"""
+    key = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """Наблюдение для гистограммы (значение в секундах)"""
+    key = _key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        state = series.get(key)
+        if state is None:
+            # [счетчики по корзинам, сумма, количество]
+            state = series[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+
+def cache_result(cache: str, hit: bool):
+    """Попадание или промах кэша"""
+    inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+class timed:
+    """Время выполнения и исключения блока кода или функции.
+
+    Пишет гистограмму <metric>_seconds и счетчик <metric>_errors_total:
+
+        with metrics.timed("flowise_request", mode="predict"):
+            ...
+
+        @metrics.timed("translation")
+        def translate_text(...):
+            ...
+    """
+
+    def __init__(self, metric: str, **labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(f"{self.metric}_seconds", time.perf_counter() - self._started, **self.labels)
+        # Закрытие генератора потребителем ошибкой не считается
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            inc(f"{self.metric}_errors_total", **self.labels)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.metric, **self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def instrument_methods(cls, metric: str, names: Iterable[str]):
+    """Оборачивает методы класса в timed(metric, operation=<имя метода>)"""
+    for name in names:
+        setattr(cls, name, timed(metric, operation=name)(getattr(cls, name)))
+
+
+def reset():
+    """Сброс всех значений (для бенчмарков)"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus 0.0.4"""
+    with _lock:
+        counters = {name: dict(series) for name, series in _counters.items()}
+        histograms = {
+            name: {key: (list(state[0]), state[1], state[2]) for key, state in series.items()}
+            for name, series in _histograms.items()
+        }
+
+    lines = []
+    for name in sorted(counters):
+        if name in HELP:
+            lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(counters[name].items()):
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+    for name in sorted(histograms):
+        if name in HELP:
+            lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, (buckets, total, count) in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(key)} {repr(total)}")
+            lines.append(f"{name}_count{_format_labels(key)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def create_app():
+    """Приложение FastAPI с единственным маршрутом /metrics"""
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    app = FastAPI(title="Метрики", docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    return app
+
+
+_server_started = False
+_server_lock = threading.Lock()
+
+
+def _metrics_setting(key: str):
+    import streamlit as st
+    try:
+        return st.secrets["metrics"].get(key, METRICS_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return METRICS_DEFAULTS[key]
+
+
+def start_server():
+    """Запуск HTTP-сервера метрик в фоновом потоке (один раз на процесс)"""
+    global _server_started
+    if _server_started:
+        return
+    with _server_lock:
+        if _server_started:
+            return
+        _server_started = True
+        if not _metrics_setting("enabled"):
+            return
+        host, port = _metrics_setting("host"), int(_metrics_setting("port"))
+        threading.Thread(target=_serve, args=(host, port), name="metrics-server", daemon=True).start()
+
+
+def _serve(host: str, port: int):
+    try:
+        import uvicorn
+        config = uvicorn.Config(create_app(), host=host, port=port, log_level="warning", access_log=False)
+        uvicorn.Server(config).run()
+    except BaseException as e:
+        # uvicorn завершает поток через SystemExit, если порт занят
+        from utils.log import get_logger
+        get_logger(__name__).error(f"Сервер метрик не запущен ({host}:{port}): {e!r}")
@@ -2,6 +2,7 @@ from st_pages import Page, show_pages, add_page_title
 import streamlit as st
 import os
 from utils.database.database_manager import get_database
+from utils import metrics
 
 # Словарь с настройками страниц
 PAGE_CONFIG = {
@@ -63,11 +64,30 @@ PAGE_CONFIG = {
         "order": 8,
         "show_when_authenticated": True,
         "admin_only": True
+    },
+    "admin/transfer": {
+        "name": "Перенос данных",
+        "icon": "📦",
+        "order": 9,
+        "show_when_authenticated": True,
+        "show_in_menu": True,
+        "admin_only": True
+    },
+    "admin/response_cache": {
+        "name": "Кэш ответов",
+        "icon": "🗄️",
+        "order": 10,
+        "show_when_authenticated": True,
+        "show_in_menu": True,
+        "admin_only": True
     }
 }
 
 def setup_pages():
     """Настройка страниц приложения"""
+    # Сервер метрик запускается один раз на процесс при первом перезапуске
+    metrics.start_server()
+    
     pages_to_show = []
     is_authenticated = st.session_state.get("authenticated", False)
     is_admin = st.session_state.get("is_admin", False)
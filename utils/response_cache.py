@@ -0,0 +1,144 @@
+"""Кэш ответов Flowise на повторяющиеся вопросы.
+
+Два уровня, оба выключены по умолчанию:
+- точное совпадение: ключ — id чат-потока и нормализованный вопрос (регистр
+  и пробелы не учитываются), значение хранится в Redis с TTL;
+- близкие вопросы: косинусный индекс в памяти процесса
+  (utils/semantic_cache.py), проверяется после промаха первого уровня.
+
+Настройки в secrets.toml:
+
+    [response_cache]
+    enabled = true              # точное совпадение
+    semantic = true             # близкие вопросы
+    ttl = 3600                  # секунд, для обоих уровней
+    max_question_length = 500   # длинные вопросы не кэшируются
+    similarity_threshold = 0.88
+    semantic_max_entries = 1000 # записей на чат-поток
+
+Кэш подключен только в бесплатном чате (pages/simple_chat.py): ключ не
+содержит сессию, поэтому чат-потоки с памятью сессии (поисковый чат,
+помощники) отдали бы ответ, построенный по чужому разговору.
+
+Очистка — страница администратора "Кэш ответов" (pages/admin/response_cache.py).
+"""
+import hashlib
+import threading
+import unicodedata
+from typing import Optional
+
+import streamlit as st
+
+from utils import metrics
+
+RESPONSE_CACHE_DEFAULTS = {
+    "enabled": False,
+    "ttl": 3600,
+    "max_question_length": 500,
+    "semantic": False,
+    "similarity_threshold": 0.88,
+    "semantic_max_entries": 1000
+}
+
+KEY_PREFIX = "response_cache"
+PURGE_BATCH_SIZE = 500
+
+_semantic_cache = None
+_semantic_lock = threading.Lock()
+
+
+def _cache_setting(key: str):
+    try:
+        return st.secrets["response_cache"].get(key, RESPONSE_CACHE_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return RESPONSE_CACHE_DEFAULTS[key]
+
+
+def is_enabled() -> bool:
+    return bool(_cache_setting("enabled"))
+
+
+def is_semantic_enabled() -> bool:
+    return bool(_cache_setting("semantic"))
+
+
+def get_semantic_cache():
+    """Индекс близких вопросов процесса (создается при первом обращении)"""
+    global _semantic_cache
+    if _semantic_cache is None:
+        with _semantic_lock:
+            if _semantic_cache is None:
+                from utils.semantic_cache import SemanticCache
+                _semantic_cache = SemanticCache(
+                    threshold=float(_cache_setting("similarity_threshold")),
+                    max_entries=int(_cache_setting("semantic_max_entries")),
+                    ttl=float(_cache_setting("ttl"))
+                )
+    return _semantic_cache
+
+
+def normalize_question(question: str) -> str:
+    """Вопрос без различий в регистре, пробелах и формах символов Unicode"""
+    return " ".join(unicodedata.normalize("NFKC", question).casefold().split())
+
+
+def cache_key(flow_id: str, question: str) -> Optional[str]:
+    normalized = normalize_question(question)
+    if not normalized or len(normalized) > int(_cache_setting("max_question_length")):
+        return None
+    return f"{KEY_PREFIX}:{flow_id}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+
+def get_response(db, flow_id: str, question: str) -> Optional[str]:
+    """Сохраненный ответ на этот или близкий вопрос, иначе None"""
+    key = cache_key(flow_id, question)
+    if key is None:
+        return None
+    if is_enabled():
+        response = db.cache_get(key)
+        metrics.cache_result("response", response is not None)
+        if response is not None:
+            return response
+    if is_semantic_enabled():
+        response = get_semantic_cache().lookup(flow_id, question)
+        metrics.cache_result("semantic", response is not None)
+        return response
+    return None
+
+
+def store_response(db, flow_id: str, question: str, response: str):
+    if not response:
+        return
+    key = cache_key(flow_id, question)
+    if key is None:
+        return
+    if is_enabled():
+        db.cache_set(key, response, expire=int(_cache_setting("ttl")))
+    if is_semantic_enabled():
+        get_semantic_cache().add(flow_id, question, response)
+
+
+def _keys(db, flow_id: Optional[str] = None):
+    return db.redis_client.scan_iter(match=f"{KEY_PREFIX}:{flow_id or '*'}:*", count=PURGE_BATCH_SIZE)
+
+
+def count(db, flow_id: Optional[str] = None) -> int:
+    """Количество сохраненных ответов (всех потоков или одного)"""
+    return sum(1 for _ in _keys(db, flow_id))
+
+
+def purge(db, flow_id: Optional[str] = None) -> int:
+    """Удаление сохраненных ответов; возвращает количество удаленных записей.
+
+    Индекс близких вопросов очищается только в текущем процессе.
+    """
+    deleted = get_semantic_cache().clear(flow_id) if _semantic_cache is not None else 0
+    batch = []
+    for key in _keys(db, flow_id):
+        batch.append(key)
+        if len(batch) >= PURGE_BATCH_SIZE:
+            deleted += db.redis_client.delete(*batch)
+            batch = []
+    if batch:
+        deleted += db.redis_client.delete(*batch)
+    return deleted
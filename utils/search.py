@@ -0,0 +1,100 @@
+"""Поиск по истории чатов.
+
+Каждое сообщение дублируется в коллекцию chat_search с текстовым индексом
+(username, content); записи добавляются при сохранении сообщений
+(DatabaseManager.append_messages) и удаляются вместе с сессией.
+
+Перестроение индекса для уже существующей истории:
+    python -m utils.search --reindex [--user имя]
+"""
+import argparse
+import re
+
+SNIPPET_WIDTH = 160
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _stems(query):
+    """Основы слов запроса: окончания отбрасываются, как при стемминге индекса"""
+    stems = []
+    for word in _WORD_RE.findall(query.lower()):
+        stem = word[:max(4, len(word) - 2)] if len(word) > 4 else word
+        if stem not in stems:
+            stems.append(stem)
+    return stems
+
+
+def stems_pattern(query):
+    """Регулярное выражение, совпадающее с любой основой слов запроса"""
+    return "|".join(re.escape(stem) for stem in _stems(query))
+
+
+def make_snippet(content, query, width=SNIPPET_WIDTH):
+    """Фрагмент сообщения вокруг первого совпадения с выделенными словами запроса"""
+    text = " ".join(content.split())
+    stems = _stems(query)
+    if not stems:
+        return text[:width] + ("…" if len(text) > width else "")
+
+    pattern = re.compile(r"\w*(?:" + stems_pattern(query) + r")\w*", re.IGNORECASE)
+    match = pattern.search(text)
+    position = match.start() if match else 0
+
+    start = max(0, position - width // 3)
+    end = min(len(text), start + width)
+    start = max(0, end - width)
+    # Не обрезаем слова на границах фрагмента
+    if start > 0:
+        space = text.find(" ", start)
+        if 0 <= space < position:
+            start = space + 1
+    if end < len(text):
+        space = text.rfind(" ", position, end)
+        if space > position:
+            end = space
+
+    snippet = pattern.sub(lambda m: f"**{m.group(0)}**", text[start:end])
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+def reindex(db, username=None):
+    """Перестроение поискового индекса по истории и архиву"""
+    query = {"username": username} if username else {}
+    db.chat_search.delete_many(query)
+
+    indexed = 0
+    histories = db.chat_history.find(
+        query,
+        {"username": 1, "flow_id": 1, "session_id": 1, "messages": 1, "archived_segments": 1},
+        batch_size=50
+    )
+    for history in histories:
+        key = (history["username"], history["flow_id"], history["session_id"])
+        for segment in range(history.get("archived_segments", 0)):
+            messages = db.load_archived_segment(*key, segment)
+            db.index_messages(*key, messages)
+            indexed += len(messages)
+        messages = history.get("messages", [])
+        db.index_messages(*key, messages)
+        indexed += len(messages)
+    return indexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поисковый индекс истории чатов")
+    parser.add_argument("--reindex", action="store_true", help="перестроить индекс")
+    parser.add_argument("--user", default=None, help="только для одного пользователя")
+    args = parser.parse_args()
+
+    if not args.reindex:
+        parser.print_help()
+        return
+
+    from utils.database.database_manager import get_database
+    indexed = reindex(get_database(), args.user)
+    print(f"Проиндексировано сообщений: {indexed}")
+
+
+if __name__ == "__main__":
+    main()
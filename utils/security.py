@@ -1,13 +1,78 @@
 from passlib.hash import pbkdf2_sha256
 import re
+import time
+import uuid
 from datetime import datetime, timedelta
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import redis
+from utils.database.database_manager import get_database
+from utils.log import get_logger
+
+log = get_logger(__name__)
 
 # Константы безопасности
 MAX_LOGIN_ATTEMPTS = 3
+MAX_CLIENT_LOGIN_ATTEMPTS = 20  # попыток с одного клиента за окно
+LOGIN_WINDOW = 15  # минут
 LOCKOUT_DURATION = 15  # минут
 PASSWORD_MIN_LENGTH = 8
 
+SECURITY_DEFAULTS = {
+    # Сколько доверенных прокси (nginx, балансировщик) дописывают адрес в
+    # X-Forwarded-For; 0 — заголовкам прокси не доверять
+    "trusted_proxy_hops": 1
+}
+
+# Резервирование попытки входа до проверки пароля.
+# KEYS: окно пользователя, блокировка пользователя, окно клиента, блокировка клиента
+# ARGV: now_ms, window_ms, lockout_ms, member, max_user, max_client
+# Возвращает {1, 0} если попытка разрешена, иначе {0, оставшееся время блокировки в мс}
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local lockout = tonumber(ARGV[3])
+local ttl = math.max(redis.call('PTTL', KEYS[2]), redis.call('PTTL', KEYS[4]))
+if ttl > 0 then
+    return {0, ttl}
+end
+local locked = 0
+for i = 1, 2 do
+    local window_key = KEYS[2 * i - 1]
+    redis.call('ZREMRANGEBYSCORE', window_key, '-inf', now - window)
+    if redis.call('ZCARD', window_key) >= tonumber(ARGV[4 + i]) then
+        redis.call('SET', KEYS[2 * i], 1, 'PX', lockout)
+        redis.call('DEL', window_key)
+        locked = 1
+    end
+end
+if locked == 1 then
+    return {0, lockout}
+end
+for i = 1, 2 do
+    redis.call('ZADD', KEYS[2 * i - 1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[2 * i - 1], window)
+end
+return {1, 0}
+"""
+
+# Учет неудачной попытки (сама попытка уже записана при резервировании).
+# KEYS: окно пользователя, блокировка пользователя
+# ARGV: now_ms, window_ms, lockout_ms, max_user
+# Возвращает {число попыток в окне, оставшееся время блокировки в мс}
+_FAIL_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+local count = redis.call('ZCARD', KEYS[1])
+if count >= tonumber(ARGV[4]) then
+    redis.call('SET', KEYS[2], 1, 'PX', tonumber(ARGV[3]))
+    redis.call('DEL', KEYS[1])
+end
+return {count, redis.call('PTTL', KEYS[2])}
+"""
+
+_login_scripts = {}
+
 def hash_password(password):
     """Хеширование пароля с использованием PBKDF2"""
     return pbkdf2_sha256.hash(password)
@@ -35,8 +100,134 @@ def is_strong_password(password):
     
     return True, "Пароль соответствует требованиям"
 
+def _security_setting(key):
+    try:
+        return st.secrets["security"].get(key, SECURITY_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return SECURITY_DEFAULTS[key]
+
+def get_client_id():
+    """Идентификатор клиента для ограничения попыток входа.
+    
+    Левые адреса X-Forwarded-For задает сам клиент, поэтому берется адрес,
+    дописанный первым доверенным прокси (trusted_proxy_hops справа).
+    """
+    try:
+        hops = int(_security_setting("trusted_proxy_hops"))
+        if hops > 0:
+            headers = st.context.headers
+            forwarded_for = [ip.strip() for ip in headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+            if forwarded_for:
+                return forwarded_for[-min(hops, len(forwarded_for))]
+            real_ip = headers.get("X-Real-Ip")
+            if real_ip:
+                return real_ip.strip()
+    except Exception:
+        pass
+    
+    # Без заголовков прокси ограничиваем хотя бы текущую сессию браузера
+    ctx = get_script_run_ctx()
+    return f"session:{ctx.session_id}" if ctx else "unknown"
+
+def _login_keys(username, client_id):
+    return [
+        f"login:attempts:user:{username}",
+        f"login:lock:user:{username}",
+        f"login:attempts:client:{client_id}",
+        f"login:lock:client:{client_id}"
+    ]
+
+def _get_login_script(name, source):
+    """Регистрация Lua-скрипта в Redis (выполняется через EVALSHA)"""
+    if name not in _login_scripts:
+        _login_scripts[name] = get_database().redis_client.register_script(source)
+    return _login_scripts[name]
+
+def _lockout_message(ttl_ms):
+    remaining_time = max(1, -(-int(ttl_ms) // 60000))
+    return f"Аккаунт заблокирован. Попробуйте через {remaining_time} минут"
+
 def check_login_attempts(username):
-    """Проверка попыток входа"""
+    """Проверка попыток входа.
+    
+    Попытка резервируется в Redis до проверки пароля, поэтому лимит общий
+    для всех вкладок и процессов и заблокированный запрос не доходит до хеширования.
+    """
+    client_id = get_client_id()
+    member = f"{int(time.time() * 1000)}:{uuid.uuid4().hex[:8]}"
+    try:
+        allowed, ttl_ms = _get_login_script("acquire", _ACQUIRE_SCRIPT)(
+            keys=_login_keys(username, client_id),
+            args=[
+                int(time.time() * 1000),
+                LOGIN_WINDOW * 60 * 1000,
+                LOCKOUT_DURATION * 60 * 1000,
+                member,
+                MAX_LOGIN_ATTEMPTS,
+                MAX_CLIENT_LOGIN_ATTEMPTS
+            ]
+        )
+    except redis.RedisError as e:
+        log.warning(f"Ошибка ограничителя попыток входа: {str(e)}")
+        return _check_local_login_attempts(username)
+    
+    if not allowed:
+        return False, _lockout_message(ttl_ms)
+    
+    st.session_state.login_attempt = {
+        'username': username,
+        'client_id': client_id,
+        'member': member
+    }
+    return True, ""
+
+def increment_login_attempts(username):
+    """Увеличение счетчика неудачных попыток входа"""
+    try:
+        count, ttl_ms = _get_login_script("fail", _FAIL_SCRIPT)(
+            keys=_login_keys(username, get_client_id())[:2],
+            args=[
+                int(time.time() * 1000),
+                LOGIN_WINDOW * 60 * 1000,
+                LOCKOUT_DURATION * 60 * 1000,
+                MAX_LOGIN_ATTEMPTS
+            ]
+        )
+    except redis.RedisError as e:
+        log.warning(f"Ошибка ограничителя попыток входа: {str(e)}")
+        return _increment_local_login_attempts(username)
+    
+    if ttl_ms > 0:
+        return False, f"Превышено количество попыток. Аккаунт заблокирован на {LOCKOUT_DURATION} минут"
+    
+    remaining_attempts = MAX_LOGIN_ATTEMPTS - count
+    return True, f"Осталось попыток: {remaining_attempts}"
+
+def reset_login_attempts(username):
+    """Сброс счетчика попыток входа"""
+    attempt = st.session_state.pop('login_attempt', None)
+    try:
+        user_window, user_lock, client_window, _ = _login_keys(
+            username,
+            attempt['client_id'] if attempt else get_client_id()
+        )
+        pipe = get_database().redis_client.pipeline()
+        pipe.delete(user_window, user_lock)
+        if attempt and attempt['username'] == username:
+            # Успешный вход не расходует лимит клиента
+            pipe.zrem(client_window, attempt['member'])
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning(f"Ошибка ограничителя попыток входа: {str(e)}")
+    
+    if username in st.session_state.get('login_attempts', {}):
+        st.session_state.login_attempts[username] = {
+            'attempts': 0,
+            'lockout_until': None
+        }
+
+def _check_local_login_attempts(username):
+    """Проверка попыток входа в рамках сессии (если Redis недоступен)"""
     if 'login_attempts' not in st.session_state:
         st.session_state.login_attempts = {}
     
@@ -59,8 +250,9 @@ def check_login_attempts(username):
     
     return True, ""
 
-def increment_login_attempts(username):
-    """Увеличение счетчика неудачных попыток входа"""
+def _increment_local_login_attempts(username):
+    """Учет неудачной попытки в рамках сессии (если Redis недоступен)"""
+    _check_local_login_attempts(username)
     user_attempts = st.session_state.login_attempts[username]
     user_attempts['attempts'] += 1
     
@@ -70,11 +262,3 @@ def increment_login_attempts(username):
     
     remaining_attempts = MAX_LOGIN_ATTEMPTS - user_attempts['attempts']
     return True, f"Осталось попыток: {remaining_attempts}"
-
-def reset_login_attempts(username):
-    """Сброс счетчика попыток входа"""
-    if username in st.session_state.login_attempts:
-        st.session_state.login_attempts[username] = {
-            'attempts': 0,
-            'lockout_until': None
-        }
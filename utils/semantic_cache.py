@@ -0,0 +1,235 @@
+"""Кэш ответов на близкие по смыслу вопросы в памяти процесса.
+
+Вопрос превращается в вектор без внешних сервисов: основы слов и
+символьные триграммы хэшируются в вектор фиксированной длины (NumPy),
+вес признака — логарифм частоты, вектор нормируется. Близость вопросов —
+косинус, ответ берется из кэша, если он не ниже порога.
+
+Косинус по словам и триграммам высок и у вопросов с противоположным
+смыслом ("как включить ..." и "как отключить ...", "monthly" и "yearly"),
+поэтому ответ отдается, только если совпадают значимые слова: основы без
+служебных слов (utils/stopwords.py), с отрицаниями и числами. Синонимы
+из небольшого словаря (_SYNONYMS) приводятся к одному слову, служебные
+слова почти не влияют на вектор, поэтому перефразированный вопрос с теми
+же значимыми словами ("сколько стоит подписка", "какова цена подписки")
+находится, хотя общих слов у вопросов почти нет.
+
+Записи хранятся отдельно для каждого чат-потока; при заполнении
+вытесняется запись, которая дольше всех не использовалась. Настройки и
+подключение к страницам — в utils/response_cache.py.
+"""
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from typing import Dict, FrozenSet, Optional, Tuple
+
+import numpy as np
+
+from utils.stopwords import STOPWORDS
+
+DEFAULT_DIM = 2048
+DEFAULT_THRESHOLD = 0.88
+DEFAULT_MAX_ENTRIES = 1000
+INITIAL_CAPACITY = 64
+CANDIDATES = 8  # ближайших записей, у которых сверяются значимые слова
+
+# Вклад символьных триграмм относительно основ слов: они сглаживают формы
+# слов, но не должны делать похожими "подключить" и "отключить"
+NGRAM_WEIGHT = 0.3
+# Служебные слова почти не влияют на близость
+STOPWORD_WEIGHT = 0.1
+
+# Синонимы: слово, начинающееся с одного из префиксов, заменяется основой
+# слева. Только пары, которые в вопросах к помощникам означают одно и то же
+_SYNONYMS = {
+    "цена": ("цен", "стои", "price", "cost"),
+    "удал": ("удал", "стере", "стира", "delete", "remove"),
+}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _stem(word: str) -> str:
+    for canonical, prefixes in _SYNONYMS.items():
+        if word.startswith(prefixes):
+            return canonical
+    # Основа слова — как в поиске по истории (utils/search.py)
+    return word[:max(4, len(word) - 2)] if len(word) > 4 else word
+
+
+def _words(text: str):
+    normalized = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    return _WORD_RE.findall(normalized)
+
+
+def _features(words):
+    for word in words:
+        if word in STOPWORDS:
+            yield "w:" + word, STOPWORD_WEIGHT
+            continue
+        stem = _stem(word)
+        yield "w:" + stem, 1.0
+        # Триграммы по основе: у синонимов они тоже совпадают
+        padded = f"<{stem}"
+        for i in range(len(padded) - 2):
+            yield "c:" + padded[i:i + 3], NGRAM_WEIGHT
+
+
+def significant_words(text: str) -> FrozenSet[str]:
+    """Значимые основы вопроса: без служебных слов, с отрицаниями и числами"""
+    return frozenset(_stem(word) for word in _words(text) if word not in STOPWORDS)
+
+
+def _same_meaning(first: FrozenSet[str], second: FrozenSet[str]) -> bool:
+    """Значимые основы совпадают с точностью до формы слова.
+
+    Основа с отброшенным окончанием у разных форм бывает разной длины
+    ("аккау" и "аккаун"), поэтому основы считаются одинаковыми, если
+    одна начинается с другой длиной от 4 символов.
+    """
+    def covered(stems, others):
+        return all(
+            stem in others or (len(stem) >= 4 and any(
+                other.startswith(stem) or (len(other) >= 4 and stem.startswith(other)) for other in others
+            ))
+            for stem in stems
+        )
+    return covered(first, second) and covered(second, first)
+
+
+def vectorize(text: str, dim: int = DEFAULT_DIM) -> Optional[np.ndarray]:
+    """Нормированный вектор текста или None для текста без слов"""
+    indices = []
+    weights = []
+    for feature, weight in _features(_words(text)):
+        # crc32 не зависит от PYTHONHASHSEED; старший бит задает знак признака
+        digest = zlib.crc32(feature.encode("utf-8"))
+        indices.append(digest % dim)
+        weights.append(-weight if digest & 0x80000000 else weight)
+    if not indices:
+        return None
+    vector = np.bincount(indices, weights=weights, minlength=dim)
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return None
+    return (vector / norm).astype(np.float32)
+
+
+def _grow(array: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _Partition:
+    """Векторы, значимые слова и ответы одного чат-потока"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((INITIAL_CAPACITY, dim), dtype=np.float32)
+        self.last_used = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.expires = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
+        self.words = []
+        self.responses = []
+
+    def __len__(self):
+        return len(self.responses)
+
+    def best_match(self, vector: np.ndarray, words: FrozenSet[str], now: float,
+                   threshold: float) -> Tuple[Optional[int], float]:
+        """Ближайшая запись не ниже порога с теми же значимыми словами"""
+        size = len(self.responses)
+        if size == 0:
+            return None, 0.0
+        similarities = self.vectors[:size] @ vector
+        similarities[self.expires[:size] <= now] = -1.0
+        count = min(CANDIDATES, size)
+        candidates = np.argpartition(-similarities, count - 1)[:count]
+        for index in candidates[np.argsort(-similarities[candidates])]:
+            similarity = float(similarities[index])
+            if similarity < threshold:
+                break
+            if _same_meaning(words, self.words[index]):
+                return int(index), similarity
+        return None, 0.0
+
+    def slot_for_new(self, max_entries: int) -> int:
+        size = len(self.responses)
+        if size < max_entries:
+            if size == len(self.vectors):
+                capacity = min(max_entries, size * 2)
+                self.vectors = _grow(self.vectors, capacity)
+                self.last_used = _grow(self.last_used, capacity)
+                self.expires = _grow(self.expires, capacity)
+            self.words.append(None)
+            self.responses.append(None)
+            return size
+        # Вытесняется запись, которая дольше всех не использовалась
+        return int(np.argmin(self.last_used[:size]))
+
+
+class SemanticCache:
+    """Косинусный индекс вопросов с ответами, разделенный по чат-потокам"""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl: float = 3600, dim: int = DEFAULT_DIM):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dim = dim
+        self._partitions: Dict[str, _Partition] = {}
+        self._lock = threading.Lock()
+        self._tick = 0
+
+    def lookup(self, flow_id: str, question: str) -> Optional[str]:
+        """Ответ на самый близкий вопрос, если близость не ниже порога"""
+        vector = vectorize(question, self.dim)
+        if vector is None:
+            return None
+        words = significant_words(question)
+        with self._lock:
+            partition = self._partitions.get(flow_id)
+            if partition is None:
+                return None
+            best, _ = partition.best_match(vector, words, time.time(), self.threshold)
+            if best is None:
+                return None
+            self._tick += 1
+            partition.last_used[best] = self._tick
+            return partition.responses[best]
+
+    def add(self, flow_id: str, question: str, response: str):
+        vector = vectorize(question, self.dim)
+        if vector is None or not response:
+            return
+        words = significant_words(question)
+        now = time.time()
+        with self._lock:
+            partition = self._partitions.setdefault(flow_id, _Partition(self.dim))
+            # Тот же вопрос еще раз обновляет существующую запись
+            best, _ = partition.best_match(vector, words, now, 0.999)
+            slot = best if best is not None else partition.slot_for_new(self.max_entries)
+            self._tick += 1
+            partition.vectors[slot] = vector
+            partition.words[slot] = words
+            partition.last_used[slot] = self._tick
+            partition.expires[slot] = now + self.ttl
+            partition.responses[slot] = response
+
+    def size(self, flow_id: Optional[str] = None) -> int:
+        with self._lock:
+            if flow_id is not None:
+                return len(self._partitions.get(flow_id, ()))
+            return sum(len(partition) for partition in self._partitions.values())
+
+    def clear(self, flow_id: Optional[str] = None) -> int:
+        """Удаление записей потока (или всех); возвращает количество удаленных"""
+        with self._lock:
+            if flow_id is not None:
+                partition = self._partitions.pop(flow_id, None)
+                return len(partition) if partition else 0
+            removed = sum(len(partition) for partition in self._partitions.values())
+            self._partitions.clear()
+            return removed
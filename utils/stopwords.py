@@ -0,0 +1,30 @@
+"""Служебные слова вопросов на русском и английском.
+
+Предлоги, союзы, местоимения, вопросительные слова и вежливые обращения
+не говорят о теме вопроса: по ним не ищутся фрагменты документов
+(utils/documents.py) и не сравниваются вопросы в кэше близких вопросов
+(utils/semantic_cache.py). Отрицания вынесены отдельно: для темы они не
+важны, но меняют смысл вопроса на противоположный.
+"""
+
+STOPWORDS = frozenset("""
+а в во на за к ко с со о об обо у из от до по и но же бы ли вот даже
+как какой какая какое какие каких каким какими какую каком каков какова
+каково каковы что чего чем чему это этот эта эти этого этой том тот та те
+то для или либо при где когда куда откуда почему зачем сколько кто чей
+можно нужно надо есть был была были было быть будет если чтобы так такой
+такая такое такие там тут здесь уже еще ещё все всё весь вся всех я мне
+меня мой моя мое мои ты вы вас ваш ваша ваши они она оно его её ее их нас
+наш про под над после перед между через около также тоже только очень
+более менее расскажи скажи подскажи объясни помоги напиши покажи
+расскажите скажите подскажите объясните помогите напишите покажите
+пожалуйста
+a an the and or but of to in on at by for is it what how why when where
+which who whom this that these those with from about into are was were be
+can could would should does do did have has had i me my please tell explain
+you your yours much many
+""".split())
+
+NEGATIONS = frozenset("""
+не нет ни без нельзя not no without never cannot
+""".split())
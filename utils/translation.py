@@ -1,23 +1,87 @@
-from googletrans import Translator
+"""Перевод сообщений чата.
+
+Кнопка 🔄 у сообщения переводит его по запросу. Ответы помощника на
+английском, кроме того, переводятся на русский автоматически, но вне
+критического пути: ответ сохраняется и показывается сразу, перевод
+выполняется в фоновом потоке (submit_reply_translation) и записывается в
+поле translation того же сообщения; content остается исходным текстом.
+Автоперевод включается для каждого помощника отдельно (поле auto_translate
+в chat_flows), значение по умолчанию задается в secrets.toml:
+
+    [translation]
+    auto_translate = true   # для помощников без собственной настройки
+    workers = 4             # одновременных фоновых переводов на процесс
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
 import streamlit as st
+from utils import metrics
+from utils.log import get_logger
+
+log = get_logger(__name__)
+
+TRANSLATION_DEFAULTS = {
+    "auto_translate": True,
+    "workers": 4
+}
+
+_translator = None
+_executor = None
+_pending: Dict[str, Future] = {}  # message_id -> фоновый перевод ответа
+_pending_lock = threading.Lock()
+
+def _translation_setting(key: str):
+    try:
+        return st.secrets["translation"].get(key, TRANSLATION_DEFAULTS[key])
+    except (KeyError, FileNotFoundError):
+        return TRANSLATION_DEFAULTS[key]
 
-# Создаем глобальный экземпляр переводчика
-translator = Translator()
+def get_translator():
+    """Глобальный экземпляр переводчика (googletrans загружается при первом обращении)"""
+    global _translator
+    if _translator is None:
+        from googletrans import Translator
+        _translator = Translator()
+    return _translator
 
-def translate_text(text, target_lang='ru'):
+def split_into_chunks(text, max_length=1000):
+    """Разбивает текст на части до max_length символов по границам предложений"""
+    parts = []
+    current_part = ""
+    sentences = text.replace('\n', '. ').split('. ')
+    
+    for sentence in sentences:
+        if len(current_part) + len(sentence) < max_length:
+            current_part += sentence + '. '
+        else:
+            if current_part:
+                parts.append(current_part.strip())
+            current_part = sentence + '. '
+    if current_part:
+        parts.append(current_part.strip())
+    return parts
+
+@metrics.timed("translation")
+def translate_text(text, target_lang='ru', raise_errors=False):
     """
     Переводит текст на указанный язык, разбивая длинный текст на части
     target_lang: 'ru' для русского или 'en' для английского
+    raise_errors: пробросить общую ошибку перевода вызывающему коду вместо
+    возврата исходного текста. Функция вызывается и из фонового потока,
+    где элементы Streamlit недоступны, поэтому ошибку в интерфейсе
+    показывает интерактивный вызов (кнопка 🔄)
     """
+    started = time.perf_counter()
     try:
-        print(f"Начало перевода текста. Целевой язык: {target_lang}")
-        print(f"Исходный текст (первые 100 символов): {text[:100]}...")
-        
         if text is None or not isinstance(text, str) or text.strip() == '':
-            print("Получен пустой текст для перевода")
+            log.debug("Получен пустой текст для перевода")
             return "Пустой текст для перевода"
         
         # Создаем новый экземпляр переводчика для каждого перевода
+        from googletrans import Translator
         translator = Translator()
         
         # Определяем язык текста
@@ -25,78 +89,128 @@ def translate_text(text, target_lang='ru'):
             detected = translator.detect(text)
             detected_lang = detected.lang
             confidence = detected.confidence
-            print(f"Определен язык: {detected_lang} (уверенность: {confidence})")
+            log.debug(f"Определен язык: {detected_lang} (уверенность: {confidence})")
             
             # Если уверенность в определении языка низкая, используем запасной метод
             if confidence < 0.8:
-                print("Низкая уверенность в определении языка, пробуем запасной метод...")
                 from langdetect import detect
                 detected_lang = detect(text)
-                print(f"Язык определен запасным методом: {detected_lang}")
+                log.debug(f"Низкая уверенность, язык определен запасным методом: {detected_lang}")
         except Exception as e:
-            print(f"Ошибка при определении языка: {str(e)}")
+            log.warning(f"Ошибка при определении языка: {str(e)}")
+            metrics.inc("translation_errors_total", stage="detect")
             return text
         
         # Если текст уже на целевом языке, возвращаем его
         if detected_lang == target_lang:
-            print(f"Текст уже на целевом языке ({target_lang})")
+            log.debug(f"Текст уже на целевом языке ({target_lang})")
             return text
         
         # Разбиваем текст на части по 1000 символов
-        print("Разбиваем текст на части...")
-        parts = []
-        current_part = ""
-        sentences = text.replace('\n', '. ').split('. ')
-        
-        for sentence in sentences:
-            if len(current_part) + len(sentence) < 1000:
-                current_part += sentence + '. '
-            else:
-                if current_part:
-                    parts.append(current_part.strip())
-                current_part = sentence + '. '
-        if current_part:
-            parts.append(current_part.strip())
-        
-        print(f"Текст разбит на {len(parts)} частей")
+        parts = split_into_chunks(text)
         
         # Переводим каждую часть отдельно
         translated_parts = []
         for i, part in enumerate(parts, 1):
             try:
-                print(f"Перевод части {i}/{len(parts)}...")
                 translation = translator.translate(part, dest=target_lang)
                 if translation and hasattr(translation, 'text'):
                     translated_parts.append(translation.text)
-                    print(f"Часть {i} успешно переведена")
+                    log.debug(f"Часть {i}/{len(parts)} переведена")
                 else:
-                    print(f"Ошибка: часть {i} не удалось перевести")
+                    log.warning(f"Часть {i}/{len(parts)} не удалось перевести")
+                    metrics.inc("translation_errors_total", stage="chunk")
                     translated_parts.append(part)
             except Exception as e:
-                print(f"Ошибка при переводе части {i}: {str(e)}")
+                log.warning(f"Ошибка при переводе части {i}/{len(parts)}: {str(e)}")
+                metrics.inc("translation_errors_total", stage="chunk")
                 translated_parts.append(part)
                 continue
         
         # Объединяем переведенные части
         result = ' '.join(translated_parts)
-        print("Перевод завершен успешно")
+        log.info(f"Текст переведен на {target_lang}: {len(text)} символов, частей: {len(parts)}",
+                 extra={"duration_ms": round((time.perf_counter() - started) * 1000)})
         return result
             
     except Exception as e:
-        print(f"Общая ошибка при переводе: {str(e)}")
-        st.error(f"Ошибка при переводе: {str(e)}")
+        log.error(f"Общая ошибка при переводе: {str(e)}", exc_info=True)
+        metrics.inc("translation_errors_total", stage="total")
+        if raise_errors:
+            raise
         return text
 
+def is_auto_translate_enabled(flow: Dict) -> bool:
+    """Переводить ли ответы помощника автоматически"""
+    value = flow.get("auto_translate")
+    return bool(_translation_setting("auto_translate") if value is None else value)
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _pending_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(_translation_setting("workers")), thread_name_prefix="translation"
+                )
+    return _executor
+
+def _translate_reply(db, username: str, flow_id: str, session_id: str, message: Dict) -> Optional[str]:
+    content = message["content"]
+    try:
+        from langdetect import detect
+        if detect(content) != 'en':
+            metrics.inc("reply_translations_total", result="skipped")
+            return None
+    except Exception:
+        metrics.inc("reply_translations_total", result="skipped")
+        return None
+
+    translated = translate_text(content, 'ru')
+    if not translated or translated == content:
+        metrics.inc("reply_translations_total", result="failed")
+        return None
+    db.set_message_translation(username, flow_id, session_id, message["message_id"], translated)
+    metrics.inc("reply_translations_total", result="translated")
+    return translated
+
+def submit_reply_translation(db, username: str, flow_id: str, session_id: str, message: Dict) -> Future:
+    """Фоновый перевод сохраненного ответа помощника на русский.
+
+    Повторный вызов для того же сообщения возвращает уже запущенный
+    перевод. Future возвращает перевод или None, если ответ не на
+    английском или перевести его не удалось.
+    """
+    message_id = message["message_id"]
+    executor = _get_executor()
+    with _pending_lock:
+        future = _pending.get(message_id)
+        if future is not None:
+            return future
+        future = _pending[message_id] = executor.submit(
+            _translate_reply, db, username, flow_id, session_id, message
+        )
+    future.add_done_callback(lambda done: _forget_translation(message_id, done))
+    return future
+
+def _forget_translation(message_id: str, future: Future):
+    with _pending_lock:
+        if _pending.get(message_id) is future:
+            del _pending[message_id]
+
+def is_translation_pending(message_id: str) -> bool:
+    with _pending_lock:
+        return message_id in _pending
+
 def display_message_with_translation(message, message_hash, avatar, role, button_key=None):
-    """Отображает сообщение с кнопкой перевода"""
-    # Добавляем уникальный идентификатор для каждого сообщения
-    if 'message_display_counter' not in st.session_state:
-        st.session_state.message_display_counter = 0
-    st.session_state.message_display_counter += 1
-    
-    # Создаем уникальный ключ для кнопки, используя счетчик
+    """Отображает сообщение с кнопкой перевода.
+
+    message_hash — постоянный идентификатор сообщения (message_id): ключи
+    кнопок не должны меняться между перезапусками, иначе нажатие,
+    записанное под старым ключом, теряется.
+    """
     if button_key is None:
-        button_key = f"translate_{message_hash}_{role}_{st.session_state.message_display_counter}"
+        button_key = f"translate_{message_hash}"
     
     translation_key = f"translation_{message_hash}"
     content = message.get("content", "")
@@ -121,6 +235,12 @@ def display_message_with_translation(message, message_hash, avatar, role, button
             
             current_state = st.session_state[translation_key]
             
+            # Автоматический перевод ответа показывается вместо оригинала,
+            # когда он готов; кнопка 🔄 возвращает исходный текст
+            if message.get("translation") and current_state["translated_text"] is None:
+                current_state["translated_text"] = message["translation"]
+                current_state["is_translated"] = True
+            
             # Отображаем текст
             if current_state["is_translated"]:
                 if current_state["translated_text"] is None:
@@ -130,20 +250,31 @@ def display_message_with_translation(message, message_hash, avatar, role, button
                 message_placeholder.markdown(content)
         
         with cols[1]:
-            # Кнопка перевода с динамической подсказкой и уникальным ключом
-            try:
-                detected_lang = translator.detect(content).lang
-                tooltip = "Перевести на английский" if detected_lang == 'ru' else "Перевести на русский"
-            except:
+            # Кнопка перевода с динамической подсказкой.
+            # Язык определяется локально и один раз на сообщение: запрос к
+            # Google Translate для каждой подсказки при каждом перезапуске
+            # скрипта делал отрисовку истории медленной
+            if "lang" not in current_state:
+                try:
+                    from langdetect import detect
+                    current_state["lang"] = detect(content)
+                except Exception:
+                    current_state["lang"] = None
+            if current_state["lang"]:
+                tooltip = "Перевести на английский" if current_state["lang"] == 'ru' else "Перевести на русский"
+            else:
                 tooltip = "Перевести"
                 
-            translate_button_key = f"{button_key}_translate_{st.session_state.message_display_counter}"
-            if st.button("🔄", key=translate_button_key, help=tooltip):
+            if st.button("🔄", key=button_key, help=tooltip):
                 current_state = st.session_state[translation_key]
                 current_state["is_translated"] = not current_state["is_translated"]
                 
                 if current_state["is_translated"] and current_state["translated_text"] is None:
-                    current_state["translated_text"] = translate_text(content)
+                    try:
+                        current_state["translated_text"] = translate_text(content, raise_errors=True)
+                    except Exception as e:
+                        st.error(f"Ошибка при переводе: {str(e)}")
+                        current_state["is_translated"] = False
                 
                 message_placeholder.markdown(
                     current_state["translated_text"] if current_state["is_translated"] 
@@ -151,9 +282,7 @@ def display_message_with_translation(message, message_hash, avatar, role, button
                 )
         
         with cols[2]:
-            # Кнопка удаления с уникальным ключом
-            delete_button_key = f"delete_{message_hash}_{st.session_state.message_display_counter}"
-            if st.button("🗑", key=delete_button_key, help="Удалить сообщение"):
+            if st.button("🗑", key=f"delete_{message_hash}", help="Удалить сообщение"):
                 return True
     
     return False 
\ No newline at end of file
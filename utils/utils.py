@@ -8,10 +8,16 @@ from streamlit.runtime.scriptrunner import add_script_run_ctx
 from streamlit import switch_page
 import streamlit as st
 from utils.database.database_manager import get_database
+from utils.log import get_logger
+
+log = get_logger(__name__)
 
 # Определяем базовый путь для файлов данных
 DATA_DIR = "/data" if os.path.exists("/data") else "."
 
+# Список деактивированных ключей
+DEACTIVATED_KEYS_FILE = os.path.join(os.path.dirname(__file__), '..', 'chat', 'deactivated_keys.json')
+
 # Функция для получения правильного пути к файлу
 def get_data_file_path(filename):
     """
@@ -28,17 +34,20 @@ def ensure_directories():
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
-ensure_directories()
-
-# Инициализация базы данных
-user_db = TinyDB(get_data_file_path('user_database.json'))
 User = Query()
+_user_db = None
 
-# Получаем экземпляр базы данных
-db = get_database()
+def get_user_db():
+    """Открывает локальную базу пользователей при первом обращении"""
+    global _user_db
+    if _user_db is None:
+        ensure_directories()
+        _user_db = TinyDB(get_data_file_path('user_database.json'))
+    return _user_db
 
 def check_token_status(username):
     """Проверяет статус токена пользователя"""
+    user_db = get_user_db()
     user = user_db.get(User.username == username)
     
     if not user:
@@ -81,7 +90,7 @@ def save_token(token, generations=500):
     try:
         # Проверяем, не был ли токен деактивирован ранее
         if is_token_deactivated(token):
-            print(f"Попытка повторного использования деактивированного токена: {token}")
+            log.warning(f"Попытка повторного использования деактивированного токена: {token}")
             return False
             
         # Читаем существующие данные или создаем новые
@@ -110,7 +119,7 @@ def save_token(token, generations=500):
             json.dump(data, f, ensure_ascii=False, indent=4)
         return True
     except Exception as e:
-        print(f"Error saving token: {str(e)}")
+        log.error(f"Error saving token: {str(e)}")
         return False
 
 def load_access_keys():
@@ -129,7 +138,7 @@ def load_access_keys():
                     return []
         return []
     except Exception as e:
-        print(f"Error loading keys: {str(e)}")
+        log.error(f"Error loading keys: {str(e)}")
         return []
 
 def remove_used_key(used_key):
@@ -157,11 +166,12 @@ def remove_used_key(used_key):
             json.dump(data, f, ensure_ascii=False, indent=4)
         return True
     except Exception as e:
-        print(f"Ошибка при удалении ключа: {str(e)}")
+        log.error(f"Ошибка при удалении ключа: {str(e)}")
         return False
 
 def update_remaining_generations(username, remaining):
     """Обновляет количество оставшихся генераций"""
+    db = get_database()
     user = db.get_user(username)
     
     if not user:
@@ -195,6 +205,7 @@ def update_remaining_generations(username, remaining):
                     }
                 }
             )
+            db.invalidate_user(username)
             
             if 'access_granted' in st.session_state:
                 st.session_state.access_granted = False
@@ -210,6 +221,7 @@ def update_remaining_generations(username, remaining):
                 }
             }
         )
+        db.invalidate_user(username)
     
     return True
 
@@ -220,7 +232,7 @@ def verify_user_access():
         switch_page("registr")
         return False
     
-    user = db.get_user(st.session_state.username)
+    user = get_database().get_user(st.session_state.username)
     if not user or not user.get('active_token'):
         st.warning("Необходим активный токен")
         switch_page("key_input")
@@ -236,7 +248,7 @@ def format_database():
             json.dump(data, f, ensure_ascii=False, indent=4)
         return True
     except Exception as e:
-        print(f"Ошибка форматирования базы данных: {str(e)}")
+        log.error(f"Ошибка форматирования базы данных: {str(e)}")
         return False
 
 def generate_unique_token():
@@ -247,9 +259,8 @@ def generate_and_save_token(generations=500):
     """Генерирует новый токен без сохранения в файл"""
     return generate_unique_token()
 
-def save_deactivated_token(token):
+def save_deactivated_token(token, deactivated_file=DEACTIVATED_KEYS_FILE):
     """Сохраняет деактивированный токен в отдельный файл"""
-    deactivated_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'deactivated_keys.json')
     try:
         if os.path.exists(deactivated_file):
             with open(deactivated_file, 'r', encoding='utf-8') as f:
@@ -270,12 +281,11 @@ def save_deactivated_token(token):
             json.dump(data, f, ensure_ascii=False, indent=4)
         return True
     except Exception as e:
-        print(f"Ошибка при сохранении деактивированного токена: {str(e)}")
+        log.error(f"Ошибка при сохранении деактивированного токена: {str(e)}")
         return False
 
-def is_token_deactivated(token):
+def is_token_deactivated(token, deactivated_file=DEACTIVATED_KEYS_FILE):
     """Проверяет, был ли токен деактивирован ранее"""
-    deactivated_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'deactivated_keys.json')
     try:
         if os.path.exists(deactivated_file):
             with open(deactivated_file, 'r', encoding='utf-8') as f:
@@ -284,5 +294,5 @@ def is_token_deactivated(token):
                 return token.strip('"') in deactivated_keys
         return False
     except Exception as e:
-        print(f"Ошибка при проверке деактивированного токена: {str(e)}")
+        log.error(f"Ошибка при проверке деактивированного токена: {str(e)}")
         return False